@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/asynccatalogs.py
+# License           : BSD-3-Clause
+
+import asyncio
+import logging
+import threading
+
+import numpy as np
+
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """
+    :return: angular distance(s) in degrees (haversine formula, vectorized)
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(np.asarray(v, dtype=float)) for v in (ra1, dec1, ra2, dec2))
+    a = np.sin((dec2 - dec1) / 2.) ** 2 + np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2.) ** 2
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(a, 0., 1.))))
+
+
+def async_mongo_client(uri=None, **kwargs):
+    """
+    :return: asyncio Mongo client (pymongo >= 4.9, else motor)
+    """
+    try:
+        from pymongo import AsyncMongoClient
+    except ImportError:
+        from motor.motor_asyncio import AsyncIOMotorClient as AsyncMongoClient
+    return AsyncMongoClient(uri, **kwargs)
+
+
+class AsyncCatalogBackend(object):
+    """
+    One asyncio Mongo client, and its connection pool, shared by the
+    catalog queries of a process.
+
+    The client lives in an event loop run by a background thread, so that
+    queries can be submitted from any thread (see submit) and many of them,
+    from many alerts, kept in flight at once. At most max_in_flight queries
+    are sent to the server at the same time, the others wait in the loop.
+    """
+
+    def __init__(self, uri=None, client=None, max_pool_size=50, max_in_flight=64, logger=None):
+        """
+        :param uri: Mongo uri of the extcats databases
+        :param client: already built asyncio client (default: async_mongo_client(uri))
+        :param max_pool_size: maximum number of connections of the client
+        :param max_in_flight: maximum number of concurrent queries
+        """
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='AsyncCatalogBackend', daemon=True)
+        self._thread.start()
+        self.max_in_flight = max_in_flight
+        self.n_queries = 0
+
+        async def setup():
+            # the client and the semaphore must be created in the loop
+            self.client = client if client is not None else \
+                async_mongo_client(uri, maxPoolSize=max_pool_size)
+            self.slots = asyncio.Semaphore(max_in_flight)
+        asyncio.run_coroutine_threadsafe(setup(), self.loop).result()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine (e.g. AsyncCatalogQuery.binaryserach) in the
+        backend loop.
+        :return: concurrent.futures.Future of its result. From another event
+                 loop, use `await asyncio.wrap_future(future)`.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        :return: result of the coroutine, run in the backend loop
+        """
+        return self.submit(coro).result(timeout)
+
+    def query(self, catalog, **kwargs):
+        """
+        :return: AsyncCatalogQuery of the catalog on this backend
+        """
+        return AsyncCatalogQuery(self, catalog, **kwargs)
+
+    def close(self):
+        if not self.loop.is_running():
+            return
+
+        async def shutdown():
+            # drop the queries still in flight, then close the client
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            close = getattr(self.client, 'close', None)
+            if close is not None:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+        self.run(shutdown())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+# backends shared by the units of the process, by uri and settings
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(uri=None, logger=None, **kwargs):
+    """
+    :param kwargs: AsyncCatalogBackend settings (max_pool_size, max_in_flight, client)
+    :return: the AsyncCatalogBackend of the uri and settings, created at the
+             first call. Units asking for other settings get their own
+             backend (and connection pool).
+    """
+    # an already built client is identified by its id
+    key = (uri, tuple(sorted((name, id(value) if name == 'client' else value)
+                             for name, value in kwargs.items())))
+    with _backends_lock:
+        backend = _backends.get(key)
+        if backend is None:
+            if any(other == uri for other, _ in _backends):
+                (logger or logging.getLogger()).info(
+                    "New catalog backend for %s with the settings %s", uri, kwargs)
+            backend = _backends[key] = AsyncCatalogBackend(uri, logger=logger, **kwargs)
+        return backend
+
+
+class AsyncCatalogQuery(object):
+    """
+    asyncio equivalent of the extcats CatalogQuery binaryserach and
+    findclosest searches, on an AsyncCatalogBackend.
+
+    With the '2dsphere' method, the sources are looked up through the
+    2dsphere index of the GeoJSON position `pos_key` (extcats layout,
+    longitude ra wrapped to [-180, 180)). With 'raw', a box around the position is selected
+    on ra_key / dec_key (which should be indexed) and the distances are
+    computed here.
+    """
+
+    def __init__(self, backend, catalog, ra_key='ra', dec_key='dec', pos_key='pos',
+                 coll_name='srcs', method='2dsphere', logger=None, **kwargs):
+        """
+        other keyword arguments (e.g. dbclient) of CatalogQuery are ignored
+        """
+        if method not in ('2dsphere', 'raw'):
+            raise ValueError("method must be '2dsphere' or 'raw', not %s" % method)
+        self.backend = backend
+        self.catalog = catalog
+        self.ra_key = ra_key
+        self.dec_key = dec_key
+        self.pos_key = pos_key
+        self.method = method
+        self.logger = logger if logger is not None else backend.logger
+        self.coll_name = coll_name
+
+    @property
+    def collection(self):
+        return self.backend.client[self.catalog][self.coll_name]
+
+    def search_filter(self, ra, dec, rs_arcsec):
+        """
+        :return: Mongo filter of the sources around the position
+        """
+        radius = rs_arcsec / 3600.
+        if self.method == '2dsphere':
+            return {self.pos_key: {'$geoWithin': {'$centerSphere': [[((ra + 180.) % 360.) - 180., dec], np.radians(radius)]}}}
+        dec_range = {'$gte': dec - radius, '$lte': dec + radius}
+        cos_dec = np.cos(np.radians(min(abs(dec) + radius, 90.)))
+        if cos_dec < radius / 180.:
+            # around the poles
+            return {self.dec_key: dec_range}
+        half_width = radius / cos_dec
+        ra_min, ra_max = ra - half_width, ra + half_width
+        if ra_min < 0. or ra_max >= 360.:
+            ra_range = {'$or': [{self.ra_key: {'$gte': ra_min % 360.}},
+                                {self.ra_key: {'$lte': ra_max % 360.}}]}
+            return dict(ra_range, **{self.dec_key: dec_range})
+        return {self.ra_key: {'$gte': ra_min, '$lte': ra_max}, self.dec_key: dec_range}
+
+    async def find(self, ra, dec, rs_arcsec, projection=None):
+        """
+        :return: (list of the source documents within rs_arcsec, their
+                 distances in arcsec)
+        """
+        if projection is None:
+            projection = {'_id': 0, self.pos_key: 0}
+        else:
+            projection = dict(projection, **{self.ra_key: 1, self.dec_key: 1})
+        async with self.backend.slots:
+            self.backend.n_queries += 1
+            srcs = await self.collection.find(self.search_filter(ra, dec, rs_arcsec),
+                                              projection).to_list(None)
+        if not srcs:
+            return [], np.empty(0)
+        dist = 3600. * angular_distance(ra, dec, [src[self.ra_key] for src in srcs],
+                                        [src[self.dec_key] for src in srcs])
+        # the filter of the raw method is a box
+        inside = dist <= rs_arcsec
+        return [src for src, keep in zip(srcs, inside) if keep], dist[inside]
+
+    async def binaryserach(self, ra, dec, rs_arcsec):
+        """
+        :return: True if there is any source within rs_arcsec of the position
+        """
+        if self.method == 'raw':
+            srcs, _ = await self.find(ra, dec, rs_arcsec, projection={'_id': 0})
+            return len(srcs) > 0
+        async with self.backend.slots:
+            self.backend.n_queries += 1
+            src = await self.collection.find_one(self.search_filter(ra, dec, rs_arcsec), {'_id': 1})
+        return src is not None
+
+    async def findclosest(self, ra, dec, rs_arcsec, projection=None):
+        """
+        :return: (closest source as an astropy table row, distance in arcsec),
+                 or (None, None) if there is none within rs_arcsec
+        """
+        srcs, dist = await self.find(ra, dec, rs_arcsec, projection)
+        if not srcs:
+            return None, None
+        # deferred import, astropy is slow to load
+        from astropy.table import Table
+        closest = int(np.argmin(dist))
+        return Table(rows=[srcs[closest]])[0], float(dist[closest])
+
+
+class SyncCatalogQuery(object):
+    """
+    Blocking facade of an AsyncCatalogQuery, with the CatalogQuery
+    interface used by the units. The submit_ methods return futures, to
+    keep several queries in flight.
+    """
+
+    def __init__(self, query, timeout=None):
+        self.query = query
+        self.timeout = timeout
+        self.ra_key = query.ra_key
+        self.dec_key = query.dec_key
+
+    def submit_binaryserach(self, ra, dec, rs_arcsec):
+        return self.query.backend.submit(self.query.binaryserach(ra, dec, rs_arcsec))
+
+    def submit_findclosest(self, ra, dec, rs_arcsec, projection=None):
+        return self.query.backend.submit(self.query.findclosest(ra, dec, rs_arcsec, projection))
+
+    def binaryserach(self, ra, dec, rs_arcsec):
+        return self.submit_binaryserach(ra, dec, rs_arcsec).result(self.timeout)
+
+    def findclosest(self, ra, dec, rs_arcsec, projection=None):
+        return self.submit_findclosest(ra, dec, rs_arcsec, projection).result(self.timeout)
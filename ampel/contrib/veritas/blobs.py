@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/blobs.py
+# License           : BSD-3-Clause
+
+import struct
+import numpy as np
+
+# Packed array layout (little endian):
+#   magic 'VBA' + format version (4 bytes), typecode 'f' (float32) or
+#   'd' (float64) (1 byte), ndim, always 1 (1 byte), reserved (2 bytes),
+#   number of elements (uint64), followed by the raw values. The 16 bytes
+#   header keeps the values 8-byte aligned.
+MAGIC = b'VBA\x01'
+HEADER = struct.Struct('<4scBxxQ')
+DTYPES = {b'f': np.dtype('<f4'), b'd': np.dtype('<f8')}
+TYPECODES = {'float32': b'f', 'float64': b'd'}
+
+
+def encode_array(values, dtype='float64'):
+    """
+    :param values: 1-d array-like of numbers
+    :param dtype: 'float32' or 'float64'
+    :return: bytes (stored as BSON binary)
+    """
+    typecode = TYPECODES[dtype]
+    values = np.ascontiguousarray(values, dtype=DTYPES[typecode]).ravel()
+    return HEADER.pack(MAGIC, typecode, 1, len(values)) + values.tobytes()
+
+
+def is_blob(value):
+    return isinstance(value, (bytes, bytearray, memoryview)) and bytes(value[:4]) == MAGIC
+
+
+def decode_array(value):
+    """
+    :param value: packed array (bytes, bson Binary,...) or list of numbers
+                  as stored by the previous versions
+    :return: read-only numpy array viewing the blob (no copy), or a new
+             float array for lists. None is returned unchanged.
+    """
+    if value is None:
+        return None
+    if not is_blob(value):
+        return np.asarray(value, dtype=float)
+    magic, typecode, ndim, count = HEADER.unpack_from(value)
+    if ndim != 1:
+        raise ValueError("Unsupported packed array with %d dimensions" % ndim)
+    return np.frombuffer(value, dtype=DTYPES[typecode], count=count, offset=HEADER.size)
+
+
+def decode_arrays(doc):
+    """
+    Decode all the arrays of a T2BlazarProducts result, whatever the format
+    it was stored in: packed arrays and lists of numbers become numpy arrays,
+    nested dicts are decoded recursively and other values are kept as is.
+    :return: new dict
+    """
+    decoded = {}
+    for key, value in doc.items():
+        if isinstance(value, dict):
+            decoded[key] = decode_arrays(value)
+        elif is_blob(value):
+            decoded[key] = decode_array(value)
+        elif isinstance(value, list) and all(isinstance(v, (int, float)) for v in value):
+            decoded[key] = np.asarray(value, dtype=float)
+        else:
+            decoded[key] = value
+    return decoded
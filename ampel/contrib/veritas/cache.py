@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/cache.py
+# License           : BSD-3-Clause
+
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used cache with optional time-to-live and
+    hit-rate statistics.
+    """
+
+    def __init__(self, capacity=1024, ttl=None):
+        """
+        :param capacity: maximum number of entries
+        :param ttl: lifetime of an entry in seconds (None: no expiry)
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires = entry
+        if expires is not None and expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        if len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def stats(self):
+        return {'size': len(self._data), 'capacity': self.capacity,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hit_rate}
+
+
+class CatalogMatchCache(LRUCache):
+    """
+    Remembers the per-catalog match outcomes of recently seen sources.
+
+    Entries are keyed either on the transient id or on the position
+    quantised on a grid of `quantum_arcsec`. Values are the dicts of
+    outcomes by (catalog, radius) filled by VeritasBlazarFilter.match_catalogs.
+    With position keys, a cached outcome may belong to a source up to
+    quantum_arcsec*sqrt(2) away (the diagonal of a grid cell); keep the
+    quantum well below the smallest search radius.
+    """
+
+    def __init__(self, capacity=1024, ttl=None, key='position', quantum_arcsec=1.):
+        super().__init__(capacity, ttl)
+        if key not in ('position', 'tran_id'):
+            raise ValueError("key must be either 'position' or 'tran_id'")
+        self.key = key
+        self.quantum_deg = quantum_arcsec / 3600.
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: None or dict of constructor arguments
+        :return: CatalogMatchCache instance or None if not configured
+        """
+        if not config:
+            return None
+        return cls(**config)
+
+    def make_key(self, alert, latest):
+        if self.key == 'tran_id':
+            return alert.tran_id
+        return (round(latest['ra'] / self.quantum_deg), round(latest['dec'] / self.quantum_deg))
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/catalogs.py
+# License           : BSD-3-Clause
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+
+def mongo_catalog_version(dbclient, catalog, coll_name='srcs'):
+    """
+    Version stamp of an extcats catalog. Uses the 'version' field of the
+    {'_id': 'version'} document of the meta collection if present, else a
+    fingerprint of the metadata and of the number of sources.
+    """
+    db = dbclient[catalog]
+    doc = db['meta'].find_one({'_id': 'version'})
+    if doc is not None and 'version' in doc:
+        return str(doc['version'])
+    meta = json.dumps(list(db['meta'].find()), sort_keys=True, default=str)
+    fingerprint = hashlib.md5(meta.encode())
+    fingerprint.update(str(db[coll_name].estimated_document_count()).encode())
+    return fingerprint.hexdigest()[:12]
+
+
+def file_version(path):
+    """
+    Version stamp given by the modification time of a file (e.g. touched
+    by the catalog ingestion job).
+    """
+    try:
+        return str(os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+class CatalogSnapshot(object):
+    """
+    Immutable set of catalog query objects and of their versions.
+    """
+    __slots__ = ('queries', 'versions', 'generation')
+
+    def __init__(self, queries, versions, generation):
+        self.queries = queries
+        self.versions = versions
+        self.generation = generation
+
+
+class CatalogManager(object):
+    """
+    Keeps the catalog query objects up to date with the catalog releases.
+
+    A background thread polls the version stamp of each catalog every
+    `poll_interval` seconds. When it changes, the new query object is built
+    in that thread and a new snapshot is swapped in with a single reference
+    assignment, so that callers are never blocked. Callers should take
+    one snapshot per alert/transient to work on a consistent set of
+    catalogs; the snapshot generation increases at every swap.
+    """
+
+    def __init__(self, build, version, catalogs=(), poll_interval=None, logger=None):
+        """
+        :param build: function returning the query object of a catalog name
+        :param version: function returning the version stamp of a catalog name
+        :param catalogs: catalogs to load right away
+        :param poll_interval: seconds between version checks (None: no reload)
+        """
+        self.build = build
+        self.version = version
+        self.poll_interval = poll_interval
+        self.logger = logger if logger is not None else logging.getLogger()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.snapshot = CatalogSnapshot({}, {}, 0)
+        for catalog in catalogs:
+            self.get(catalog)
+        if poll_interval is not None:
+            self.start()
+
+    @classmethod
+    def for_extcats(cls, dbclient, catalogs=(), catq_kwargs=None, version_file=None,
+                    poll_interval=None, logger=None):
+        """
+        :param dbclient: pymongo client of the extcats databases
+        :param catq_kwargs: function returning the CatalogQuery keyword
+                            arguments of a catalog name, or a dict used
+                            for all catalogs
+        :param version_file: if given, use the mtime of this file as version
+                             stamp instead of the meta collection
+        """
+        from extcats import CatalogQuery
+
+        def build(catalog):
+            kwargs = catq_kwargs(catalog) if callable(catq_kwargs) else dict(catq_kwargs or {})
+            kwargs.setdefault('dbclient', dbclient)
+            return CatalogQuery.CatalogQuery(catalog, **kwargs)
+
+        if version_file is not None:
+            version = lambda catalog: file_version(version_file)
+        else:
+            version = lambda catalog: mongo_catalog_version(dbclient, catalog)
+        return cls(build, version, catalogs, poll_interval, logger)
+
+    def get(self, catalog):
+        """
+        :return: query object of the catalog, loaded now if not yet known
+        """
+        query = self.snapshot.queries.get(catalog)
+        if query is None:
+            with self._lock:
+                if catalog not in self.snapshot.queries:
+                    self._swap({catalog: (self.build(catalog), self.version(catalog))})
+            query = self.snapshot.queries[catalog]
+        return query
+
+    def _swap(self, updates):
+        """
+        publish a new snapshot with the (query, version) updates by catalog
+        """
+        old = self.snapshot
+        queries, versions = dict(old.queries), dict(old.versions)
+        for catalog, (query, version) in updates.items():
+            queries[catalog], versions[catalog] = query, version
+        self.snapshot = CatalogSnapshot(queries, versions, old.generation + 1)
+
+    def refresh(self):
+        """
+        rebuild the query objects of the catalogs whose version changed
+        :return: list of reloaded catalogs
+        """
+        updates = {}
+        for catalog, current in list(self.snapshot.versions.items()):
+            try:
+                version = self.version(catalog)
+                if version == current:
+                    continue
+                self.logger.info("Catalog %s changed (version %s -> %s), reloading",
+                    catalog, current, version)
+                updates[catalog] = (self.build(catalog), version)
+            except Exception:
+                # keep serving the previous version
+                self.logger.exception("Failed to reload catalog %s", catalog)
+        if updates:
+            with self._lock:
+                self._swap(updates)
+        return list(updates)
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            self.refresh()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll, name='CatalogManager', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/catshtm.py
+# License           : BSD-3-Clause
+
+import json
+import logging
+import itertools
+import threading
+import time
+
+import numpy as np
+import zmq
+
+# Wire protocol (zeromq multipart messages, DEALER clients / ROUTER server):
+#   request: [request id, json {"catalog": str, "radius": arcsec,
+#             "cones": [[ra, dec], ...] (radians)}]
+#   reply:   [request id, json {"colnames": [...], "colunits": [...],
+#             "shapes": [[nrows, ncols], ...], "error": null or str},
+#             one frame of little-endian float64 values per cone]
+# The request id is echoed back, so that replies can be matched to the
+# requests whatever their order.
+
+
+class CatsHTMError(RuntimeError):
+    pass
+
+
+class CatsHTMClient(object):
+    """
+    catsHTM cone search client keeping a pool of persistent sockets and
+    many requests in flight.
+
+    Requests are submitted with submit() (one or several cones of the same
+    catalog in a single message) and collected with result(); cone_search
+    keeps the synchronous interface of the catshtm_server client. An
+    instance must only be used from one thread.
+    """
+
+    def __init__(self, uri, pool_size=4, timeout=10., context=None, logger=None):
+        """
+        :param uri: zeromq endpoint of the server, e.g. tcp://localhost:27025
+        :param pool_size: number of sockets the requests are spread over
+        :param timeout: seconds to wait for a reply before giving up
+        """
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.context = context if context is not None else zmq.Context.instance()
+        self.timeout = timeout
+        self.sockets = []
+        self.poller = zmq.Poller()
+        for i in range(pool_size):
+            sock = self.context.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(uri)
+            self.sockets.append(sock)
+            self.poller.register(sock, zmq.POLLIN)
+        self._next_socket = itertools.cycle(self.sockets)
+        self._ids = itertools.count()
+        self.pending = set()
+        self.replies = {}
+
+    def submit(self, catalog, ra, dec, radius):
+        """
+        Send a cone search request without waiting for the reply.
+        :param ra, dec: position in radians, or equally long sequences of
+                        positions to search around in the same message
+        :param radius: search radius in arcsec
+        :return: request id to pass to result()
+        """
+        cones = np.column_stack([np.atleast_1d(ra), np.atleast_1d(dec)]).tolist()
+        req_id = next(self._ids)
+        header = {'catalog': catalog, 'radius': radius, 'cones': cones}
+        next(self._next_socket).send_multipart(
+            [req_id.to_bytes(8, 'little'), json.dumps(header).encode()])
+        self.pending.add(req_id)
+        return req_id
+
+    def _receive(self, timeout):
+        """
+        wait up to timeout seconds and store all the replies available
+        """
+        for sock, _ in self.poller.poll(timeout * 1000):
+            while True:
+                try:
+                    frames = sock.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                req_id = int.from_bytes(frames[0].bytes, 'little')
+                if req_id not in self.pending:
+                    # reply to a request that timed out
+                    continue
+                self.pending.discard(req_id)
+                self.replies[req_id] = frames[1:]
+
+    def result(self, req_id):
+        """
+        :return: list with one (srcs, colnames, colunits) tuple per cone of
+                 the request. srcs is a (nrows, ncols) float64 array viewing
+                 the received message.
+        """
+        deadline = time.monotonic() + self.timeout
+        while req_id not in self.replies:
+            if req_id not in self.pending:
+                raise KeyError("unknown catsHTM request id %d" % req_id)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.pending.discard(req_id)
+                raise TimeoutError("no catsHTM reply after %.1f s" % self.timeout)
+            self._receive(remaining)
+        frames = self.replies.pop(req_id)
+        header = json.loads(frames[0].bytes)
+        if header.get('error'):
+            raise CatsHTMError(header['error'])
+        return [(np.frombuffer(frame.buffer, dtype='<f8').reshape(shape),
+                 header['colnames'], header['colunits'])
+                for shape, frame in zip(header['shapes'], frames[1:])]
+
+    def cancel(self, req_id):
+        """
+        forget a request whose result is not wanted any more: its reply,
+        received or late, is dropped
+        """
+        self.pending.discard(req_id)
+        self.replies.pop(req_id, None)
+
+    def cone_search(self, catalog, ra, dec, radius):
+        """
+        :return: (srcs, colnames, colunits) of the sources within radius
+                 arcsec from (ra, dec) in radians
+        """
+        return self.result(self.submit(catalog, ra, dec, radius))[0]
+
+    def cone_search_many(self, requests):
+        """
+        Pipeline several cone searches: all the requests are sent before
+        waiting for the first reply.
+        :param requests: iterable of (catalog, ra, dec, radius)
+        :return: list of (srcs, colnames, colunits), in the request order
+        """
+        req_ids = [self.submit(*request) for request in requests]
+        return [self.result(req_id)[0] for req_id in req_ids]
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+
+
+class CatsHTMServer(object):
+    """
+    Serve catsHTM cone searches to CatsHTMClient instances.
+
+    By default the searches are done with catsHTM.cone_search on the
+    catalogs in catalogs_dir. Any function with the same signature,
+    (catalog, ra, dec, radius) -> (srcs, colnames, colunits), can be given
+    instead, e.g. a stand-in for tests. Requests are dispatched to
+    n_workers threads, so that pipelined requests are served concurrently.
+    """
+
+    def __init__(self, uri, cone_search=None, catalogs_dir=None, n_workers=4, context=None,
+                 logger=None):
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.context = context if context is not None else zmq.Context.instance()
+        if cone_search is None:
+            import catsHTM
+            cone_search = lambda catalog, ra, dec, radius: catsHTM.cone_search(
+                catalog, ra, dec, radius, catalogs_dir=catalogs_dir)
+        self.cone_search = cone_search
+        self.n_workers = n_workers
+        self.frontend = self.context.socket(zmq.ROUTER)
+        self.frontend.setsockopt(zmq.LINGER, 0)
+        self.frontend.bind(uri)
+        self.backend_uri = 'inproc://catshtm-workers-%x' % id(self)
+        self.backend = self.context.socket(zmq.DEALER)
+        self.backend.setsockopt(zmq.LINGER, 0)
+        self.backend.bind(self.backend_uri)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def handle(self, header):
+        """
+        :return: list of reply frames (header and one frame per cone)
+        """
+        reply = {'colnames': [], 'colunits': [], 'shapes': [], 'error': None}
+        frames = []
+        try:
+            for ra, dec in header['cones']:
+                srcs, colnames, colunits = self.cone_search(header['catalog'], ra, dec, header['radius'])
+                srcs = np.asarray(srcs, dtype='<f8').reshape(len(srcs), len(colnames))
+                reply['colnames'], reply['colunits'] = list(colnames), list(colunits)
+                reply['shapes'].append(srcs.shape)
+                frames.append(srcs.tobytes())
+        except Exception as e:
+            self.logger.exception("catsHTM cone search failed")
+            reply['error'], frames = repr(e), []
+        return [json.dumps(reply).encode()] + frames
+
+    def work(self):
+        """
+        worker loop: answer the requests dispatched by serve()
+        """
+        sock = self.context.socket(zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.backend_uri)
+        try:
+            while not self._stop.is_set():
+                if not sock.poll(100):
+                    continue
+                identity, req_id, header = sock.recv_multipart()
+                sock.send_multipart([identity, req_id] + self.handle(json.loads(header)))
+        finally:
+            sock.close()
+
+    def serve(self):
+        """
+        forward the client requests to the workers and their replies back
+        """
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        while not self._stop.is_set():
+            for sock, _ in poller.poll(100):
+                if sock is self.frontend:
+                    self.backend.send_multipart(self.frontend.recv_multipart(copy=False), copy=False)
+                else:
+                    self.frontend.send_multipart(self.backend.recv_multipart(copy=False), copy=False)
+
+    def start(self):
+        """
+        serve in background threads
+        """
+        if not self._threads:
+            self._threads = [threading.Thread(target=self.work, name='CatsHTMWorker', daemon=True)
+                             for i in range(self.n_workers)]
+            self._threads.append(threading.Thread(target=self.serve, name='CatsHTMServer', daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def close(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.frontend.close()
+        self.backend.close()
@@ -1,15 +1,22 @@
 
 from os.path import dirname, join
+from functools import lru_cache
+from copy import deepcopy
 import json
 
-def load_channels():
-	with open(join(dirname(__file__), "channels.json")) as f:
+@lru_cache(maxsize=None)
+def _load_json(fname):
+	"""
+		parse one of the configuration files shipped with this package, once.
+	"""
+	with open(join(dirname(__file__), fname)) as f:
 		return json.load(f)
 
+def load_channels():
+	return deepcopy(_load_json("channels.json"))
+
 def load_t2_run_configs():
-	with open(join(dirname(__file__), "t2_run_configs.json")) as f:
-		return json.load(f)
+	return deepcopy(_load_json("t2_run_configs.json"))
 
 def load_t3_jobs():
-	with open(join(dirname(__file__), "t3_jobs.json")) as f:
-		return json.load(f)
+	return deepcopy(_load_json("t3_jobs.json"))
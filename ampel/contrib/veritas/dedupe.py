@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/dedupe.py
+# License           : BSD-3-Clause
+
+import math
+import time
+import hashlib
+
+from ampel.contrib.veritas.cache import LRUCache
+
+
+class BloomFilter(object):
+    """
+    Fixed-size Bloom filter for integer keys (e.g. candids).
+    """
+
+    def __init__(self, capacity, fp_rate):
+        """
+        :param capacity: number of keys for which fp_rate is guaranteed
+        :param fp_rate: target false-positive rate at capacity
+        """
+        self.capacity = int(capacity)
+        self.n_bits = max(8, int(math.ceil(-self.capacity * math.log(fp_rate) / math.log(2) ** 2)))
+        self.n_hashes = max(1, int(round(self.n_bits / self.capacity * math.log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: h1 + i*h2 (Kirsch & Mitzenmacher)
+        digest = hashlib.blake2b(int(key).to_bytes(8, 'little', signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def fill_ratio(self):
+        return sum(bin(b).count('1') for b in self.bits) / self.n_bits
+
+    def estimated_fp_rate(self):
+        # (1 - exp(-k n / m))^k, without scanning the bit array
+        return (1. - math.exp(-self.n_hashes * self.count / self.n_bits)) ** self.n_hashes
+
+    def nbytes(self):
+        return len(self.bits)
+
+
+class RotatingBloomFilter(object):
+    """
+    Bloom filter remembering the keys of a sliding time window.
+
+    The window is split in `generations` Bloom filters; keys are added to
+    the newest one and looked up in all of them. The oldest generation is
+    dropped once the newest one is older than window/generations or full,
+    so memory stays bounded by generations x capacity keys.
+    """
+
+    def __init__(self, window, capacity, fp_rate=1e-4, generations=4, clock=time.time):
+        """
+        :param window: time span to remember the keys for, in seconds
+        :param capacity: expected number of keys per window
+        :param fp_rate: target false-positive rate of the whole filter
+        :param generations: number of Bloom filters the window is split into
+        """
+        self.window = window
+        self.generations = generations
+        self.clock = clock
+        # a lookup is a false positive if any generation is one
+        self.gen_capacity = max(1, int(math.ceil(capacity / generations)))
+        self.gen_fp_rate = 1. - (1. - fp_rate) ** (1. / generations)
+        self.filters = []
+        self.started = None
+        self.rotations = 0
+        self._rotate()
+
+    def _rotate(self):
+        self.filters.append(BloomFilter(self.gen_capacity, self.gen_fp_rate))
+        if len(self.filters) > self.generations:
+            self.filters.pop(0)
+        self.started = self.clock()
+        self.rotations += 1
+
+    def _maybe_rotate(self):
+        if self.filters[-1].count >= self.gen_capacity or \
+                self.clock() - self.started >= self.window / self.generations:
+            self._rotate()
+
+    def add(self, key):
+        self._maybe_rotate()
+        self.filters[-1].add(key)
+
+    def __contains__(self, key):
+        for bloom in reversed(self.filters):
+            if key in bloom:
+                return True
+        return False
+
+    def estimated_fp_rate(self):
+        p_none = 1.
+        for bloom in self.filters:
+            p_none *= 1. - bloom.estimated_fp_rate()
+        return 1. - p_none
+
+    def nbytes(self):
+        return sum(bloom.nbytes() for bloom in self.filters)
+
+
+# returned by CandidDeduplicator.lookup for candids not seen before
+UNSEEN = object()
+
+
+class CandidDeduplicator(object):
+    """
+    Remembers the filter verdicts of already processed candids.
+
+    Accepted candids (a small minority) are kept exactly in a TTL cache
+    together with their verdict; rejected ones are only remembered by a
+    rotating Bloom filter, so that a never-seen alert is wrongly taken for
+    a rejected duplicate with a probability of at most about fp_rate.
+    """
+
+    def __init__(self, window_days=3., capacity=1000000, fp_rate=1e-4, generations=4,
+                 max_accepted=100000, drop_accepted=False):
+        """
+        :param window_days: how long the verdicts are remembered
+        :param capacity: expected number of rejected candids per window
+        :param fp_rate: target false-positive rate of the rejected set
+        :param generations: number of Bloom filters the window is split into
+        :param max_accepted: maximum number of remembered accepted candids
+        :param drop_accepted: if True, repeats of accepted candids are
+                              rejected too, so that they do not reach the
+                              T2s again
+        """
+        window = window_days * 86400.
+        self.rejected = RotatingBloomFilter(window, capacity, fp_rate, generations)
+        self.accepted = LRUCache(max_accepted, ttl=window)
+        self.drop_accepted = drop_accepted
+        self.lookups = 0
+        self.hits_accepted = 0
+        self.hits_rejected = 0
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        :param config: None or dict of constructor arguments
+        :return: CandidDeduplicator instance or None if not configured
+        """
+        if not config:
+            return None
+        return cls(**config)
+
+    def lookup(self, candid):
+        """
+        :return: cached verdict, or UNSEEN if the candid was not processed yet
+        """
+        self.lookups += 1
+        verdict = self.accepted.get(candid, UNSEEN)
+        if verdict is not UNSEEN:
+            self.hits_accepted += 1
+            return None if self.drop_accepted else verdict
+        if candid in self.rejected:
+            self.hits_rejected += 1
+            return None
+        return UNSEEN
+
+    def record(self, candid, verdict):
+        if verdict is None:
+            self.rejected.add(candid)
+        else:
+            self.accepted.put(candid, verdict)
+
+    def stats(self):
+        return {
+            'lookups': self.lookups,
+            'hits_accepted': self.hits_accepted,
+            'hits_rejected': self.hits_rejected,
+            'accepted_size': len(self.accepted),
+            'bloom_bytes': self.rejected.nbytes(),
+            'bloom_generations': len(self.rejected.filters),
+            'estimated_fp_rate': self.rejected.estimated_fp_rate(),
+        }
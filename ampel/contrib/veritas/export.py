@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/export.py
+# License           : BSD-3-Clause
+
+import os
+import json
+import time
+import numbers
+
+import numpy as np
+
+from ampel.contrib.veritas.blobs import is_blob, decode_array
+
+MANIFEST = 'manifest.json'
+
+
+def _is_numeric_sequence(value):
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind in 'biuf'
+    return isinstance(value, (list, tuple)) and \
+        all(isinstance(v, numbers.Number) or v is None for v in value)
+
+
+def flatten(doc, prefix='', out=None):
+    """
+    Flatten a nested result document into a dict of dotted column names.
+    Numeric sequences (lists, arrays, packed blobs) are kept as float
+    arrays, nested dicts are flattened and other values are kept as is
+    (non numeric lists as json strings).
+    """
+    out = {} if out is None else out
+    for key, value in doc.items():
+        name = prefix + str(key)
+        if isinstance(value, dict):
+            flatten(value, name + '.', out)
+        elif is_blob(value):
+            out[name] = decode_array(value)
+        elif _is_numeric_sequence(value):
+            out[name] = np.asarray(value, dtype=float)
+        elif isinstance(value, (list, tuple)):
+            out[name] = json.dumps(value, default=str)
+        else:
+            out[name] = value
+    return out
+
+
+def _scalar_column(values):
+    """
+    :return: float array (None -> nan) for numbers and booleans, else
+             unicode array (None -> '')
+    """
+    if all(v is None or (isinstance(v, numbers.Number) and not isinstance(v, complex)) for v in values):
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+    return np.array(['' if v is None else str(v) for v in values])
+
+
+class ColumnarWriter(object):
+    """
+    Write rows of flattened results as a columnar dataset, one part file
+    of at most chunk_rows rows at a time, so that the memory use is
+    bounded whatever the number of rows.
+
+    Each row is a dict of scalars (numbers, strings) and of 1-d float
+    arrays. In the 'npz' format, scalar columns are stored as float or
+    unicode arrays, and ragged array columns as the concatenated values
+    '<name>.values' plus '<name>.offsets' (row i is
+    values[offsets[i]:offsets[i+1]]). The 'parquet' format (requires
+    pyarrow) stores ragged columns as list<double>.
+
+    The dataset directory holds a manifest with the part files and the
+    time of the last export, so that later exports append new parts.
+    """
+
+    def __init__(self, directory, fmt='npz', chunk_rows=10000):
+        if fmt not in ('npz', 'parquet'):
+            raise ValueError("format must be 'npz' or 'parquet'")
+        self.directory = directory
+        self.fmt = fmt
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        self.manifest = self.read_manifest(directory)
+        self.started = time.time()
+        self.n_rows = 0
+        self._reset()
+
+    @staticmethod
+    def read_manifest(directory):
+        path = os.path.join(directory, MANIFEST)
+        if not os.path.exists(path):
+            return {'parts': [], 'last_export': None, 'n_rows': 0, 'ragged': []}
+        with open(path) as infile:
+            manifest = json.load(infile)
+        manifest.setdefault('ragged', [])
+        return manifest
+
+    @property
+    def last_export(self):
+        """
+        :return: unix time of the start of the previous export (None if none)
+        """
+        return self.manifest['last_export']
+
+    def _reset(self):
+        self.scalars = {}
+        self.arrays = {}
+        self.n_buffered = 0
+
+    def append(self, row):
+        for name, value in row.items():
+            if isinstance(value, np.ndarray) or (value is None and name in self.arrays):
+                columns = self.arrays
+            else:
+                columns = self.scalars
+            if name not in columns:
+                # pad the column for the rows buffered before it appeared
+                columns[name] = [None] * self.n_buffered
+            columns[name].append(value)
+        self.n_buffered += 1
+        for columns in (self.scalars, self.arrays):
+            for values in columns.values():
+                if len(values) < self.n_buffered:
+                    values.append(None)
+        if self.n_buffered >= self.chunk_rows:
+            self.flush()
+
+    def _normalize(self):
+        """
+        Store as ragged the columns holding arrays in some rows and None
+        (e.g. poly_coef without fit) in others: None becomes an empty row.
+        """
+        ragged = set(self.arrays) | set(self.manifest['ragged'])
+        for name in [name for name in self.scalars if name in ragged]:
+            scalars = self.scalars.pop(name)
+            arrays = self.arrays.get(name, [None] * self.n_buffered)
+            self.arrays[name] = [array if array is not None else
+                                 None if scalar is None else np.atleast_1d(np.asarray(scalar, dtype=float))
+                                 for array, scalar in zip(arrays, scalars)]
+        self.manifest['ragged'] = sorted(ragged)
+
+    def _npz_columns(self):
+        columns = {name: _scalar_column(values) for name, values in self.scalars.items()}
+        for name, values in self.arrays.items():
+            values = [np.empty(0) if v is None else v for v in values]
+            columns[name + '.values'] = np.concatenate(values) if values else np.empty(0)
+            columns[name + '.offsets'] = np.concatenate([[0], np.cumsum([len(v) for v in values])])
+        return columns
+
+    def _arrow_table(self):
+        import pyarrow as pa
+        columns = {name: pa.array(_scalar_column(values)) for name, values in self.scalars.items()}
+        for name, values in self.arrays.items():
+            columns[name] = pa.array([None if v is None else v.tolist() for v in values],
+                                     type=pa.list_(pa.float64()))
+        return pa.table(columns)
+
+    def flush(self):
+        """
+        write the buffered rows as a new part file
+        """
+        if self.n_buffered == 0:
+            return
+        self._normalize()
+        part = 'part-%05d.%s' % (len(self.manifest['parts']), self.fmt)
+        path = os.path.join(self.directory, part)
+        if self.fmt == 'npz':
+            np.savez(path, **self._npz_columns())
+        else:
+            import pyarrow.parquet as pq
+            pq.write_table(self._arrow_table(), path)
+        self.manifest['parts'].append({'file': part, 'rows': self.n_buffered})
+        self.manifest['n_rows'] += self.n_buffered
+        self.n_rows += self.n_buffered
+        self._reset()
+        # the manifest is only rewritten once the part is complete
+        self._write_manifest()
+
+    def _write_manifest(self):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + '.tmp', 'w') as outfile:
+            json.dump(self.manifest, outfile, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def close(self):
+        """
+        write the remaining rows and record the export time
+        """
+        self.flush()
+        self.manifest['last_export'] = self.started
+        self._write_manifest()
+
+
+def load_npz_export(directory, columns=None):
+    """
+    Load the columns of an npz export. Columns missing from some part
+    files are filled with nan (numeric columns), '' (string columns) or
+    empty rows (ragged columns).
+    :param columns: names of the columns to load (None: all)
+    :return: dict of column name -> array. Ragged columns are returned as
+             their concatenated '.values' and '.offsets' arrays.
+    """
+    manifest = ColumnarWriter.read_manifest(directory)
+    parts = [(np.load(os.path.join(directory, part['file'])), part['rows']) for part in manifest['parts']]
+    names = []
+    for data, rows in parts:
+        names += [name for name in data.files if name not in names]
+    # a ragged column may be stored as scalars (all None) in older parts
+    ragged = {name[:-len('.offsets')] for name in names if name.endswith('.offsets')}
+    names = [name for name in names if name not in ragged]
+    if columns is not None:
+        wanted = set(columns)
+        names = [name for name in names if name in wanted or name.rsplit('.', 1)[0] in wanted]
+    out = {}
+    for name in names:
+        if name.endswith('.offsets'):
+            chunks, shift = [np.zeros(1, dtype=int)], 0
+            for data, rows in parts:
+                offsets = data[name] if name in data.files else np.zeros(rows + 1, dtype=int)
+                chunks.append(offsets[1:] + shift)
+                shift += offsets[-1]
+            out[name] = np.concatenate(chunks)
+        elif name.endswith('.values'):
+            out[name] = np.concatenate([data[name] for data, rows in parts if name in data.files])
+        else:
+            present = [data[name] for data, rows in parts if name in data.files]
+            if any(values.dtype.kind == 'U' for values in present):
+                out[name] = np.concatenate([data[name].astype(str) if name in data.files else np.full(rows, '')
+                                            for data, rows in parts])
+            else:
+                out[name] = np.concatenate([data[name] if name in data.files else np.full(rows, np.nan)
+                                            for data, rows in parts])
+    return out
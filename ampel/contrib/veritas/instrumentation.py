@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/instrumentation.py
+# License           : BSD-3-Clause
+
+import time
+import logging
+from bisect import bisect_left
+
+
+# upper bounds of the wall-time histogram buckets [s]
+DEFAULT_BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 0.1, 0.3, 1., 3., 10.)
+
+
+class _Histogram(object):
+    """
+    Fixed-bucket wall-time histogram, Prometheus style.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class _Timer(object):
+    """
+    Context manager adding the elapsed wall time to one stage.
+    """
+    __slots__ = ('instr', 'stage', 't0')
+
+    def __init__(self, instr, stage):
+        self.instr = instr
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.instr.observe(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class _Stopwatch(object):
+    """
+    Records consecutive laps, each lap being attributed to one stage.
+    Cheaper than nesting timers around a chain of short steps.
+    """
+    __slots__ = ('instr', 't0')
+
+    def __init__(self, instr):
+        self.instr = instr
+        self.t0 = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.instr.observe(stage, now - self.t0)
+        self.t0 = now
+
+
+class _NullContext(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def lap(self, stage):
+        pass
+
+
+_NULL_CONTEXT = _NullContext()
+
+
+class Instrumentation(object):
+    """
+    Per-stage wall-time histograms and counters for the VERITAS units.
+
+    Stages are free-form strings (e.g. 'cut.rb', 'catalog.4FGL', 'polyfit',
+    'http.PUT'). Results can be exported in the Prometheus text exposition
+    format, optionally written to a file (textfile collector), or summarized
+    in a log line emitted at most once every `log_interval` seconds.
+
+    Use `Instrumentation.from_config` to build an instance: a disabled
+    configuration returns the shared `NullInstrumentation`, whose methods
+    do nothing.
+    """
+
+    enabled = True
+
+    def __init__(self, unit, logger=None, buckets=DEFAULT_BUCKETS,
+                 log_interval=None, prometheus_file=None, prefix='ampel_veritas'):
+        """
+        :param unit: name of the unit, used as label in the exported metrics
+        :param logger: logger used for the periodic summary line
+        :param buckets: upper bounds of the histogram buckets in seconds
+        :param log_interval: seconds between two summary lines (None: never)
+        :param prometheus_file: path where the exposition text is written
+                                together with the summary line
+        :param prefix: prefix of the exported metric names
+        """
+        self.unit = unit
+        self.logger = logger if logger is not None else logging.getLogger()
+        self.buckets = tuple(sorted(buckets))
+        self.log_interval = log_interval
+        self.prometheus_file = prometheus_file
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.last_log = time.monotonic()
+
+    @classmethod
+    def from_config(cls, unit, config, logger=None):
+        """
+        :param config: None or dict with the keys 'enabled' (default True),
+                       'buckets', 'log_interval', 'prometheus_file', 'prefix',
+                       'channel' (appended to the unit name)
+        :return: Instrumentation or NullInstrumentation instance
+        """
+        if not config or not config.get('enabled', True):
+            return NULL_INSTRUMENTATION
+        kwargs = {k: config[k] for k in
+                  ('buckets', 'log_interval', 'prometheus_file', 'prefix') if k in config}
+        if config.get('channel'):
+            # one instance per channel, e.g. filters
+            unit = '{0}.{1}'.format(unit, config['channel'])
+        return cls(unit, logger=logger, **kwargs)
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def stopwatch(self):
+        return _Stopwatch(self)
+
+    def observe(self, stage, seconds):
+        hist = self.histograms.get(stage)
+        if hist is None:
+            hist = self.histograms[stage] = _Histogram(self.buckets)
+        hist.observe(seconds)
+
+    def incr(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def exposition(self):
+        """
+        :return: metrics in the Prometheus text exposition format
+        """
+        lines = []
+        name = '{0}_stage_seconds'.format(self.prefix)
+        if self.histograms:
+            lines.append('# TYPE {0} histogram'.format(name))
+        for stage in sorted(self.histograms):
+            hist = self.histograms[stage]
+            labels = 'unit="{0}",stage="{1}"'.format(self.unit, stage)
+            cumulative = 0
+            for bound, count in zip(self.buckets, hist.counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1},le="{2:g}"}} {3}'.format(name, labels, bound, cumulative))
+            lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(name, labels, hist.count))
+            lines.append('{0}_sum{{{1}}} {2:.9g}'.format(name, labels, hist.sum))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, labels, hist.count))
+        name = '{0}_events_total'.format(self.prefix)
+        if self.counters:
+            lines.append('# TYPE {0} counter'.format(name))
+        for counter in sorted(self.counters):
+            lines.append('{0}{{unit="{1}",name="{2}"}} {3}'.format(
+                name, self.unit, counter, self.counters[counter]))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        :return: one-line summary with calls, mean and total time per stage
+        """
+        stages = ' '.join('{0}={1}x{2:.3g}ms({3:.3g}s)'.format(
+            stage, h.count, 1e3 * h.sum / h.count, h.sum)
+            for stage, h in sorted(self.histograms.items()) if h.count)
+        counters = ' '.join('{0}={1}'.format(k, v) for k, v in sorted(self.counters.items()))
+        return '{0} timing: {1} | counters: {2}'.format(self.unit, stages, counters)
+
+    def flush(self):
+        """
+        Log the summary line and write the exposition file (if configured).
+        """
+        self.last_log = time.monotonic()
+        self.logger.info(self.summary())
+        if self.prometheus_file is not None:
+            with open(self.prometheus_file, 'w') as f:
+                f.write(self.exposition())
+
+    def maybe_flush(self):
+        """
+        Flush if more than `log_interval` seconds elapsed since the last flush.
+        """
+        if self.log_interval is not None and \
+                time.monotonic() - self.last_log >= self.log_interval:
+            self.flush()
+
+
+class NullInstrumentation(Instrumentation):
+    """
+    Disabled instrumentation: every method is a no-op.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        self.unit = None
+        self.histograms = {}
+        self.counters = {}
+
+    def timer(self, stage):
+        return _NULL_CONTEXT
+
+    def stopwatch(self):
+        return _NULL_CONTEXT
+
+    def observe(self, stage, seconds):
+        pass
+
+    def incr(self, counter, n=1):
+        pass
+
+    def reset(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def maybe_flush(self):
+        pass
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
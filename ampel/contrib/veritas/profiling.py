@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/profiling.py
+# License           : BSD-3-Clause
+
+import os
+import json
+import time
+import heapq
+import pickle
+import pstats
+import cProfile
+import logging
+import itertools
+
+
+class _ProfiledCall(object):
+    """
+    Context manager timing one call, and profiling it if sampled.
+    """
+    __slots__ = ('profiler', 'key', 'inputs', 'prof', 't0')
+
+    def __init__(self, profiler, key, inputs):
+        self.profiler = profiler
+        self.key = key
+        self.inputs = inputs
+        self.prof = None
+
+    def __enter__(self):
+        if self.profiler.sample():
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+                self.prof = prof
+            except ValueError:
+                # another profiler is already active
+                pass
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.t0
+        if self.prof is not None:
+            self.prof.disable()
+        self.profiler.record(self.key, duration, self.prof, self.inputs)
+        return False
+
+
+class _NullCall(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_CALL = _NullCall()
+
+
+class CallProfiler(object):
+    """
+    Opt-in sampling profiler for the calls of a unit (alerts filtered,
+    light curves processed).
+
+    Every call is timed, and one call out of `every` is run under cProfile.
+    Each call is identified by a key (candid, transient / compound id).
+    Every `dump_interval` seconds, the profiles of the period are merged
+    and written to `directory` as a pstats file ('<unit>-<pid>-<time>.pstats',
+    readable with pstats or snakeviz), with a json index of the sampled
+    calls (key, duration, functions with the highest own time).
+
+    The `slowest` calls since the start (profiled or not) are kept with
+    their pickled inputs in '<unit>-<pid>-slowest.pkl', so that they can be
+    replayed offline, see load_slowest.
+
+    Use `CallProfiler.from_config` to build an instance: a disabled
+    configuration returns the shared `NULL_PROFILER`, whose methods do nothing.
+    """
+
+    enabled = True
+
+    def __init__(self, unit, directory, every=100, slowest=10, dump_interval=600.,
+                 top_functions=5, logger=None):
+        """
+        :param unit: name of the unit, used in the dump file names
+        :param directory: directory of the dumps (created if needed)
+        :param every: profile one call out of every
+        :param slowest: number of slowest calls kept with their inputs
+        :param dump_interval: seconds between two dumps
+        :param top_functions: number of functions listed per sampled call
+        """
+        if every < 1:
+            raise ValueError("every must be positive")
+        self.unit = unit
+        self.directory = directory
+        self.every = every
+        self.n_slowest = slowest
+        self.dump_interval = dump_interval
+        self.top_functions = top_functions
+        self.logger = logger if logger is not None else logging.getLogger()
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = os.path.join(directory, '{0}-{1}'.format(unit, os.getpid()))
+        self.n_calls = 0
+        self.n_profiled = 0
+        self.slowest = []
+        self._seq = itertools.count()
+        self._reset()
+        self.last_dump = time.monotonic()
+
+    @classmethod
+    def from_config(cls, unit, config, logger=None):
+        """
+        :param config: None or dict with the keys 'enabled' (default True),
+                       'directory' (required), 'every', 'slowest',
+                       'dump_interval', 'top_functions', 'channel'
+                       (appended to the unit name)
+        :return: CallProfiler or NullProfiler instance
+        """
+        if not config or not config.get('enabled', True):
+            return NULL_PROFILER
+        kwargs = {k: config[k] for k in
+                  ('every', 'slowest', 'dump_interval', 'top_functions') if k in config}
+        if config.get('channel'):
+            # one instance per channel, e.g. filters
+            unit = '{0}.{1}'.format(unit, config['channel'])
+        return cls(unit, config['directory'], logger=logger, **kwargs)
+
+    def _reset(self):
+        self.stats = None
+        self.sampled = []
+
+    def profile(self, key, inputs=None):
+        """
+        :param key: identifier of the call (e.g. candid)
+        :param inputs: arguments of the call, pickled if the call is among
+                       the slowest ones
+        :return: context manager to wrap the call with
+        """
+        return _ProfiledCall(self, key, inputs)
+
+    def sample(self):
+        """
+        :return: True if the next call is to be profiled
+        """
+        self.n_calls += 1
+        return self.n_calls % self.every == 0
+
+    def record(self, key, duration, prof=None, inputs=None):
+        """
+        Add a finished call (with its profile, if sampled).
+        """
+        stats = None
+        if prof is not None:
+            self.n_profiled += 1
+            stats = pstats.Stats(prof)
+            self.sampled.append({
+                'key': str(key), 'duration': duration,
+                'top': [[pstats.func_std_string(func), tt] for func, tt in self.top(stats)],
+            })
+            if self.stats is None:
+                self.stats = pstats.Stats(prof)
+            else:
+                self.stats.add(prof)
+        if len(self.slowest) < self.n_slowest or duration > self.slowest[0][0]:
+            entry = {'key': key, 'duration': duration, 'time': time.time(),
+                     'inputs': self.pickle_inputs(key, inputs),
+                     'stats': None if stats is None else stats.stats}
+            if len(self.slowest) < self.n_slowest:
+                heapq.heappush(self.slowest, (duration, next(self._seq), entry))
+            else:
+                heapq.heapreplace(self.slowest, (duration, next(self._seq), entry))
+        if time.monotonic() - self.last_dump >= self.dump_interval:
+            self.dump()
+
+    def top(self, stats):
+        """
+        :return: list of (function, own time) with the highest own time
+        """
+        return heapq.nlargest(self.top_functions,
+                              ((func, row[2]) for func, row in stats.stats.items()),
+                              key=lambda item: item[1])
+
+    def pickle_inputs(self, key, inputs):
+        try:
+            return pickle.dumps(inputs, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            self.logger.warning("Cannot pickle the inputs of %s: %s", key, e)
+            return None
+
+    def dump(self):
+        """
+        Write the merged profile and index of the calls sampled since the
+        last dump, and the slowest calls so far.
+        """
+        self.last_dump = time.monotonic()
+        if self.stats is not None:
+            stamp = time.strftime('%Y%m%dT%H%M%S')
+            self.stats.dump_stats('{0}-{1}.pstats'.format(self.prefix, stamp))
+            with open('{0}-{1}.json'.format(self.prefix, stamp), 'w') as outfile:
+                json.dump({'unit': self.unit, 'calls': self.n_calls, 'sampled': self.sampled},
+                          outfile, indent=1)
+        if self.slowest:
+            path = '{0}-slowest.pkl'.format(self.prefix)
+            with open(path + '.tmp', 'wb') as outfile:
+                pickle.dump([entry for _, _, entry in sorted(self.slowest, reverse=True)], outfile,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+        self.logger.info("%s profiling: %d calls, %d profiled, slowest %s", self.unit,
+                         self.n_calls, self.n_profiled,
+                         ' '.join('{0}={1:.3g}s'.format(e['key'], d) for d, _, e in
+                                  sorted(self.slowest, reverse=True)[:3]))
+        self._reset()
+
+
+class NullProfiler(CallProfiler):
+    """
+    Disabled profiler: every method is a no-op.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        self.unit = None
+        self.n_calls = 0
+        self.slowest = []
+
+    def profile(self, key, inputs=None):
+        return _NULL_CALL
+
+    def record(self, key, duration, prof=None, inputs=None):
+        pass
+
+    def dump(self):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def load_slowest(path):
+    """
+    Load the slowest calls dumped by a CallProfiler, slowest first, e.g.
+    to replay them: `unit.apply(entry['inputs'])`.
+    :return: list of dicts with the keys 'key', 'duration', 'time',
+             'inputs' (unpickled, None if not picklable) and 'stats'
+             (pstats dict if the call was profiled, else None)
+    """
+    with open(path, 'rb') as infile:
+        entries = pickle.load(infile)
+    for entry in entries:
+        if entry['inputs'] is not None:
+            entry['inputs'] = pickle.loads(entry['inputs'])
+    return entries
@@ -7,17 +7,16 @@
 # Last Modified Date: 06.09.2018
 # Last Modified By  : m. nievas-rosillo <mireia.nievas-rosillo@desy.de>
 
-import sys
-import numpy as np
 import logging
-from pymongo import MongoClient
-from urllib.parse import urlparse
-from extcats import CatalogQuery
-from astropy.coordinates import SkyCoord
-from astropy.table import Table
+from collections import Counter
 from pydantic import BaseModel
 
 from ampel.base.abstract.AbsAlertFilter import AbsAlertFilter
+from ampel.contrib.veritas.instrumentation import Instrumentation
+from ampel.contrib.veritas.profiling import CallProfiler
+from ampel.contrib.veritas.cache import LRUCache, CatalogMatchCache
+from ampel.contrib.veritas.catalogs import CatalogManager
+from ampel.contrib.veritas.dedupe import CandidDeduplicator, UNSEEN
 
 
 class VeritasBlazarFilter(AbsAlertFilter):
@@ -28,6 +27,8 @@ class VeritasBlazarFilter(AbsAlertFilter):
     # Static version info
     version = 1.0
     resources = ('extcats.reader',)
+    # number of alerts kept in rejected_reason and matched_catalog
+    RECENT_ALERTS = 1000
 
     class RunConfig(BaseModel):
         """
@@ -48,9 +49,20 @@ class VeritasBlazarFilter(AbsAlertFilter):
             "3FHL": 10,
             "4FGL": 10,
         }
+        INSTRUMENTATION : dict  = {}      # see instrumentation.Instrumentation.from_config
+        LOG_SUMMARY_EVERY : int = 0       # log rejection counts every N alerts (0: never)
+        MATCH_CACHE     : dict  = {}      # e.g. {"capacity": 1000, "ttl": 86400, "key": "position"}
+        CATALOG_RELOAD  : dict  = {}      # e.g. {"poll_interval": 600, "version_file": null}
+        DEDUPE          : dict  = {}      # e.g. {"window_days": 3, "capacity": 1e6, "fp_rate": 1e-4}
+        PROFILING       : dict  = {}      # e.g. {"directory": "/tmp/prof", "every": 1000, "slowest": 10}
+        ASYNC_CATALOGS  : dict  = {}      # e.g. {"max_pool_size": 50, "max_in_flight": 64, "timeout": 30}
 
-    def __init__(self, on_match_t2_units, base_config=None, run_config=None, logger=None):
+    def __init__(self, on_match_t2_units, base_config=None, run_config=None, logger=None,
+                 catalog_queries=None):
         """
+        :param catalog_queries: optional dict of already initialized
+            extcats CatalogQuery objects (by catalog name), or CatalogManager,
+            to share the database connection among several filter instances.
         """
         if run_config is None or len(run_config.dict()) == 0:
             raise ValueError("Please check you run configuration")
@@ -60,12 +72,19 @@ class VeritasBlazarFilter(AbsAlertFilter):
 
         self.on_match_t2_units = on_match_t2_units
         self.logger = logger if logger is not None else logging.getLogger()
-        self.rejected_reason = {}
+        # outcomes of the latest alerts only, the filter runs for days
+        self.rejected_reason = LRUCache(self.RECENT_ALERTS)
+        self.matched_catalog = LRUCache(self.RECENT_ALERTS)
+        self.rejected_count = Counter()
+        self.n_processed = 0
+
+        # per-alert messages are only formatted if debug is enabled at startup
+        self.log_debug = self.logger.isEnabledFor(logging.DEBUG)
 
         # parse the run config
         rc_dict = run_config.dict()
         for k, val in rc_dict.items():
-            self.logger.info("Using %s=%s" % (k, val))
+            self.logger.info("Using %s=%s", k, val)
         
         # ----- set filter properties ----- #
         self.min_ndet                          = rc_dict['MIN_NDET']
@@ -79,22 +98,88 @@ class VeritasBlazarFilter(AbsAlertFilter):
         self.max_distpsnr1                     = rc_dict['DIST_PSNR1']
         self.max_sgscore1                      = rc_dict['SGS_SCORE1']
         self.catalogs_arcsec                   = rc_dict['CATALOGS_ARCSEC']
+        self.log_summary_every                 = rc_dict.get('LOG_SUMMARY_EVERY', 0)
+        self.match_cache = CatalogMatchCache.from_config(rc_dict.get('MATCH_CACHE'))
+        self.dedupe = CandidDeduplicator.from_config(rc_dict.get('DEDUPE'))
+
+        # ----- timing and counters (no-op unless enabled) ----- #
+        # each channel has its own filter instance and settings; give them
+        # a 'channel' key to tell their metrics and profiles apart
+        self.instrumentation = Instrumentation.from_config(
+            self.__class__.__name__, rc_dict.get('INSTRUMENTATION'), self.logger)
+        self.profiler = CallProfiler.from_config(
+            self.__class__.__name__, rc_dict.get('PROFILING'), self.logger)
+
+        # ----- init the catalog query objects ----- #
+        # with CATALOG_RELOAD, new catalog releases are swapped in while running
+        self.catalog_manager = None
+        self.catalog_generation = 0
+        if catalog_queries is None and rc_dict.get('CATALOG_RELOAD'):
+            catalog_queries = self.init_catalog_manager(base_config['extcats.reader'],
+                self.catalogs_arcsec, self.logger, **rc_dict['CATALOG_RELOAD'])
+        if catalog_queries is None and rc_dict.get('ASYNC_CATALOGS'):
+            catalog_queries = self.init_async_catalog_queries(base_config['extcats.reader'],
+                self.catalogs_arcsec, self.logger, **rc_dict['ASYNC_CATALOGS'])
+        if catalog_queries is None:
+            catalog_queries = self.init_catalog_queries(
+                base_config['extcats.reader'], self.catalogs_arcsec, self.logger)
+        if isinstance(catalog_queries, CatalogManager):
+            self.catalog_manager = catalog_queries
+            self.db_queries = None
+        else:
+            self.db_queries = {catq: catalog_queries[catq] for catq in self.catalogs_arcsec}
+
 
-        # ----- init the catalog query object for the 3fhl catalog ----- #
-        catq_client = MongoClient(base_config['extcats.reader'])
-        catq_kwargs = {'logger': self.logger, 'dbclient': catq_client}
-        self.db_queries = {}
+    @staticmethod
+    def init_catalog_queries(uri, catalogs, logger):
+        """
+            create one extcats CatalogQuery per catalog, sharing one Mongo client
+        """
+        # deferred: only needed once the filter is actually set up
+        from pymongo import MongoClient
+        from extcats import CatalogQuery
+
+        catq_client = MongoClient(uri)
+        db_queries = {}
         #for catq in catq_client.list_database_names():
         #    # loop over databases
         #    if catq in ['admin','local','config']: continue
         
-        for catq in self.catalogs_arcsec:
+        for catq in catalogs:
             if catq not in catq_client.list_database_names():
-                self.logger.error("Catalog {0} not in the Mongo DB".format(catq))
+                logger.error("Catalog {0} not in the Mongo DB".format(catq))
 
-            self.db_queries[catq] = \
+            db_queries[catq] = \
                 CatalogQuery.CatalogQuery(catq, ra_key='RAJ2000', dec_key='DEJ2000',
-                                          logger=self.logger, dbclient=catq_client)
+                                          logger=logger, dbclient=catq_client)
+        return db_queries
+
+
+    @staticmethod
+    def init_async_catalog_queries(uri, catalogs, logger, timeout=None, **backend_kwargs):
+        """
+            create blocking facades of asyncio catalog queries, sharing the
+            connection pool of the process (see asynccatalogs.get_backend)
+        """
+        from ampel.contrib.veritas.asynccatalogs import get_backend, SyncCatalogQuery
+
+        backend = get_backend(uri, logger=logger, **backend_kwargs)
+        return {catq: SyncCatalogQuery(backend.query(catq, ra_key='RAJ2000', dec_key='DEJ2000',
+                                                     logger=logger), timeout)
+                for catq in catalogs}
+
+
+    @staticmethod
+    def init_catalog_manager(uri, catalogs, logger, poll_interval=600, version_file=None):
+        """
+            create a CatalogManager reloading the catalogs on version change
+        """
+        from pymongo import MongoClient
+
+        return CatalogManager.for_extcats(
+            MongoClient(uri), catalogs,
+            catq_kwargs={'ra_key': 'RAJ2000', 'dec_key': 'DEJ2000', 'logger': logger},
+            version_file=version_file, poll_interval=poll_interval, logger=logger)
 
 
     def _alert_has_keys(self, photop):
@@ -103,103 +188,216 @@ class VeritasBlazarFilter(AbsAlertFilter):
         """
         for el in self.keys_to_check:
             if el not in photop:
-                self.logger.debug("rejected: '%s' missing" % el)
+                if self.log_debug:
+                    self.logger.debug("rejected: '%s' missing", el)
                 return False
             if photop[el] is None:
-                self.logger.debug("rejected: '%s' is None" % el)
+                if self.log_debug:
+                    self.logger.debug("rejected: '%s' is None", el)
                 return False
         return True
 
 
-    def apply(self, alert):
+    def _reject(self, latest, reason, msg=None, *args):
+        """
+            record the reason why the alert was rejected. The optional
+            debug message is only formatted if debug logging is enabled.
+        """
+        self.reason = reason
+        self.rejected_reason.put(latest['candid'], reason)
+        self.rejected_count[reason] += 1
+        self.instrumentation.incr('rejected.' + reason)
+        if self.log_debug and msg is not None:
+            self.logger.debug("rejected: " + msg, *args)
+        return None
+
+
+    def log_summary(self):
+        """
+            log the aggregated number of rejected alerts per reason
+        """
+        self.logger.info("Processed %d alerts, rejected: %s", self.n_processed,
+            ", ".join("%s=%d" % item for item in self.rejected_count.most_common()))
+        if self.match_cache is not None:
+            self.logger.info("Catalog match cache: %s", self.match_cache.stats())
+        if self.dedupe is not None:
+            self.logger.info("Candid deduplication: %s", self.dedupe.stats())
+
+
+    def apply(self, alert, matches=None):
         """
         Mandatory implementation.
         To exclude the alert, return *None*
         To accept it, either return
             * self.on_match_t2_units
             * or a custom combination of T2 unit names
+        The optional matches dict caches the catalog match outcomes of this
+        alert, see match_catalogs.
+        """
+        result = UNSEEN
+        candid = alert.pps[0]['candid']
+        if self.dedupe is not None:
+            # candids already decided get their previous verdict
+            result = self.dedupe.lookup(candid)
+            if result is not UNSEEN:
+                self.instrumentation.incr('dedupe.hit')
+                if result is None:
+                    self.reason = 'duplicate'
+                    self.rejected_count['duplicate'] += 1
+        if result is UNSEEN:
+            with self.instrumentation.timer('apply'), self.profiler.profile(candid, alert):
+                result = self._apply(alert, matches)
+            if self.dedupe is not None:
+                self.dedupe.record(candid, result)
+        self.instrumentation.maybe_flush()
+        self.n_processed += 1
+        if self.log_summary_every and self.n_processed % self.log_summary_every == 0:
+            self.log_summary()
+        return result
+
+
+    def _apply(self, alert, matches=None):
+        """
+            run the cut chain and the catalog matching on the latest photopoint
         """
-        
-        # cut on RB (1 is real, 0 is bogus)
         latest = alert.pps[0]
-        
-        if latest['rb'] < self.rb_th:
-            self.logger.debug("rejected: RB score %.2f below threshold (%.2f)" %
-                (latest['rb'], self.rb_th))
-            self.reason='low_rb'
-            self.rejected_reason[latest['candid']] = self.reason
+        sw = self.instrumentation.stopwatch()
+        passed = self.passes_cuts(latest)
+        # whole chain, rejected alerts included
+        sw.lap('cuts')
+        if not passed:
             return None
+
+        # a new catalog release invalidates the cached outcomes
+        if self.catalog_manager is not None and self.match_cache is not None:
+            generation = self.catalog_manager.snapshot.generation
+            if generation != self.catalog_generation:
+                self.match_cache.clear()
+                self.catalog_generation = generation
+
+        # reuse the catalog outcomes of recently seen sources
+        if matches is None and self.match_cache is not None:
+            key = self.match_cache.make_key(alert, latest)
+            matches = self.match_cache.get(key)
+            if matches is None:
+                matches = {}
+                self.match_cache.put(key, matches)
+                self.instrumentation.incr('match_cache.miss')
+            else:
+                self.instrumentation.incr('match_cache.hit')
+
+        if self.match_catalogs(latest, matches):
+            self.instrumentation.incr('accepted')
+            return self.on_match_t2_units
+        return self._reject(latest, 'not_in_catalogs', "not in catalogs")
+
+
+    def passes_cuts(self, latest):
+        """
+            apply the cuts on the photopoint properties. On rejection, the
+            reason is recorded and None is returned. Each cut passed is timed
+            as the 'cut.<name>' stage.
+        """
+        sw = self.instrumentation.stopwatch()
+        # cut on RB (1 is real, 0 is bogus)
+        if latest['rb'] < self.rb_th:
+            return self._reject(latest, 'low_rb',
+                "RB score %.2f below threshold (%.2f)", latest['rb'], self.rb_th)
+        sw.lap('cut.rb')
         
         if latest['scorr'] < self.scorr:
-            self.logger.debug("rejected: SCORR (SNR) %.2f < %.2f" %
-                (latest['scorr'], self.scorr))
-            self.reason='low_scorr'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'low_scorr',
+                "SCORR (SNR) %.2f < %.2f", latest['scorr'], self.scorr)
+        sw.lap('cut.scorr')
         
         if latest['ssnrms'] < self.ssnrms:
-            self.logger.debug("rejected: SSNRMS (SNR) %.2f < %.2f" %
-                (latest['ssnrms'], self.ssnrms))
-            self.reason='low_ssnrms'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'low_ssnrms',
+                "SSNRMS (SNR) %.2f < %.2f", latest['ssnrms'], self.ssnrms)
+        sw.lap('cut.ssnrms')
 
         # cut on magnitude (bandpass, min<mag<max)
         if (latest['magpsf'] < self.min_mag):
-            self.logger.debug("rejected: magpsf %.2f < %.2f" %
-                (latest['magpsf'], self.min_mag))
-            self.reason='low_mag'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'low_mag',
+                "magpsf %.2f < %.2f", latest['magpsf'], self.min_mag)
         elif (latest['magpsf'] > self.max_mag):
-            self.logger.debug("rejected: magpsf %.2f > %.2f" %
-                (latest['magpsf'], self.max_mag))
-            self.reason='high_mag'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'high_mag',
+                "magpsf %.2f > %.2f", latest['magpsf'], self.max_mag)
+        sw.lap('cut.mag')
         
         # check sharpness (to remove cosmic rays, negative values)
         # http://stsdas.stsci.edu/cgi-bin/gethelp.cgi?peak
         if (latest['sharpnr']) < self.min_sharpness:
             # likely a cosmic ray
-            self.reason='cosmic_ray_sharpness'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'cosmic_ray_sharpness')
         elif (latest['sharpnr']) > self.max_sharpness:
             # likely an extended source
-            self.reason='extended_src_sharpness'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
+            return self._reject(latest, 'extended_src_sharpness')
+        sw.lap('cut.sharpness')
             
         # check for positional coincidence with known star-like objects.
         if (latest['distpsnr1']) < self.max_distpsnr1:
             if (latest['sgscore1']) > self.max_sgscore1:
                 # likely a star
-                self.reason='ps1_cat_star'
-                self.rejected_reason[latest['candid']] = self.reason
-                return None
+                return self._reject(latest, 'ps1_cat_star')
+        sw.lap('cut.ps1_star')
             
         # since it was detected only once, it might be an object with 
         # a large proper motion (i.e. solar system or closeby star)
         if latest['ndethist'] < 2:
-            self.logger.debug("rejected: only detected once")
-            self.reason='one_time_detection'
-            self.rejected_reason[latest['candid']] = self.reason
-            return None
-        
-        # check for positional coincidence with gamma-ray blazars
-        for catq in self.db_queries:
-            currentcat = self.db_queries[catq]
-            rs_arcsec  = self.catalogs_arcsec[catq]
-            matchfound = currentcat.binaryserach(\
-                latest['ra'], latest['dec'], rs_arcsec)
-            if matchfound:
-                return self.on_match_t2_units
-            
-        self.logger.debug("rejected: not in catalogs")
-        
-        self.reason='not_in_catalogs'
-        self.rejected_reason[latest['candid']] = self.reason    
-        
-        return None
+            return self._reject(latest, 'one_time_detection', "only detected once")
+        sw.lap('cut.ndethist')
+
+        return True
+
+
+    def match_catalogs(self, latest, matches=None):
+        """
+            check for positional coincidence with gamma-ray blazars.
+            :param matches: optional dict of outcomes by (catalog, radius),
+                filled and reused by evaluations sharing the same alert.
+            :return: True if any catalog has a source within its radius. The
+                matching catalog and its version are kept in matched_catalog
+                (for the RECENT_ALERTS latest alerts).
+        """
+        if self.catalog_manager is not None:
+            # one consistent set of catalogs for the whole alert
+            snapshot = self.catalog_manager.snapshot
+            db_queries, versions = snapshot.queries, snapshot.versions
+        else:
+            db_queries, versions = self.db_queries, {}
+        # with asyncio catalog queries, all the catalogs are queried at once;
+        # the ones still running at the first match are cancelled
+        pending = {}
+        for catq, rs_arcsec in self.catalogs_arcsec.items():
+            submit = getattr(db_queries[catq], 'submit_binaryserach', None)
+            if submit is not None and (matches is None or matches.get((catq, rs_arcsec)) is None):
+                pending[catq] = submit(latest['ra'], latest['dec'], rs_arcsec)
+        sw = self.instrumentation.stopwatch()
+        try:
+            for catq in self.catalogs_arcsec:
+                rs_arcsec  = self.catalogs_arcsec[catq]
+                matchfound = None if matches is None else matches.get((catq, rs_arcsec))
+                if matchfound is None:
+                    currentcat = db_queries[catq]
+                    if catq in pending:
+                        matchfound = pending.pop(catq).result(currentcat.timeout)
+                    else:
+                        matchfound = currentcat.binaryserach(\
+                            latest['ra'], latest['dec'], rs_arcsec)
+                    sw.lap('catalog.' + catq)
+                    if matches is not None:
+                        matches[(catq, rs_arcsec)] = matchfound
+                if matchfound:
+                    self.matched_catalog.put(latest['candid'], (catq, versions.get(catq)))
+                    return True
+            return False
+        finally:
+            # after a match or a failure: keep the outcomes already received,
+            # and cancel the queries of the other catalogs still in flight
+            for catq, future in pending.items():
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    if matches is not None:
+                        matches[(catq, self.catalogs_arcsec[catq])] = future.result()
+                else:
+                    future.cancel()
                 
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t0/alerts.py
+# License           : BSD-3-Clause
+
+import io
+import json
+import zlib
+import fastavro
+
+
+# candidate fields read by VeritasBlazarFilter: its keys_to_check plus
+# sharpnr and candid ('ndet' is not part of the ZTF schema and is ignored)
+FILTER_FIELDS = ('ndet', 'ra', 'dec', 'rb', 'scorr', 'ssnrms', 'magpsf',
+                 'distpsnr1', 'sgscore1', 'ndethist', 'sharpnr', 'candid')
+
+AVRO_MAGIC = b'Obj\x01'
+
+
+def _read_long(buf, pos):
+    """
+    decode one zig-zag varint encoded avro long starting at buf[pos]
+    :return: (value, position of the next byte)
+    """
+    b = buf[pos]
+    pos += 1
+    n = b & 0x7f
+    shift = 7
+    while b & 0x80:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def _read_header(buf):
+    """
+    parse the header of an avro object container file.
+    :return: (metadata dict, sync marker, position of the first data block)
+    """
+    if buf[:4] != AVRO_MAGIC:
+        raise ValueError("Not an avro object container file")
+    pos = 4
+    meta = {}
+    while True:
+        count, pos = _read_long(buf, pos)
+        if count == 0:
+            break
+        if count < 0:
+            # negative count is followed by the block size in bytes
+            count = -count
+            _, pos = _read_long(buf, pos)
+        for i in range(count):
+            klen, pos = _read_long(buf, pos)
+            key = bytes(buf[pos:pos + klen]).decode()
+            pos += klen
+            vlen, pos = _read_long(buf, pos)
+            meta[key] = bytes(buf[pos:pos + vlen])
+            pos += vlen
+    return meta, bytes(buf[pos:pos + 16]), pos + 16
+
+
+def _iter_blocks(buf, pos, sync, codec):
+    """
+    yield (record count, decompressed block data) for each data block
+    """
+    while pos < len(buf):
+        count, pos = _read_long(buf, pos)
+        size, pos = _read_long(buf, pos)
+        data = buf[pos:pos + size]
+        pos += size
+        if buf[pos:pos + 16] != sync:
+            raise ValueError("Invalid avro sync marker")
+        pos += 16
+        if codec == b'deflate':
+            data = zlib.decompress(data, -15)
+        elif codec not in (b'null', None):
+            raise ValueError("Unsupported avro codec %s" % codec)
+        yield count, data
+
+
+def project_schema(schema, candidate_fields):
+    """
+    Build a reader schema keeping only the alert identifiers and the
+    requested candidate fields. Skipped fields (prv_candidates, cutouts,...)
+    are not materialized by the avro decoder.
+    :param schema: writer schema (json dict) of the ZTF alert
+    :param candidate_fields: names of the candidate fields to keep
+    :return: reader schema (json dict)
+    """
+    fields = []
+    for field in schema['fields']:
+        if field['name'] in ('objectId', 'candid'):
+            fields.append(field)
+        elif field['name'] == 'candidate':
+            cand = dict(field['type'])
+            cand['fields'] = [f for f in cand['fields'] if f['name'] in candidate_fields]
+            fields.append(dict(field, type=cand))
+    return dict(schema, fields=fields)
+
+
+class LeanAlert(object):
+    """
+    Alert with only the filter fields decoded. The full record (previous
+    candidates, cutouts,...) is kept as an undecoded byte slice and is only
+    decoded by materialize(), e.g. once the alert has been accepted.
+    """
+    __slots__ = ('tran_id', 'candid', 'pps', 'uls', '_raw', '_writer')
+
+    def __init__(self, alert, raw, writer):
+        self.tran_id = alert['objectId']
+        self.candid = alert['candid']
+        self.pps = [alert['candidate']]
+        self.uls = []
+        self._raw = raw
+        self._writer = writer
+
+    def materialize(self):
+        """
+        :return: the complete alert dict
+        """
+        return fastavro.schemaless_reader(io.BytesIO(self._raw), self._writer)
+
+
+class AlertReader(object):
+    """
+    Decoder for ZTF avro alerts extracting only the fields needed by the
+    filter. Writer schemas are parsed once and cached, keyed on the raw
+    schema stored in the file header, so that decoding an alert costs a
+    header scan and a single schemaless read.
+    """
+
+    def __init__(self, candidate_fields=FILTER_FIELDS):
+        self.candidate_fields = frozenset(candidate_fields)
+        self._schemas = {}
+
+    def _get_schemas(self, raw_schema):
+        schemas = self._schemas.get(raw_schema)
+        if schemas is None:
+            writer = json.loads(raw_schema)
+            reader = project_schema(writer, self.candidate_fields)
+            schemas = (fastavro.parse_schema(writer), fastavro.parse_schema(reader))
+            self._schemas[raw_schema] = schemas
+        return schemas
+
+    def _iter_records(self, data):
+        """
+        yield (projected record, raw record bytes, writer schema)
+        """
+        buf = memoryview(data)
+        meta, sync, pos = _read_header(buf)
+        writer, reader = self._get_schemas(meta['avro.schema'])
+        for count, block in _iter_blocks(buf, pos, sync, meta.get('avro.codec')):
+            fo = io.BytesIO(block)
+            for i in range(count):
+                start = fo.tell()
+                record = fastavro.schemaless_reader(fo, writer, reader)
+                yield record, block[start:fo.tell()], writer
+
+    def read(self, data):
+        """
+        :param data: bytes of an avro object container file
+        :return: list of alert dicts with the keys objectId, candid and
+                 candidate (containing only the requested fields)
+        """
+        return [record for record, raw, writer in self._iter_records(data)]
+
+    def read_lean(self, data):
+        """
+        :param data: bytes of an avro object container file
+        :return: list of LeanAlert instances
+        """
+        return [LeanAlert(record, raw, writer) for record, raw, writer in self._iter_records(data)]
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t0/replay.py
+# License           : BSD-3-Clause
+
+"""
+Replay archived ZTF alert tarballs through VeritasBlazarFilter.
+
+Alerts are read from one or many tarballs and dispatched in chunks to a
+pool of worker processes. Each worker decodes the alerts with a
+schema-cached reader extracting only the fields used by the filter, and
+evaluates every given run config on each alert (see sweep.FilterSweep).
+Per-reason rejection counts and accepted candids are merged as chunks
+complete.
+
+Example:
+    python -m ampel.contrib.veritas.t0.replay alerts_*.tar.gz \\
+        --config tighter_rb.json --workers 8 --output report.json
+
+where tighter_rb.json holds either one dict or a list of dicts of
+RunConfig parameters overriding those of the VERITAS_BLAZARS channel.
+"""
+
+import sys
+import json
+import time
+import logging
+import tarfile
+import argparse
+import multiprocessing
+from collections import Counter
+
+from ampel.contrib.veritas.channels import load_channels
+from ampel.contrib.veritas.t0.alerts import AlertReader
+from ampel.contrib.veritas.t0.sweep import FilterSweep
+
+
+def default_run_config():
+    """
+    :return: t0 runConfig dict of the VERITAS_BLAZARS channel
+    """
+    for channel in load_channels():
+        if channel['channel'] == 'VERITAS_BLAZARS':
+            return dict(channel['sources']['t0Filter']['runConfig'])
+    raise KeyError("VERITAS_BLAZARS channel not found")
+
+
+def iter_tar_chunks(paths, chunk_size):
+    """
+    yield lists of raw avro payloads read from the given tarballs
+    """
+    chunk = []
+    for path in paths:
+        # streaming mode, works for plain and compressed tarballs alike
+        with tarfile.open(path, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith('.avro'):
+                    continue
+                chunk.append(tar.extractfile(member).read())
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+# per-process state set up by _init_worker
+_worker = {}
+
+
+def _init_worker(run_configs, base_config, on_match_t2_units):
+    logger = logging.getLogger('VeritasReplay')
+    logger.setLevel(logging.WARNING)
+    _worker['reader'] = AlertReader()
+    _worker['sweep'] = FilterSweep(run_configs, base_config, on_match_t2_units, logger=logger)
+
+
+def _process_chunk(chunk):
+    """
+    decode a chunk of alerts and evaluate each filter on it
+    :return: ChunkResult-like dict, see ReplayReport.merge
+    """
+    reader, sweep = _worker['reader'], _worker['sweep']
+    filters = sweep.filters
+    rejected = [Counter() for f in filters]
+    accepted = [[] for f in filters]
+    n_alerts, n_queries = sweep.n_alerts, sweep.n_catalog_queries
+    for payload in chunk:
+        for alert in reader.read_lean(payload):
+            row = sweep.evaluate(alert)
+            for i, ok in enumerate(row):
+                if ok:
+                    accepted[i].append(alert.candid)
+                else:
+                    rejected[i][filters[i].reason] += 1
+    return {'n_alerts': sweep.n_alerts - n_alerts,
+            'n_catalog_queries': sweep.n_catalog_queries - n_queries,
+            'rejected': rejected, 'accepted': accepted}
+
+
+class ReplayReport(object):
+    """
+    Merged replay outcome, one entry per evaluated run config.
+    """
+
+    def __init__(self, run_configs):
+        self.run_configs = run_configs
+        self.n_alerts = 0
+        self.n_catalog_queries = 0
+        self.rejected = [Counter() for rc in run_configs]
+        self.accepted = [[] for rc in run_configs]
+
+    def merge(self, result):
+        self.n_alerts += result['n_alerts']
+        self.n_catalog_queries += result['n_catalog_queries']
+        for i in range(len(self.run_configs)):
+            self.rejected[i].update(result['rejected'][i])
+            self.accepted[i].extend(result['accepted'][i])
+
+    def to_dict(self):
+        return {
+            'n_alerts': self.n_alerts,
+            'n_catalog_queries': self.n_catalog_queries,
+            'configs': [
+                {
+                    'run_config': rc,
+                    'n_accepted': len(self.accepted[i]),
+                    'rejected': dict(self.rejected[i]),
+                    'accepted': sorted(self.accepted[i]),
+                }
+                for i, rc in enumerate(self.run_configs)]
+        }
+
+
+def replay(paths, run_configs, base_config, workers=None, chunk_size=256,
+           on_match_t2_units=('T2BLAZARPRODUTCS',), logger=None):
+    """
+    Run VeritasBlazarFilter over archived alerts.
+    :param paths: list of alert tarballs
+    :param run_configs: list of (complete) filter RunConfig dicts
+    :param base_config: dict with the 'extcats.reader' resource URI
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunk_size: number of alerts sent to a worker at once
+    :return: ReplayReport
+    """
+    logger = logger if logger is not None else logging.getLogger()
+    report = ReplayReport(run_configs)
+    t0 = time.time()
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(run_configs, base_config, list(on_match_t2_units))) as pool:
+        for result in pool.imap_unordered(_process_chunk, iter_tar_chunks(paths, chunk_size)):
+            report.merge(result)
+            logger.info("Replayed %d alerts (%.0f alerts/s)",
+                        report.n_alerts, report.n_alerts / (time.time() - t0))
+    return report
+
+
+def load_run_configs(config_files):
+    """
+    :param config_files: json files holding a dict or a list of dicts
+                         overriding the channel default runConfig
+    :return: list of complete RunConfig dicts
+    """
+    default = default_run_config()
+    if not config_files:
+        return [default]
+    run_configs = []
+    for fname in config_files:
+        with open(fname) as f:
+            overrides = json.load(f)
+        if isinstance(overrides, dict):
+            overrides = [overrides]
+        for override in overrides:
+            rc = dict(default)
+            rc.update(override)
+            run_configs.append(rc)
+    return run_configs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tarballs', nargs='+', help="alert tarballs")
+    parser.add_argument('--config', action='append', default=[],
+                        help="json file with RunConfig overrides (dict or list of dicts)")
+    parser.add_argument('--extcats', default=None, help="extcats MongoDB URI")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-size', type=int, default=256)
+    parser.add_argument('--output', default=None, help="json report file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    report = replay(args.tarballs, load_run_configs(args.config),
+                    {'extcats.reader': args.extcats},
+                    workers=args.workers, chunk_size=args.chunk_size)
+
+    if args.output is None:
+        json.dump(report.to_dict(), sys.stdout, indent=2)
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
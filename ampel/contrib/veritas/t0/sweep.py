@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t0/sweep.py
+# License           : BSD-3-Clause
+
+import logging
+import numpy as np
+
+from ampel.contrib.veritas.t0.VeritasBlazarFilter import VeritasBlazarFilter
+
+
+class FilterSweep(object):
+    """
+    Evaluate several VeritasBlazarFilter run configs against each alert in
+    a single pass.
+
+    All the filter instances share one Mongo client and one CatalogQuery per
+    catalog. Since a catalog match only depends on the position and on the
+    search radius, its outcome is computed at most once per alert and
+    reused by every config asking for the same (catalog, radius).
+    """
+
+    def __init__(self, run_configs, base_config, on_match_t2_units=('T2BLAZARPRODUTCS',),
+                 logger=None):
+        """
+        :param run_configs: list of RunConfig instances or dicts of parameters
+        :param base_config: dict with the 'extcats.reader' resource URI
+        """
+        self.logger = logger if logger is not None else logging.getLogger()
+        run_configs = [rc if hasattr(rc, 'dict') else VeritasBlazarFilter.RunConfig(**rc)
+                       for rc in run_configs]
+        catalogs = []
+        for rc in run_configs:
+            catalogs += [c for c in rc.dict()['CATALOGS_ARCSEC'] if c not in catalogs]
+        self.catalog_queries = VeritasBlazarFilter.init_catalog_queries(
+            base_config['extcats.reader'], catalogs, self.logger)
+        self.filters = [
+            VeritasBlazarFilter(list(on_match_t2_units), base_config=base_config,
+                                run_config=rc, logger=self.logger,
+                                catalog_queries=self.catalog_queries)
+            for rc in run_configs]
+        self.n_alerts = 0
+        self.n_catalog_queries = 0
+
+    def evaluate(self, alert):
+        """
+        :return: list of booleans, True if the alert is accepted by the
+                 corresponding run config. The reason of a rejection is
+                 available as self.filters[i].reason.
+        """
+        matches = {}
+        row = [filt.apply(alert, matches) is not None for filt in self.filters]
+        self.n_alerts += 1
+        self.n_catalog_queries += len(matches)
+        return row
+
+    def accept_matrix(self, alerts):
+        """
+        :param alerts: iterable of alerts
+        :return: boolean array of shape (number of alerts, number of configs)
+        """
+        rows = [self.evaluate(alert) for alert in alerts]
+        return np.array(rows, dtype=bool).reshape(len(rows), len(self.filters))
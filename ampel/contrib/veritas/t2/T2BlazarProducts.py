@@ -1,5 +1,9 @@
 from ampel.base.abstract.AbsT2Unit import AbsT2Unit
-import astropy.stats as astats
+from ampel.contrib.veritas.instrumentation import Instrumentation
+from ampel.contrib.veritas.profiling import CallProfiler
+from ampel.contrib.veritas.t2.lcarrays import get_lc_arrays, bin_points, bin_upper_limits, summarize_points, BIN_ORIGIN
+from ampel.contrib.veritas.t2.colors import EpochTable, batched_iterative_polyfit, close_pairs
+from ampel.contrib.veritas.blobs import encode_array
 import logging
 import numpy as np
 import itertools
@@ -18,6 +22,29 @@ class T2BlazarProducts(AbsT2Unit):
         'calculate_color': True,
         'bblocks_p0': 0.05
     }
+    # optional run config parameters, see select_fit_points:
+    # 'lookback_days': only fit the points of the last lookback_days days
+    # 'bin_days': inverse-variance average the points in bins of bin_days
+    #             days (1 for nightly bins) before fitting
+    # 'array_encoding': store the arrays as packed 'float32' or 'float64'
+    #             binary blobs instead of lists (see ampel.contrib.veritas.blobs)
+    # 'upper_limits': fold the upper limits in the photometry of each band
+    #             (censored fits, see censored_polymodelfit). The upper limits
+    #             are only loaded for the T2BlazarProductsUL unit.
+    # 'color_engine': 'pairs' (default) pairs the detections of two bands
+    #             taken within one day, 'epochs' derives all the colors from
+    #             one table of nightly epochs (see epoch_color_estimation)
+    # 'color_epoch_days': length of the epochs of the 'epochs' engine (default 1)
+
+    # arrays always packed as float64 (julian dates do not fit in a float32)
+    time_keys = ('jds_val', 'jds_err', 'x', 'xerr', 'ul_jds')
+    # small arrays used by estimate_excitement, always kept as lists
+    list_keys = ('poly_coef',)
+    # magnitude error given to the upper limits (5 sigma) entering the fits,
+    # the error of a 5 sigma detection
+    ul_mag_err = 2.5 / np.log(10) / 5.
+    # maximum number of refits adding the violated upper limits
+    ul_max_iter = 5
 
     def __init__(self, logger=None, base_config=None):
         """
@@ -30,31 +57,147 @@ class T2BlazarProducts(AbsT2Unit):
         # Save the logger as instance variable
         super().__init__(logger)
         self.logger = logger if logger is not None else logging.getLogger()
+        # per-band and per-pair messages are only formatted if debug is enabled
+        self.log_debug = self.logger.isEnabledFor(logging.DEBUG)
         self.base_config = self.default_config if base_config is None else base_config
         self.run_config = None
+        self.lc = None
         self.data_filter = {}
+        self.history = {}
+        self.last_mags = {}
         self.uls_filter = {}
         self.colordict = {1: 'g', 2: 'r', 3: 'i'}  # i is not really used
         self.available_photom = []
         self.available_colors = []
         self.results = dict()
+        self.instrumentation = Instrumentation.from_config(
+            self.__class__.__name__, self.base_config.get('instrumentation'), self.logger)
+        self.profiler = CallProfiler.from_config(
+            self.__class__.__name__, self.base_config.get('profiling'), self.logger)
 
     def classify_in_filters(self,light_curve):
         '''
         Classify the photometric points in filter groups.
         :param light_curve:  object containing the photometry points
                              (ppo_list) and upper limits (ulo_list)
-        :return: None (fills the available_color, data_filter and uls_filter properties)
+        :return: None (fills the available_color, data_filter and uls_filter properties).
+                 data_filter holds the points of each band as views of the
+                 structured array self.lc.points (fields jd, fid, magpsf,
+                 sigmapsf, ra, dec).
         '''
         self.colordict = {1: 'g', 2: 'r', 3: 'i'}  # i is not really used
-        self.data_filter = {}
-        for item in light_curve.ppo_list:
-            # item['mjd'] = item['jd']-2400000.5
-            if item.get_value('fid') not in self.data_filter:
-                self.data_filter[item.get_value('fid')] = []
-            self.data_filter[item.get_value('fid')].append(item.content)
+        self.lc = get_lc_arrays(light_curve)
+        # copy, the band groups of the cached arrays are shared
+        self.data_filter = dict(self.lc.bands)
+        self.uls_filter = {}
+        if self.run_config.get('upper_limits'):
+            self.uls_filter = {band: uls for band, uls in self.lc.ul_bands.items()
+                               if band in self.data_filter and len(uls)}
+
+        self.available_bands = sorted(list(self.data_filter.keys()))
 
+    def select_fit_points(self):
+        '''
+        Keep the aggregate statistics of the full history of each band in
+        self.history, then restrict the points to fit to the lookback window
+        and bin them, if requested by the run config. This keeps the cost
+        of the fits and of the bayesian blocks flat for long light curves.
+        The upper limits are reduced to the deepest one per bin (or per
+        night) without a detection, since they outnumber the detections.
+        :return: None (replaces the data_filter, uls_filter groups and
+                 available_bands, and keeps in last_mags the magnitudes of
+                 the detections merged in the last fitted point)
+        '''
+        self.history = {band: summarize_points(points) for band, points in self.data_filter.items()}
+        self.last_mags = {band: points['magpsf'][-1:] for band, points in self.data_filter.items()}
+        lookback = self.run_config.get('lookback_days')
+        bin_days = self.run_config.get('bin_days')
+        if lookback is None and bin_days is None and not self.uls_filter:
+            return
+        for band, points in list(self.data_filter.items()):
+            uls = self.uls_filter.get(band)
+            if lookback is not None:
+                points = points[points['jd'] >= self.max_jd - lookback]
+                if uls is not None:
+                    uls = uls[uls['jd'] >= self.max_jd - lookback]
+            if uls is not None:
+                uls = bin_upper_limits(uls, bin_days or 1., points)
+            if bin_days is not None and len(points):
+                keys = np.floor((points['jd'] - BIN_ORIGIN) / bin_days)
+                self.last_mags[band] = points['magpsf'][keys == keys.max()]
+                points = bin_points(points, bin_days)
+            if len(points) == 0:
+                del self.data_filter[band]
+                self.uls_filter.pop(band, None)
+            else:
+                self.data_filter[band] = points
+                if uls is not None:
+                    self.uls_filter[band] = uls
         self.available_bands = sorted(list(self.data_filter.keys()))
+        if lookback is None and bin_days is None:
+            return
+        self.results['history'] = {
+            self.colordict.get(band, str(band)): summary for band, summary in self.history.items()}
+
+    def history_mean_mag(self, color, exclude=None):
+        '''
+        :param color: photometric band
+        :param exclude: optional magnitudes of the points to leave out
+        :return: mean magnitude of all the points of the band
+        '''
+        hist = self.history[color]
+        if exclude is None:
+            return hist['mag_sum'] / hist['n']
+        exclude = np.atleast_1d(exclude)
+        n = hist['n'] - len(exclude)
+        return (hist['mag_sum'] - np.sum(exclude)) / n if n > 0 else np.nan
+
+    def censored_mean_mag(self, color, exclude=None):
+        '''
+        Mean magnitude of the band, counting the upper limits deeper than
+        the mean of the detections at their limit, since the faint states
+        of the source only show up as upper limits. Only the limits of the
+        lookback window, if any, are counted.
+        :param color: photometric band
+        :param exclude: optional magnitudes of the points to leave out
+        :return: mean magnitude
+        '''
+        mean_mag = self.history_mean_mag(color, exclude)
+        uls = self.lc.ul_bands[color]
+        lookback = self.run_config.get('lookback_days')
+        if lookback is not None:
+            uls = uls[uls['jd'] >= self.max_jd - lookback]
+        lims = uls['diffmaglim']
+        deep = lims[lims > mean_mag]
+        if len(deep) == 0:
+            return mean_mag
+        exclude = np.atleast_1d(exclude if exclude is not None else [])
+        hist = self.history[color]
+        return (hist['mag_sum'] - np.sum(exclude) + np.sum(deep)) / (hist['n'] - len(exclude) + len(deep))
+
+    def censored_polymodelfit(self, x, y, ul_x, ul_y):
+        '''
+        Polynomial fit of censored data: the upper limits (the source is
+        fainter than ul_y) that the fitted model violates are added to the
+        fitted points at their limit, and the fit is repeated until no new
+        limit is violated.
+        :param x, y: detections
+        :param ul_x, ul_y: times and magnitudes of the upper limits
+        :return: best-fitting polynomial parameters, chi2 and the boolean
+                 mask of the upper limits used in the fit
+        '''
+        used = np.zeros(len(ul_x), dtype=bool)
+        coef, chi2 = self.iterative_polymodelfit(x, y)
+        for _ in range(self.ul_max_iter):
+            if coef is None:
+                break
+            violated = ul_y > np.polyval(coef, ul_x)
+            if not np.any(violated & ~used):
+                break
+            used |= violated
+            coef, chi2 = self.iterative_polymodelfit(
+                np.concatenate((x, ul_x[used])), np.concatenate((y, ul_y[used])))
+        return (coef, chi2, used)
 
     def iterative_polymodelfit(self, x, y):
         '''
@@ -65,20 +208,23 @@ class T2BlazarProducts(AbsT2Unit):
         self.run_config['max_order']
         :return: Returns best-fitting polynomial paramaters and the chi2.
         '''
-        self.logger.info("Performing a polynomial fit of the data")
+        if self.log_debug:
+            self.logger.debug("Performing a polynomial fit of %d points", len(y))
         if len(y) < 3:
             return (None, None)
-        poly, res = np.polyfit(x, y, 1, full=True)[0:2]
-        chisq_dof = (res / (len(x) - 2))[0]
-        for k in range(self.run_config['max_order']):
-            if len(y) > k + 3:
-                self.logger.debug("Trying poly({0}) shape".format(k + 2))
-                poly_new, res_new = np.polyfit(x, y, k + 2, full=True)[0:2]
-                if len(res_new) == 0: break
-                chisq_dof_new = (res_new / (len(x) - (k + 3)))[0]
-                if chisq_dof_new < chisq_dof * 0.8:
-                    poly, res = poly_new, res_new
-                    chisq_dof = chisq_dof_new
+        with self.instrumentation.timer('polyfit'):
+            poly, res = np.polyfit(x, y, 1, full=True)[0:2]
+            chisq_dof = (res / (len(x) - 2))[0]
+            for k in range(self.run_config['max_order']):
+                if len(y) > k + 3:
+                    if self.log_debug:
+                        self.logger.debug("Trying poly(%d) shape", k + 2)
+                    poly_new, res_new = np.polyfit(x, y, k + 2, full=True)[0:2]
+                    if len(res_new) == 0: break
+                    chisq_dof_new = (res_new / (len(x) - (k + 3)))[0]
+                    if chisq_dof_new < chisq_dof * 0.8:
+                        poly, res = poly_new, res_new
+                        chisq_dof = chisq_dof_new
         return (poly, chisq_dof)
 
     def estimate_bayesian_blocks(self, x, y, yerr):
@@ -94,9 +240,13 @@ class T2BlazarProducts(AbsT2Unit):
         x = np.asarray(x)
         y = np.asarray(y)
         yerr = np.asarray(yerr)
+        # deferred import, astropy is slow to load
+        import astropy.stats as astats
+
         # false alarm probability
         p0 = self.run_config['bblocks_p0']
-        edges = astats.bayesian_blocks(x, y, yerr, fitness='measures', p0=p0)
+        with self.instrumentation.timer('bayesian_blocks'):
+            edges = astats.bayesian_blocks(x, y, yerr, fitness='measures', p0=p0)
         bayesianblocks = {'x': [], 'xerr': [], 'y': [], 'yerr': []}
         for xmin, xmax in zip(edges[:-1], edges[1:]):
             filt = (x >= xmin) * (x < xmax)
@@ -111,6 +261,24 @@ class T2BlazarProducts(AbsT2Unit):
             bayesianblocks['yerr'].append(ystd)
         return (bayesianblocks)
 
+    def serialize(self, result):
+        '''
+        Convert the numpy arrays of a photometry or color result to lists, or
+        to packed binary arrays if requested by the 'array_encoding' run
+        config parameter, so that the result is BSON serializable.
+        :param result: dict (modified in place)
+        '''
+        encoding = self.run_config.get('array_encoding')
+        for item, value in result.items():
+            if encoding is not None and item == 'bayesian_blocks':
+                result[item] = {key: encode_array(val, 'float64' if key in self.time_keys else encoding)
+                                for key, val in value.items()}
+            elif type(value) == np.ndarray:
+                if encoding is None or item in self.list_keys:
+                    result[item] = value.tolist()
+                else:
+                    result[item] = encode_array(value, 'float64' if item in self.time_keys else encoding)
+
     def photometry_estimation(self, color):
         '''
         Collects photometry for the specified band performs an iterative model fit.
@@ -118,39 +286,57 @@ class T2BlazarProducts(AbsT2Unit):
         :return: dictionary containing photometry.
         '''
         cthis = self.colordict[color]
-        self.logger.info("Photometry of filter {0}".format(cthis))
+        if self.log_debug:
+            self.logger.debug("Photometry of filter %s", cthis)
         photresult = dict()
-        # cit   = itertools.cycle(self.data_filter[color])
         cit = self.data_filter[color]
-        photresult['jds_val'] = np.asarray([item['jd'] for item in cit])
-        photresult['jds_err'] = np.asarray([0 for item in cit])
-        photresult['mag_val'] = np.asarray([item['magpsf'] for item in cit])
-        photresult['mag_err'] = np.asarray([item['sigmapsf'] for item in cit])
+        photresult['jds_val'] = cit['jd']
+        photresult['jds_err'] = np.zeros(len(cit), dtype=int)
+        photresult['mag_val'] = cit['magpsf']
+        photresult['mag_err'] = cit['sigmapsf']
         photresult['quantity'] = 'mag'
         photresult['label'] = 'phot_mag_{0}'.format(cthis)
-        # check if the source is becoming significantly brighter
-        mean_mag = np.mean(photresult['mag_val'][:-1])
-        mean_mag_err = np.std(photresult['mag_val'][:-1])
+        # check if the source is becoming significantly brighter than the
+        # average of the full history (without the detections of the last
+        # point, several if it is a bin)
+        uls = self.uls_filter.get(color)
+        if uls is None:
+            mean_mag = self.history_mean_mag(color, exclude=self.last_mags[color])
+        else:
+            mean_mag = self.censored_mean_mag(color, exclude=self.last_mags[color])
         last_mag = photresult['mag_val'][-1]
         last_mag_err = photresult['mag_err'][-1]
         # is_brighter  = last_mag+last_mag_err<mean_mag-mean_mag_err
         is_brighter = int(last_mag + last_mag_err < mean_mag)
+        if uls is not None and is_brighter:
+            # not anymore if the source faded below a later upper limit
+            is_brighter = int(not np.any((uls['jd'] > cit['jd'].max()) & (uls['diffmaglim'] > last_mag)))
         photresult['is_brighter'] = is_brighter
         # Fit the trend by a polynomium of degree 2,3 or 4
         # print('........ polyfit')
-        coef, chi2 = self.iterative_polymodelfit( \
-            x=photresult['jds_val'], y=photresult['mag_val'])
+        if uls is None:
+            coef, chi2 = self.iterative_polymodelfit( \
+                x=photresult['jds_val'], y=photresult['mag_val'])
+            x, y, yerr = photresult['jds_val'], photresult['mag_val'], photresult['mag_err']
+        else:
+            coef, chi2, used = self.censored_polymodelfit(
+                photresult['jds_val'], photresult['mag_val'], uls['jd'], uls['diffmaglim'])
+            photresult['ul_jds'] = uls['jd']
+            photresult['ul_mag'] = uls['diffmaglim']
+            photresult['ul_censored'] = int(np.sum(used))
+            # merge the violated limits with the detections, by time
+            x = np.concatenate((photresult['jds_val'], uls['jd'][used]))
+            order = np.argsort(x, kind='stable')
+            x = x[order]
+            y = np.concatenate((photresult['mag_val'], uls['diffmaglim'][used]))[order]
+            yerr = np.concatenate((photresult['mag_err'],
+                                   np.full(np.sum(used), self.ul_mag_err)))[order]
         photresult['poly_coef'], photresult['poly_chi2'] = coef, chi2
         # Get the bayesian blocks
-        photresult['bayesian_blocks'] = self.estimate_bayesian_blocks( \
-            x=photresult['jds_val'],
-            y=photresult['mag_val'],
-            yerr=photresult['mag_err'])
+        photresult['bayesian_blocks'] = self.estimate_bayesian_blocks(x=x, y=y, yerr=yerr)
 
-        # Convert everything back to lists to allow serialization
-        for item in photresult:
-            if type(photresult[item]) == np.ndarray:
-                photresult[item] = photresult[item].tolist()
+        # Convert everything back to lists (or blobs) to allow serialization
+        self.serialize(photresult)
 
         self.results[photresult['label']] = photresult
         if photresult['label'] not in self.available_photom:
@@ -166,10 +352,8 @@ class T2BlazarProducts(AbsT2Unit):
         :return: True/False
         '''
         if item1['fid'] == item2['fid']:
-            self.logger.debug("Data was taken with the same filter")
             return False
         if abs(item1['jd'] - item2['jd']) > max_jdtimediff:
-            self.logger.debug("Data was taken at different times")
             return False
         return (True)
 
@@ -182,27 +366,29 @@ class T2BlazarProducts(AbsT2Unit):
         :return: dictionary containing the color photometry.
         '''
         cd1, cd2 = self.colordict[color1], self.colordict[color2]
-        self.logger.info("Color of ({0},{1})".format(cd1, cd2))
+        if self.log_debug:
+            self.logger.debug("Color of (%s,%s)", cd1, cd2)
         colorresult = dict()
         f1, f2 = color1, color2
         df1, df2 = self.data_filter[f1], self.data_filter[f2]
-        # Match julian_dates from the two groups
-        valid_pairs = \
-            [pair for pair in itertools.product(df1, df2) \
-             if self.is_valid_pair_for_color(pair[0], pair[1], max_jdtimediff)]
-
-        if len(valid_pairs) == 0: return (None)
-        pairs = dict()
-        pairs[f1], pairs[f2] = np.transpose(valid_pairs)
-
-        jds_val = np.asarray([(p1['jd'] + p2['jd']) / 2. \
-                              for (p1, p2) in zip(pairs[f1], pairs[f2])])
-        jds_err = np.asarray([abs(p1['jd'] - p2['jd']) / 2. \
-                              for (p1, p2) in zip(pairs[f1], pairs[f2])])
-        color_val = np.asarray([(p1['magpsf'] - p2['magpsf']) \
-                                for (p1, p2) in zip(pairs[f1], pairs[f2])])
-        color_err = np.asarray([np.sqrt(p1['sigmapsf'] ** 2 + p2['sigmapsf'] ** 2) \
-                                for (p1, p2) in zip(pairs[f1], pairs[f2])])
+        # Match julian_dates from the two groups: the band2 points within
+        # max_jdtimediff of each band1 point are found in the sorted band2
+        # times, and the pairs kept in the order of itertools.product(df1, df2)
+        with self.instrumentation.timer('color_pairing'):
+            i1, i2 = close_pairs(df1['jd'], df2['jd'], max_jdtimediff)
+            p1, p2 = df1[i1], df2[i2]
+        self.instrumentation.incr('color_pairs_tested', len(df1) * len(df2))
+        if self.log_debug:
+            # one aggregated message instead of one per candidate pair
+            self.logger.debug("%d of %d (%s,%s) pairs within %s days",
+                len(p1), len(df1) * len(df2), cd1, cd2, max_jdtimediff)
+
+        if len(p1) == 0: return (None)
+
+        jds_val = (p1['jd'] + p2['jd']) / 2.
+        jds_err = np.abs(p1['jd'] - p2['jd']) / 2.
+        color_val = p1['magpsf'] - p2['magpsf']
+        color_err = np.sqrt(p1['sigmapsf'] ** 2 + p2['sigmapsf'] ** 2)
 
         # is it significantly bluer?
         mean_color = np.mean(color_val[:-1])
@@ -214,9 +400,7 @@ class T2BlazarProducts(AbsT2Unit):
         colorresult['label'] = '{0}-{1}'.format(cd1, cd2)
         colorresult['jds_val'] = jds_val
         colorresult['jds_err'] = jds_err
-        colorresult['color_ave'] = \
-            np.mean([item['magpsf'] for item in self.data_filter[f1]]) - \
-            np.mean([item['magpsf'] for item in self.data_filter[f2]])
+        colorresult['color_ave'] = self.history_mean_mag(f1) - self.history_mean_mag(f2)
         colorresult['color_val'] = color_val
         colorresult['color_err'] = color_err
         # fit to a polynom of 3rd degreee
@@ -228,10 +412,8 @@ class T2BlazarProducts(AbsT2Unit):
             y=colorresult['color_val'],
             yerr=colorresult['color_err'])
 
-        # Convert everything back to lists to allow serialization
-        for item in colorresult:
-            if type(colorresult[item]) == np.ndarray:
-                colorresult[item] = colorresult[item].tolist()
+        # Convert everything back to lists (or blobs) to allow serialization
+        self.serialize(colorresult)
 
         # check the color
         colorresult['is_bluer'] = int(last_color + last_color_err < mean_color)
@@ -240,6 +422,51 @@ class T2BlazarProducts(AbsT2Unit):
             self.available_colors.append(colorresult['label'])
         return (colorresult)
 
+    def epoch_color_estimation(self):
+        '''
+        Computes the colors of all the pairs of bands at once: the detections
+        are grouped in multi-band epochs (nights), the colors are taken
+        between the band averages of each epoch, and the polynomial fits of
+        all the colors are done as one batch.
+        :return: dict of the color results by label
+        '''
+        points = np.concatenate([self.data_filter[band] for band in self.available_bands])
+        with self.instrumentation.timer('color_pairing'):
+            table = EpochTable(points, width=self.run_config.get('color_epoch_days', 1.))
+            colors = table.colors(itertools.combinations(self.available_bands, 2))
+        if self.log_debug:
+            self.logger.debug("%d epochs, colors of %s", len(table), sorted(colors))
+        if not colors:
+            return {}
+        pairs = sorted(colors)
+        with self.instrumentation.timer('polyfit'):
+            fits = batched_iterative_polyfit([colors[pair]['jds_val'] for pair in pairs],
+                                             [colors[pair]['color_val'] for pair in pairs],
+                                             self.run_config['max_order'])
+        out = {}
+        for (f1, f2), (coef, chi2) in zip(pairs, fits):
+            colorresult = colors[(f1, f2)]
+            color_val, color_err = colorresult['color_val'], colorresult['color_err']
+            # is it significantly bluer?
+            mean_color = np.mean(color_val[:-1])
+            is_bluer = int(color_val[-1] + color_err[-1] < mean_color)
+            colorresult.update({
+                'quantity': 'color',
+                'label': '{0}-{1}'.format(self.colordict[f1], self.colordict[f2]),
+                'color_ave': self.history_mean_mag(f1) - self.history_mean_mag(f2),
+                'poly_coef': coef,
+                'poly_chi2': chi2,
+            })
+            colorresult['bayesian_blocks'] = self.estimate_bayesian_blocks(
+                x=colorresult['jds_val'], y=color_val, yerr=color_err)
+            self.serialize(colorresult)
+            colorresult['is_bluer'] = is_bluer
+            self.results[colorresult['label']] = colorresult
+            if colorresult['label'] not in self.available_colors:
+                self.available_colors.append(colorresult['label'])
+            out[colorresult['label']] = colorresult
+        return out
+
     def estimate_excitement(self):
         '''
         check variables to assess how exciting the alert is
@@ -320,17 +547,52 @@ class T2BlazarProducts(AbsT2Unit):
         """
 
         self.run_config = run_config if run_config is not None else self.base_config
-        self.min_jd = np.min(light_curve.get_values('jd'))
-        self.max_jd = np.max(light_curve.get_values('jd'))
+        # the unit serves the run configs of all the channels: the first one
+        # enabling instrumentation or profiling sets it up for all of them
+        if not self.instrumentation.enabled and self.run_config.get('instrumentation'):
+            self.instrumentation = Instrumentation.from_config(
+                self.__class__.__name__, self.run_config['instrumentation'], self.logger)
+        if not self.profiler.enabled and self.run_config.get('profiling'):
+            self.profiler = CallProfiler.from_config(
+                self.__class__.__name__, self.run_config['profiling'], self.logger)
+        # profiled calls are attributed to the transient state
+        key = '{0}:{1}'.format(getattr(light_curve, 'tran_id', None),
+                               getattr(light_curve, 'compound_id', None))
+        with self.instrumentation.timer('run'), \
+                self.profiler.profile(key, (light_curve, run_config)):
+            self._run(light_curve)
+        self.instrumentation.incr('runs')
+        self.instrumentation.maybe_flush()
+
+        return self.results
+
+    def _run(self, light_curve):
+        """
+        Compute the photometry and colors of all the available bands
+        and the excitement score. Fills self.results.
+        """
+        # nothing is carried over from the previous light curve
+        self.results = dict()
+        self.available_photom = []
+        self.available_colors = []
         self.classify_in_filters(light_curve)
+        self.min_jd = np.min(self.lc.jd)
+        self.max_jd = np.max(self.lc.jd)
+        self.select_fit_points()
 
         for color in self.available_bands:
-            photresult = self.photometry_estimation(color)
+            with self.instrumentation.timer('photometry'):
+                photresult = self.photometry_estimation(color)
 
-        for (color1, color2) in itertools.combinations(self.available_bands, 2):
-            colorresult = self.color_estimation(color1, color2, max_jdtimediff=1)
+        if self.run_config.get('color_engine', 'pairs') == 'epochs':
+            with self.instrumentation.timer('color'):
+                self.epoch_color_estimation()
+        else:
+            for (color1, color2) in itertools.combinations(self.available_bands, 2):
+                with self.instrumentation.timer('color'):
+                    colorresult = self.color_estimation(color1, color2, max_jdtimediff=1)
 
         self.estimate_excitement()
-
-        return self.results
+        self.logger.info("Photometry %s, colors %s, excitement %.2f",
+            self.available_photom, self.available_colors, self.results['excitement'])
 
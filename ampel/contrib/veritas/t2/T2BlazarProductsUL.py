@@ -0,0 +1,11 @@
+from ampel.contrib.veritas.t2.T2BlazarProducts import T2BlazarProducts
+
+
+class T2BlazarProductsUL(T2BlazarProducts):
+    """
+    T2BlazarProducts with the upper limits loaded with the light curves,
+    to be used with the 'upper_limits' run config parameter. Loading the
+    upper limits has a cost for every run, so it is left to the channels
+    asking for them.
+    """
+    upperLimits = True
@@ -8,18 +8,16 @@
 # Last Modified By  : matteo.giomi@desy.de
 
 import logging
-from pymongo import MongoClient
-from astropy.coordinates import SkyCoord
-from astropy.table import Table
 
 from ampel.base.abstract.AbsT2Unit import AbsT2Unit
 #from ampel.core.flags.T2RunStates import T2RunStates
 from ampel.contrib.hu.utils import info_as_debug
+from ampel.contrib.veritas.instrumentation import Instrumentation
+from ampel.contrib.veritas.catalogs import CatalogManager
+from ampel.contrib.veritas.t2.lcarrays import get_lc_arrays
 
-from extcats import CatalogQuery
-from extcats.catquery_utils import get_closest
-from numpy import asarray, degrees
-from ampel.contrib.hu import catshtm_server
+# pymongo, extcats, catsHTM and astropy are imported where they are first
+# needed, to keep the import of this module cheap.
 
 class T2CatalogMatch(AbsT2Unit):
 	"""
@@ -40,8 +38,25 @@ class T2CatalogMatch(AbsT2Unit):
 		# empty dict of suppoerted (AS WELL AS REQUESTED) extcats catalog query objects
 		self.catq_objects = {}
 		
+		# per-catalog field extractors, see get_field_extractor
+		self.field_extractors = {}
+		
+		# optional manager reloading the extcats catalogs on version change,
+		# set up at the first run with a 'catalog_reload' run config entry
+		self.catalog_manager = None
+		self.catq_kwargs_by_catalog = {}
+		# snapshot of the catalogs used for the whole current run
+		self.snapshot = None
+		
+		# optional asyncio backend of the extcats queries, set up at the first
+		# run with an 'async_catalogs' run config entry
+		self.async_backend = None
+		self.async_timeout = None
+		
 		# initialize the catsHTM paths and the extcats query client.
+		from pymongo import MongoClient
 		if 'catsHTM.default' in self.base_config:
+			from ampel.contrib.hu import catshtm_server
 			self.catshtm_client 			= catshtm_server.get_client(self.base_config['catsHTM.default'])
 		if 'extcats.reader' not in self.base_config:
 			self.catq_client = MongoClient()
@@ -59,6 +74,10 @@ class T2CatalogMatch(AbsT2Unit):
 		
 		# mandatory keys
 		self.mandatory_keys = ['use', 'rs_arcsec']
+		
+		# timing and counters (no-op unless enabled)
+		self.instrumentation = Instrumentation.from_config(
+			self.__class__.__name__, self.base_config.get('instrumentation'), self.logger)
 
 	def init_extcats_query(self, catalog, catq_kwargs=None):
 		"""
@@ -73,6 +92,25 @@ class T2CatalogMatch(AbsT2Unit):
 			
 		"""
 		
+		# the manager keeps its own (reloadable) CatalogQuery instances
+		if self.catalog_manager is not None:
+			self.catq_kwargs_by_catalog.setdefault(catalog, catq_kwargs)
+			if self.snapshot is None or catalog not in self.snapshot.queries:
+				# first use of the catalog: load it and take the new snapshot
+				self.catalog_manager.get(catalog)
+				self.snapshot = self.catalog_manager.snapshot
+			return self.snapshot.queries[catalog]
+		
+		# blocking facades of the asyncio queries, see init_async_catalogs
+		if self.async_backend is not None:
+			catq = self.catq_objects.get(catalog)
+			if catq is None:
+				from ampel.contrib.veritas.asynccatalogs import SyncCatalogQuery
+				catq = SyncCatalogQuery(
+					self.async_backend.query(catalog, **self.merge_catq_kwargs(catq_kwargs)), self.async_timeout)
+				self.catq_objects[catalog] = catq
+			return catq
+		
 		# check if the catalog exist as an extcats database
 		if not catalog in self.catq_client.list_database_names():
 			raise ValueError("cannot find %s among installed extcats catalogs"%(catalog))
@@ -82,15 +120,11 @@ class T2CatalogMatch(AbsT2Unit):
 		if catq is None:
 			self.logger.debug("CatalogQuery object not previously instantiated. Doing it now.")
 			
-			# add catalog specific arguments to the general ones
-			if catq_kwargs is None:
-				catq_kwargs = self.catq_kwargs_global
-			else:
-				merged_kwargs = self.catq_kwargs_global.copy()
-				merged_kwargs.update(catq_kwargs)
+			merged_kwargs = self.merge_catq_kwargs(catq_kwargs)
 			self.logger.debug("Using arguments: %s"%repr(merged_kwargs))
 			
 			# init the catalog query and remember it
+			from extcats import CatalogQuery
 			catq = CatalogQuery.CatalogQuery(catalog, **merged_kwargs)
 			self.catq_objects[catalog] = catq
 			return catq
@@ -98,6 +132,200 @@ class T2CatalogMatch(AbsT2Unit):
 			self.logger.debug("CatalogQuery object for catalog %s already exists."%catalog)
 			return catq
 
+	def merge_catq_kwargs(self, catq_kwargs=None):
+		"""
+			add catalog specific CatalogQuery arguments to the general ones
+		"""
+		merged_kwargs = self.catq_kwargs_global.copy()
+		if catq_kwargs is not None:
+			merged_kwargs.update(catq_kwargs)
+		return merged_kwargs
+
+	def init_catalog_manager(self, poll_interval=600, version_file=None):
+		"""
+			Set up the CatalogManager polling the catalog versions and swapping
+			in new CatalogQuery instances when a catalog is updated.
+		"""
+		self.catalog_manager = CatalogManager.for_extcats(
+			self.catq_client,
+			catq_kwargs=lambda catalog: self.merge_catq_kwargs(self.catq_kwargs_by_catalog.get(catalog)),
+			version_file=version_file, poll_interval=poll_interval, logger=self.logger)
+
+	def init_async_catalogs(self, timeout=None, **kwargs):
+		"""
+			Query the extcats catalogs through the asyncio backend shared by
+			the units of the process (see ampel.contrib.veritas.asynccatalogs),
+			so that the queries of all the catalogs are in flight at once.
+			kwargs are passed to AsyncCatalogBackend (max_pool_size, max_in_flight).
+		"""
+		from ampel.contrib.veritas.asynccatalogs import get_backend
+		self.async_backend = get_backend(self.base_config.get('extcats.reader'), logger=self.logger, **kwargs)
+		self.async_timeout = timeout
+		# the blocking CatalogQuery objects are replaced
+		self.catq_objects = {}
+
+	def extcats_projection(self, catq, keys_to_append):
+		"""
+			have mongo return just the requested fields (and the coordinates)
+		"""
+		if keys_to_append == 'all':
+			return {}
+		projection = {key: 1 for key in keys_to_append}
+		projection.update({catq.ra_key: 1, catq.dec_key: 1, '_id': 0})
+		return {'projection': projection}
+
+	def submit_extcats_queries(self, catalogs, transient_ra, transient_dec):
+		"""
+			send the queries of all the extcats catalogs at once, if they go
+			through the asyncio backend.
+			
+			Returns:
+			--------
+				
+				dict of futures of the (src, dist) results by catalog (empty if
+				the backend is not used).
+		"""
+		if self.async_backend is None or self.catalog_manager is not None:
+			return {}
+		futures = {}
+		for catalog, cat_opts in catalogs.items():
+			if cat_opts.get('use') != 'extcats' or 'rs_arcsec' not in cat_opts:
+				continue
+			catq = self.init_extcats_query(catalog, catq_kwargs=cat_opts.get('catq_kwargs'))
+			futures[catalog] = catq.submit_findclosest(transient_ra, transient_dec, cat_opts['rs_arcsec'],
+				**self.extcats_projection(catq, cat_opts.get('keys_to_append', 'all')))
+		return futures
+
+	def init_catshtm_client(self, **kwargs):
+		"""
+			Replace the catshtm_server client by a CatsHTMClient keeping
+			several cone searches in flight (see ampel.contrib.veritas.catshtm).
+			kwargs are passed to CatsHTMClient (pool_size, timeout).
+		"""
+		from ampel.contrib.veritas.catshtm import CatsHTMClient
+		self.catshtm_client = CatsHTMClient(self.base_config['catsHTM.default'], logger=self.logger, **kwargs)
+
+	def submit_catshtm_queries(self, catalogs, transient_ra, transient_dec):
+		"""
+			send the cone searches of all the catsHTM catalogs at once, if
+			the client supports pipelining.
+			
+			Returns:
+			--------
+				
+				dict of request ids by catalog (empty if not pipelining).
+		"""
+		client = getattr(self, 'catshtm_client', None)
+		if not hasattr(client, 'submit'):
+			return {}
+		from numpy import radians
+		return {catalog: client.submit(
+					catalog, radians(transient_ra), radians(transient_dec), cat_opts['rs_arcsec'])
+				for catalog, cat_opts in catalogs.items()
+				if cat_opts.get('use') == 'catsHTM' and 'rs_arcsec' in cat_opts}
+
+	def cancel_queries(self, catshtm_req_ids, extcats_futures):
+		"""
+			cancel the submitted catsHTM requests and extcats queries whose
+			result was not collected (no-op for the collected ones).
+		"""
+		for req_id in catshtm_req_ids.values():
+			self.catshtm_client.cancel(req_id)
+		for future in extcats_futures.values():
+			future.cancel()
+
+	def query_catalog(self, catalog, cat_opts, transient_ra, transient_dec, catshtm_req_id=None,
+		extcats_future=None):
+		"""
+			find the closest counterpart of the transient in the given catalog.
+			For catsHTM catalogs, the reply to an already submitted request
+			(see submit_catshtm_queries) can be given by its id, and for extcats
+			catalogs the future of an already submitted query (see
+			submit_extcats_queries).
+			
+			Returns:
+			--------
+				
+				(src, dist) tuple, with src being None if no match is found.
+		"""
+		src, dist = None, None
+		keys_to_append = cat_opts.get('keys_to_append', 'all')
+		
+		# how do you want to support the catalog?
+		use = cat_opts.get('use')
+		if use == 'extcats':
+			
+			# get the catalog query object and do the query. If only some fields
+			# are requested, have mongo return just those (and the coordinates).
+			if extcats_future is not None:
+				src, dist = extcats_future.result(self.async_timeout)
+			else:
+				catq = self.init_extcats_query(catalog, catq_kwargs=cat_opts.get('catq_kwargs'))
+				src, dist = catq.findclosest(transient_ra, transient_dec, cat_opts['rs_arcsec'],
+					**self.extcats_projection(catq, keys_to_append))
+		elif use == 'catsHTM':
+			from astropy.coordinates import SkyCoord
+			from astropy.table import Table
+			from extcats.catquery_utils import get_closest
+			from numpy import asarray, degrees
+			
+			# catshtm needs coordinates in radians
+			transient_coords = SkyCoord(transient_ra, transient_dec, unit='deg')
+			if catshtm_req_id is not None:
+				srcs, colnames, colunits = self.catshtm_client.result(catshtm_req_id)[0]
+			else:
+				srcs, colnames, colunits = self.catshtm_client.cone_search(
+												catalog,
+												transient_coords.ra.rad, transient_coords.dec.rad,
+												cat_opts['rs_arcsec'])
+			if len(srcs) > 0:
+				
+				# find out how ra/dec are called in the catalog
+				catq_kwargs = cat_opts.get('catq_kwargs')
+				if catq_kwargs is None:
+					ra_key, dec_key = 'ra', 'dec'
+				else:
+					ra_key, dec_key = catq_kwargs.get('ra_key', 'ra'), catq_kwargs.get('dec_key', 'dec')
+				
+				# format to astropy Table, keeping only the needed columns
+				srcs = asarray(srcs)
+				if keys_to_append != 'all':
+					keep = [i for i, name in enumerate(colnames)
+						if name in keys_to_append or name in (ra_key, dec_key)]
+					srcs, colnames = srcs[:, keep], [colnames[i] for i in keep]
+				srcs_tab = Table(srcs, names=colnames)
+
+				# get the closest source and its distance (catsHTM stuff is in radians)
+				srcs_tab[ra_key]  = degrees(srcs_tab[ra_key])
+				srcs_tab[dec_key] = degrees(srcs_tab[dec_key])
+				src, dist = get_closest(transient_coords.ra.degree, transient_coords.dec.degree, srcs_tab, ra_key, dec_key)
+		else:
+			message = "use option can not be %s for catalog %s. valid are 'extcats' or 'catsHTM'"%(use, catalog)
+			raise ValueError(message)
+		return src, dist
+
+	def get_field_extractor(self, catalog, colnames, keys_to_append):
+		"""
+			Return a function converting a matched catalog row into a dict
+			of python values for the requested fields. The column positions
+			are resolved once per catalog and column layout, and the whole
+			row is converted with a single call.
+		"""
+		colnames = tuple(colnames)
+		fields = colnames if keys_to_append == 'all' else tuple(keys_to_append)
+		key = (catalog, colnames, fields)
+		extractor = self.field_extractors.get(key)
+		if extractor is None:
+			missing = [field for field in fields if field not in colnames]
+			if missing:
+				raise KeyError("fields %s not found in catalog %s"%(missing, catalog))
+			index = [(field, colnames.index(field)) for field in fields]
+			def extractor(src):
+				values = src.as_void().tolist()
+				return {field: values[i] for field, i in index}
+			self.field_extractors[key] = extractor
+		return extractor
+
 	def run(self, light_curve, run_config):
 		""" 
 			Parameters
@@ -191,15 +419,61 @@ class T2CatalogMatch(AbsT2Unit):
 				
 				Note that, when a match is found, the distance of the lightcurve object
 				to the catalog counterpart is also returned as the 'dist2transient' key.
+				
+				If the run config contains a 'catalog_reload' dict (arguments of
+				init_catalog_manager, e.g. {'poll_interval': 600}), the extcats catalogs
+				are reloaded when their version changes, and the version used for each
+				match is returned as the 'catalog_version' key.
+				
+				If the run config contains a 'catshtm_client' dict (arguments of
+				init_catshtm_client, e.g. {'pool_size': 4}), the catsHTM cone searches
+				of all the catalogs are sent at once to a server running
+				ampel.contrib.veritas.catshtm.CatsHTMServer, and collected while the
+				extcats catalogs are queried.
+				
+				If the run config contains an 'async_catalogs' dict (arguments of
+				init_async_catalogs, e.g. {'max_pool_size': 50, 'timeout': 30}), the
+				extcats queries of all the catalogs are sent at once through the
+				asyncio Mongo backend shared by the units of the process (not used
+				together with 'catalog_reload').
 		"""
 		
+		if self.catalog_manager is None and run_config.get('catalog_reload'):
+			self.init_catalog_manager(**run_config['catalog_reload'])
+		if run_config.get('async_catalogs') and self.async_backend is None:
+			self.init_async_catalogs(**run_config['async_catalogs'])
+		if run_config.get('catshtm_client') and not hasattr(getattr(self, 'catshtm_client', None), 'submit'):
+			self.init_catshtm_client(**run_config['catshtm_client'])
+		# the unit serves the run configs of all the channels: the first one
+		# enabling instrumentation sets it up for all of them
+		if not self.instrumentation.enabled and run_config.get('instrumentation'):
+			self.instrumentation = Instrumentation.from_config(
+				self.__class__.__name__, run_config['instrumentation'], self.logger)
+		# one consistent set of catalogs (and versions) for the whole run
+		self.snapshot = self.catalog_manager.snapshot if self.catalog_manager is not None else None
+		with self.instrumentation.timer('run'):
+			out_dict = self._run(light_curve, run_config)
+		self.instrumentation.maybe_flush()
+		return out_dict
+
+	def _run(self, light_curve, run_config):
+		"""
+			match the transient position against each of the configured catalogs.
+			See the run method for the description of the run config.
+		"""
 		# get ra and dec from lightcurve object
 		lc_get_pos_kwargs = run_config.get('lc_get_pos_kwargs')
 		if lc_get_pos_kwargs is None:
 			lc_get_pos_kwargs = self.lc_get_pos_defaults
 		self.logger.debug("getting transient position from lightcurve using args: %s"%lc_get_pos_kwargs)
 		try:
-			transient_ra, transient_dec = light_curve.get_pos(**lc_get_pos_kwargs)
+			with self.instrumentation.timer('get_pos'):
+				if lc_get_pos_kwargs.get('filters') is None:
+					# use the arrays shared with the other T2s of this compound
+					transient_ra, transient_dec = get_lc_arrays(light_curve).get_pos(
+						lc_get_pos_kwargs.get('ret', 'brightest'))
+				else:
+					transient_ra, transient_dec = light_curve.get_pos(**lc_get_pos_kwargs)
 		except IndexError:
 			raise NotImplemented
 			#return T2RunStates.MISSING_INFO # TODO change me back !
@@ -208,77 +482,49 @@ class T2CatalogMatch(AbsT2Unit):
 		# initialize the catalog quer(ies). Use instance variable to aviod duplicates
 		out_dict = {}
 		catalogs = run_config.get('catalogs')
-		for catalog, cat_opts in catalogs.items():
-			src, dist = None, None
-			self.logger.debug("Loading catalog %s using options: %s"%(catalog, str(cat_opts)))
+		catshtm_req_ids, extcats_futures = {}, {}
+		try:
+			catshtm_req_ids = self.submit_catshtm_queries(catalogs, transient_ra, transient_dec)
+			extcats_futures = self.submit_extcats_queries(catalogs, transient_ra, transient_dec)
+			for catalog, cat_opts in catalogs.items():
+				src, dist = None, None
+				self.logger.debug("Loading catalog %s using options: %s"%(catalog, str(cat_opts)))
 			
-			# check options:
-			for opt_key in self.mandatory_keys:
-				if not opt_key in cat_opts.keys():
-					message = ("options for catalog %s are missing mandatory %s argument. Check your run config."%
-						(catalog, opt_key))
-					raise KeyError(message)
+				# check options:
+				for opt_key in self.mandatory_keys:
+					if not opt_key in cat_opts.keys():
+						message = ("options for catalog %s are missing mandatory %s argument. Check your run config."%
+							(catalog, opt_key))
+						raise KeyError(message)
 			
-			# how do you want to support the catalog?
-			use = cat_opts.get('use')
-			if use == 'extcats':
-				
-				# get the catalog query object and do the query
-				catq = self.init_extcats_query(catalog, catq_kwargs=cat_opts.get('catq_kwargs'))
-				src, dist = catq.findclosest(transient_ra, transient_dec, cat_opts['rs_arcsec'])
-			elif use == 'catsHTM':
-				
-				# catshtm needs coordinates in radians
-				transient_coords = SkyCoord(transient_ra, transient_dec, unit='deg')
-				srcs, colnames, colunits = self.catshtm_client.cone_search(
-													catalog,
-													transient_coords.ra.rad, transient_coords.dec.rad,
-													cat_opts['rs_arcsec'])
-				if len(srcs) > 0:
-					
-					# format to astropy Table
-					srcs_tab = Table(asarray(srcs), names=colnames)
-					
-					# find out how ra/dec are called in the catalog
-					catq_kwargs = cat_opts.get('catq_kwargs')
-					if catq_kwargs is None:
-						ra_key, dec_key = 'ra', 'dec'
-					else:
-						ra_key, dec_key = catq_kwargs.get('ra_key', 'ra'), catq_kwargs.get('dec_key', 'dec')
-
-					# get the closest source and its distance (catsHTM stuff is in radians)
-					srcs_tab[ra_key]  = degrees(srcs_tab[ra_key])
-					srcs_tab[dec_key] = degrees(srcs_tab[dec_key])
-					src, dist = get_closest(transient_coords.ra.degree, transient_coords.dec.degree, srcs_tab, ra_key, dec_key)
-			else:
-				message = "use option can not be %s for catalog %s. valid are 'extcats' or 'catsHTM'"%(use, catalog)
-				raise ValueError(message)
+				# how do you want to support the catalog?
+				with self.instrumentation.timer('catalog.' + catalog):
+					src, dist = self.query_catalog(catalog, cat_opts, transient_ra, transient_dec,
+						catshtm_req_ids.get(catalog), extcats_futures.get(catalog))
 			
-			# now add the results to the output dictionary
-			out_dict_catalog = {}
-			if not src is None:
-				self.logger.debug("found counterpart %.2f arcsec away from transient."%dist)
-				# if you found a cp add the required field from the catalog:
-				# if keys_to_append argument is given or if it is equal to 'all'
-				# then take all the columns in the catalog. Otherwise only add the 
-				# requested ones.
-				out_dict[catalog] = {'dist2transient': dist}
-				keys_to_append = cat_opts.get('keys_to_append', 'all')
-				if keys_to_append == 'all':
-					keys_to_append = src.colnames
-				if len(keys_to_append) > 0:
-					to_add = {}
-					for field in keys_to_append:
-						try:
-							val = src[field].tolist()
-						except AttributeError:
-							val = src[field]
-						to_add[field] = val
-					out_dict[catalog].update(to_add)
-			else:
-				self.logger.debug("no match found in catalog %s within %.2f arcsec from transient"%
-					(catalog, cat_opts['rs_arcsec']))
-				out_dict[catalog] = False
+				# now add the results to the output dictionary
+				out_dict_catalog = {}
+				if not src is None:
+					self.logger.debug("found counterpart %.2f arcsec away from transient."%dist)
+					self.instrumentation.incr('matched.' + catalog)
+					# if you found a cp add the required field from the catalog:
+					# if keys_to_append argument is given or if it is equal to 'all'
+					# then take all the columns in the catalog. Otherwise only add the 
+					# requested ones.
+					out_dict[catalog] = {'dist2transient': dist}
+					if self.catalog_manager is not None and cat_opts.get('use') == 'extcats':
+						out_dict[catalog]['catalog_version'] = self.snapshot.versions.get(catalog)
+					keys_to_append = cat_opts.get('keys_to_append', 'all')
+					if len(keys_to_append) > 0:
+						extract = self.get_field_extractor(catalog, src.colnames, keys_to_append)
+						out_dict[catalog].update(extract(src))
+				else:
+					self.logger.debug("no match found in catalog %s within %.2f arcsec from transient"%
+						(catalog, cat_opts['rs_arcsec']))
+					out_dict[catalog] = False
+		finally:
+			# after a failure, drop the queries of the other catalogs still in flight
+			self.cancel_queries(catshtm_req_ids, extcats_futures)
 		
 		# return the info as dictionary
 		return out_dict
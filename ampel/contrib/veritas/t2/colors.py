@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t2/colors.py
+# License           : BSD-3-Clause
+
+import itertools
+
+import numpy as np
+
+from ampel.contrib.veritas.t2.lcarrays import BIN_ORIGIN
+
+
+class EpochTable(object):
+    """
+    Multi-band epochs of a light curve: the detections are sorted once by
+    time and grouped by night (or by bins of `width` days), and each band
+    of each epoch is averaged (inverse-variance weighted magnitude, plain
+    mean time). Arrays have the shape (n_epochs, n_bands), with nan where a
+    band has no detection in an epoch.
+    """
+    __slots__ = ('bands', 'jd', 'mag', 'err')
+
+    def __init__(self, points, width=1., origin=BIN_ORIGIN):
+        """
+        :param points: structured array with the fields jd, fid, magpsf, sigmapsf
+        :param width: epoch length in days
+        """
+        points = points[np.argsort(points['jd'], kind='stable')]
+        self.bands = np.unique(points['fid'])
+        _, epoch = np.unique(np.floor((points['jd'] - origin) / width), return_inverse=True)
+        epoch = epoch.ravel()
+        n_epochs, n_bands = (epoch[-1] + 1 if len(epoch) else 0), len(self.bands)
+        cell = epoch * n_bands + np.searchsorted(self.bands, points['fid'])
+        size = n_epochs * n_bands
+        count = np.bincount(cell, minlength=size)
+        weight = 1. / points['sigmapsf'] ** 2
+        wsum = np.bincount(cell, weight, minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.jd = (np.bincount(cell, points['jd'], minlength=size) / count).reshape(n_epochs, n_bands)
+            self.mag = (np.bincount(cell, weight * points['magpsf'], minlength=size) / wsum).reshape(n_epochs, n_bands)
+            self.err = (wsum ** -0.5).reshape(n_epochs, n_bands)
+        self.err[~np.isfinite(self.mag)] = np.nan
+
+    def __len__(self):
+        return len(self.jd)
+
+    def colors(self, pairs=None):
+        """
+        :param pairs: list of (band1, band2), default: all the pairs of bands
+        :return: dict of (band1, band2) -> dict of the arrays jds_val, jds_err,
+                 color_val, color_err over the epochs with both bands
+                 (pairs without common epoch are left out)
+        """
+        index = {int(band): i for i, band in enumerate(self.bands)}
+        if pairs is None:
+            pairs = itertools.combinations(sorted(index), 2)
+        out = {}
+        for band1, band2 in pairs:
+            i1, i2 = index[band1], index[band2]
+            both = np.isfinite(self.mag[:, i1]) & np.isfinite(self.mag[:, i2])
+            if not np.any(both):
+                continue
+            jd1, jd2 = self.jd[both, i1], self.jd[both, i2]
+            out[(band1, band2)] = {
+                'jds_val': (jd1 + jd2) / 2.,
+                'jds_err': np.abs(jd1 - jd2) / 2.,
+                'color_val': self.mag[both, i1] - self.mag[both, i2],
+                'color_err': np.hypot(self.err[both, i1], self.err[both, i2]),
+            }
+        return out
+
+
+def close_pairs(jd1, jd2, max_jdtimediff):
+    """
+    Pairs of times of two bands closer than max_jdtimediff, found by
+    binary search in the sorted jd2 instead of a len(jd1) x len(jd2)
+    matrix of time differences.
+    :return: (indices in jd1, indices in jd2) of the pairs of times
+             within max_jdtimediff, sorted by jd1 then jd2 index
+    """
+    order = np.argsort(jd2, kind='stable')
+    sjd2 = jd2[order]
+    # candidates in a slightly wider window, then the exact cut
+    margin = max_jdtimediff + 1e-6
+    lo = np.searchsorted(sjd2, jd1 - margin, side='left')
+    hi = np.searchsorted(sjd2, jd1 + margin, side='right')
+    counts = hi - lo
+    i1 = np.repeat(np.arange(len(jd1)), counts)
+    pos = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    i2 = order[pos]
+    keep = np.abs(jd1[i1] - jd2[i2]) <= max_jdtimediff
+    i1, i2 = i1[keep], i2[keep]
+    sort = np.lexsort((i2, i1))
+    return i1[sort], i2[sort]
+
+
+def batched_polyfit(xs, ys, deg):
+    """
+    Least-squares polynomial fits of several data sets at once, with the
+    same column scaling and singular value cutoff as numpy.polyfit.
+    :param xs, ys: lists of 1-d arrays (one per data set)
+    :param deg: degree of the polynomials
+    :return: (coefficients, highest power first, shape (n_sets, deg + 1),
+              residual sums of squares, nan where numpy.polyfit returns none)
+    """
+    n_sets, order = len(xs), deg + 1
+    lengths = np.array([len(x) for x in xs])
+    n_max = max(lengths.max() if n_sets else 0, 1)
+    # data sets padded with zero rows, which do not change the fits
+    valid = np.arange(n_max)[None, :] < lengths[:, None]
+    x = np.zeros((n_sets, n_max))
+    y = np.zeros((n_sets, n_max))
+    x[valid] = np.concatenate(xs) if n_sets else []
+    y[valid] = np.concatenate(ys) if n_sets else []
+    lhs = x[:, :, None] ** np.arange(deg, -1, -1)[None, None, :] * valid[:, :, None]
+    scale = np.sqrt(np.sum(lhs * lhs, axis=1))
+    scale[scale == 0] = 1.
+    lhs = lhs / scale[:, None, :]
+    u, s, vt = np.linalg.svd(lhs, full_matrices=False)
+    rcond = lengths * np.finfo(float).eps
+    keep = s > (rcond * s[:, 0])[:, None]
+    inv_s = np.where(keep, 1. / np.where(keep, s, 1.), 0.)
+    coef = np.einsum('pji,pj,pkj,pk->pi', vt, inv_s, u, y)
+    resid = np.sum((np.einsum('pkj,pj->pk', lhs, coef) - y) ** 2 * valid, axis=1)
+    # like numpy.linalg.lstsq, no residuals if rank deficient or not overdetermined
+    resid[(keep.sum(axis=1) < order) | (lengths <= order)] = np.nan
+    return coef / scale, resid
+
+
+def batched_iterative_polyfit(xs, ys, max_order):
+    """
+    Batched equivalent of T2BlazarProducts.iterative_polymodelfit: linear
+    fit, then higher orders (up to max_order + 1) kept while they reduce
+    the chi2 per degree of freedom by more than 20%.
+    :return: list of (coefficients, chi2 per dof), (None, None) for the
+             data sets with less than 3 points
+    """
+    lengths = np.array([len(x) for x in xs])
+    fits = {deg: batched_polyfit(xs, ys, deg) for deg in range(1, max_order + 2)
+            if np.any(lengths > deg + 1)}
+    out = []
+    for i, n in enumerate(lengths):
+        if n < 3:
+            out.append((None, None))
+            continue
+        coefs, resid = fits[1]
+        poly, chisq_dof = coefs[i], resid[i] / (n - 2)
+        for k in range(max_order):
+            if n > k + 3:
+                coefs, resid = fits[k + 2]
+                if np.isnan(resid[i]):
+                    break
+                chisq_dof_new = resid[i] / (n - (k + 3))
+                if chisq_dof_new < chisq_dof * 0.8:
+                    poly, chisq_dof = coefs[i], chisq_dof_new
+        out.append((poly, chisq_dof))
+    return out
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t2/lcarrays.py
+# License           : BSD-3-Clause
+
+import numpy as np
+
+from ampel.contrib.veritas.cache import LRUCache
+
+# photopoint fields extracted from the light curves
+FIELDS = ('jd', 'fid', 'magpsf', 'sigmapsf', 'ra', 'dec')
+DTYPE = np.dtype([('jd', 'f8'), ('fid', 'i1'), ('magpsf', 'f8'), ('sigmapsf', 'f8'),
+                  ('ra', 'f8'), ('dec', 'f8')])
+# upper limit fields
+UL_FIELDS = ('jd', 'fid', 'diffmaglim')
+UL_DTYPE = np.dtype([('jd', 'f8'), ('fid', 'i1'), ('diffmaglim', 'f8')])
+
+
+def _column(field):
+    return property(lambda self: self.points[field], doc="%s of all the points" % field)
+
+
+def _table(objects, fields, dtype):
+    rows = [tuple(obj.content.get(field) for field in fields) for obj in objects]
+    table = np.array(rows, dtype=float).reshape(len(rows), len(fields))
+    out = np.empty(len(rows), dtype=dtype)
+    for i, field in enumerate(fields):
+        out[field] = np.nan_to_num(table[:, i]) if field == 'fid' else table[:, i]
+    return out
+
+
+def _group_by_band(array):
+    """
+    :return: array sorted by fid (stable), dict of fid -> contiguous slice
+    """
+    array = array[np.argsort(array['fid'], kind='stable')]
+    fids, starts, counts = np.unique(array['fid'], return_index=True, return_counts=True)
+    return array, {int(fid): array[start:start + count]
+                   for fid, start, count in zip(fids, starts, counts) if fid > 0}
+
+
+class LightCurveArrays(object):
+    """
+    Compact view of the photopoints of a light curve: a structured numpy
+    array with the fields of DTYPE (41 bytes per point, missing values are
+    nan, or 0 for fid). The points are grouped by band, keeping their
+    light curve order within a band, so that each entry of `bands` is a
+    contiguous slice of `points`, i.e. a view rather than a copy.
+    The upper limits (fields of UL_DTYPE) are grouped the same way in
+    `uls` and `ul_bands`, sorted by time within a band.
+    """
+    __slots__ = ('points', 'bands', 'uls', 'ul_bands')
+
+    jd, fid, magpsf, sigmapsf, ra, dec = (_column(field) for field in FIELDS)
+
+    def __init__(self, points, uls=None):
+        """
+        :param points: structured array of dtype DTYPE, in light curve order
+        :param uls: optional structured array of dtype UL_DTYPE
+        """
+        self.points, self.bands = _group_by_band(points)
+        uls = np.empty(0, dtype=UL_DTYPE) if uls is None else uls
+        self.uls, self.ul_bands = _group_by_band(np.sort(uls, order='jd', kind='stable'))
+
+    @classmethod
+    def from_light_curve(cls, light_curve):
+        uls = getattr(light_curve, 'ulo_list', None) or []
+        return cls(_table(light_curve.ppo_list, FIELDS, DTYPE), _table(uls, UL_FIELDS, UL_DTYPE))
+
+    def __len__(self):
+        return len(self.jd)
+
+    def get_pos(self, ret='brightest'):
+        """
+        Equivalent of LightCurve.get_pos without band selection.
+        :param ret: 'brightest', 'latest' or 'mean'
+        :return: (ra, dec) of the transient
+        """
+        if len(self.jd) == 0:
+            raise IndexError("no photopoints in light curve")
+        if ret == 'brightest':
+            i = np.nanargmin(self.magpsf)
+        elif ret == 'latest':
+            i = np.nanargmax(self.jd)
+        elif ret == 'mean':
+            return float(np.nanmean(self.ra)), float(np.nanmean(self.dec))
+        else:
+            raise ValueError("ret must be 'brightest', 'latest' or 'mean', not %s" % ret)
+        return float(self.ra[i]), float(self.dec[i])
+
+
+# origin of the binning grid: JD x.25 is 18h UTC, daytime at Palomar,
+# so that with bins of one day all the points of a night share a bin
+BIN_ORIGIN = 0.25
+
+
+def bin_points(points, width, origin=BIN_ORIGIN):
+    """
+    Inverse-variance weighted average of the points falling in the same
+    time bin.
+    :param points: structured array of dtype DTYPE (e.g. one band group)
+    :param width: bin width in days
+    :return: structured array of dtype DTYPE with one point per non-empty
+             bin, sorted by time. jd, ra and dec are plain averages.
+    """
+    if len(points) == 0:
+        return points.copy()
+    keys = np.floor((points['jd'] - origin) / width)
+    _, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+    inv = inv.ravel()
+    count = np.bincount(inv)
+    weight = 1. / points['sigmapsf'] ** 2
+    wsum = np.bincount(inv, weight)
+    binned = np.empty(len(first), dtype=DTYPE)
+    binned['fid'] = points['fid'][first]
+    binned['magpsf'] = np.bincount(inv, weight * points['magpsf']) / wsum
+    binned['sigmapsf'] = wsum ** -0.5
+    for field in ('jd', 'ra', 'dec'):
+        binned[field] = np.bincount(inv, points[field]) / count
+    return binned
+
+
+def bin_upper_limits(uls, width, points=None, origin=BIN_ORIGIN):
+    """
+    Keep the deepest upper limit of each time bin, and drop the bins
+    holding a detection.
+    :param uls: structured array of dtype UL_DTYPE (e.g. one band group)
+    :param width: bin width in days
+    :param points: optional detections of the same band
+    :return: structured array of dtype UL_DTYPE, one limit per bin, sorted by time
+    """
+    if len(uls) == 0:
+        return uls.copy()
+    keys = np.floor((uls['jd'] - origin) / width)
+    order = np.lexsort((-uls['diffmaglim'], keys))
+    keys = keys[order]
+    # first of each bin is the deepest limit
+    first = np.concatenate(([True], keys[1:] != keys[:-1]))
+    binned = uls[order][first]
+    if points is not None and len(points):
+        detected = np.floor((points['jd'] - origin) / width)
+        binned = binned[~np.isin(keys[first], detected)]
+    return binned
+
+
+def summarize_points(points):
+    """
+    Aggregate statistics of a set of points, computed in one vectorized pass.
+    :return: dict of python numbers (n, sum and sum of squares of the
+             magnitudes, weighted mean magnitude and error, time range)
+    """
+    mag = points['magpsf']
+    weight = 1. / points['sigmapsf'] ** 2
+    wsum = float(np.sum(weight))
+    return {
+        'n': len(points),
+        'mag_sum': float(np.sum(mag)),
+        'mag_sumsq': float(np.sum(mag ** 2)),
+        'wmean_mag': float(np.sum(weight * mag) / wsum) if wsum > 0 else None,
+        'wmean_mag_err': wsum ** -0.5 if wsum > 0 else None,
+        'jd_first': float(np.min(points['jd'])) if len(points) else None,
+        'jd_last': float(np.max(points['jd'])) if len(points) else None,
+    }
+
+
+# arrays of the recently processed light curves, shared by all the T2 units
+# of the process. Compounds are immutable, so compound_id identifies the points.
+_cache = LRUCache(capacity=256)
+
+
+def get_lc_arrays(light_curve):
+    """
+    :return: LightCurveArrays of the light curve, built once per compound.
+             Units load the light curves with or without upper limits, so
+             an entry built without them is rebuilt for a light curve
+             carrying upper limits.
+    """
+    key = getattr(light_curve, 'compound_id', None)
+    if key is None:
+        return LightCurveArrays.from_light_curve(light_curve)
+    arrays = _cache.get(key)
+    if arrays is None or (len(arrays.uls) == 0 and getattr(light_curve, 'ulo_list', None)):
+        arrays = LightCurveArrays.from_light_curve(light_curve)
+        _cache.put(key, arrays)
+    return arrays
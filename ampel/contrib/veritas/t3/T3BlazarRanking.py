@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t3/T3BlazarRanking.py
+# License           : BSD-3-Clause
+
+import os
+import json
+import time
+import datetime
+import logging
+
+from ampel.base.abstract.AbsT3Unit import AbsT3Unit
+from ampel.pipeline.common.ZTFUtils import ZTFUtils
+from ampel.contrib.veritas.t3.ranking import TopK
+
+
+class T3BlazarRanking(AbsT3Unit):
+    """
+    Rank the transients of a channel by their T2BlazarProducts excitement
+    score and write a summary of the top K to a single json file per run.
+
+    The transients are consumed chunk by chunk and only the current top K
+    are kept, so that the memory use does not depend on the number of
+    transients. Each entry has the ZTF name, the excitement, the
+    is_brighter / is_bluer flags of each band and color, and the catalog
+    counterparts found by T2CatalogMatch.
+
+    run_config keys:
+        't2_unit_photometry': T2BlazarProducts unit id
+        't2_unit_catalog': T2CatalogMatch unit id (default 'CATALOGMATCH')
+        'top_k': number of transients in the summary (default 20)
+        'summary_path': output file, formatted with the run date
+                        (default 'blazar_ranking_{date}.json')
+    """
+
+    version = 0.1
+
+    def __init__(self, logger, base_config=None, run_config=None, global_info=None):
+        """
+        """
+        self.base_config = base_config
+        self.run_config = run_config
+        self.global_info = global_info
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        self.t2_unit_photometry = run_config['t2_unit_photometry']
+        self.t2_unit_catalog = run_config.get('t2_unit_catalog', 'CATALOGMATCH')
+        self.summary_path = run_config.get('summary_path', 'blazar_ranking_{date}.json')
+        self.top = TopK(run_config.get('top_k', 20))
+        self.channels = set()
+        self.t_start = time.time()
+
+    def t2_result(self, tran_view, unit_id):
+        """
+        :return: results of the given T2 unit for the transient, or None
+        """
+        for t2record in tran_view.t2records:
+            if t2record['t2_unit_id'] == unit_id and t2record['results']:
+                return t2record['results'][0]
+        return None
+
+    def summarize(self, tran_view, photometry):
+        """
+        :return: dict describing the transient in the ranking
+        """
+        flags = {}
+        for label, result in photometry.items():
+            if not isinstance(result, dict):
+                continue
+            if 'is_brighter' in result:
+                flags[label] = {'is_brighter': bool(result['is_brighter'])}
+            elif 'is_bluer' in result:
+                flags[label] = {'is_bluer': bool(result['is_bluer'])}
+
+        # keep only the catalogs with a counterpart
+        catalogs = self.t2_result(tran_view, self.t2_unit_catalog) or {}
+        associations = {catalog: match for catalog, match in catalogs.items() if match}
+
+        return {
+            'tran_id': tran_view.tran_id,
+            'ztf_name': str(ZTFUtils.to_ztf_id(tran_view.tran_id)),
+            'excitement': photometry.get('excitement'),
+            'flags': flags,
+            'associations': associations,
+        }
+
+    def add(self, transients):
+        """
+        """
+        if transients is None:
+            return
+        for tran_view in transients:
+            if isinstance(tran_view.channel, str):
+                self.channels.add(tran_view.channel)
+            photometry = self.t2_result(tran_view, self.t2_unit_photometry)
+            if photometry is None or photometry.get('excitement') is None:
+                continue
+            # the summary is only built for the transients entering the top K
+            self.top.push(photometry['excitement'],
+                          lambda: self.summarize(tran_view, photometry))
+
+    def done(self):
+        """
+        """
+        summary = {
+            'created': datetime.datetime.utcnow().isoformat(),
+            'channels': sorted(self.channels),
+            'n_ranked': self.top.n_seen,
+            'top': [dict(entry, rank=rank + 1) for rank, (score, entry) in enumerate(self.top.ranked())],
+        }
+        path = self.summary_path.format(date=datetime.date.today().strftime("%Y%m%d"))
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as outfile:
+            json.dump(summary, outfile, indent=1, default=str)
+        self.logger.info("Ranked {} transients in {:.1f} s, top {} written to {}".format(
+            self.top.n_seen, time.time() - self.t_start, len(self.top), path))
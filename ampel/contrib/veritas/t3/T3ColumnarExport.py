@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t3/T3ColumnarExport.py
+# License           : BSD-3-Clause
+
+import time
+import logging
+
+from ampel.base.abstract.AbsT3Unit import AbsT3Unit
+from ampel.contrib.veritas.export import ColumnarWriter, flatten
+
+
+class T3ColumnarExport(AbsT3Unit):
+    """
+    Export the T2BlazarProducts and T2CatalogMatch results of a channel as
+    a columnar dataset (npz, or parquet if pyarrow is installed), with one
+    row per transient state, for offline analysis with numpy or pandas.
+
+    The photometry results are stored under 'phot.<label>.<key>' and the
+    catalog matches under 'cat.<catalog>.<key>' (with a 'matched' flag).
+    Light curve arrays become ragged columns. Rows are written in chunks,
+    and each run appends new part files with only the states modified
+    since the previous export. A state is exported whole (photometry and
+    catalog matches) whenever any of its T2 results changed, so that a
+    state exported again appears in several parts: readers must keep the
+    last row of each compound_id.
+
+    run_config keys:
+        'output_dir': dataset directory
+        'format': 'npz' (default) or 'parquet'
+        'chunk_rows': rows per part file (default 10000)
+        't2_unit_photometry': T2BlazarProducts unit id
+        't2_unit_catalog': T2CatalogMatch unit id (default 'CATALOGMATCH')
+        'modified_since_last': only export the states whose T2 results
+                               changed since the last export (default True)
+        'timestamp_key': T2 record (or else latest result entry) key of the
+                         modification time (default 'dt'). The records
+                         without it are always exported, and counted.
+    """
+
+    version = 0.1
+
+    def __init__(self, logger, base_config=None, run_config=None, global_info=None):
+        """
+        """
+        self.base_config = base_config
+        self.run_config = run_config
+        self.global_info = global_info
+        self.logger = logger if logger is not None else logging.getLogger()
+
+        self.t2_unit_photometry = run_config['t2_unit_photometry']
+        self.t2_unit_catalog = run_config.get('t2_unit_catalog', 'CATALOGMATCH')
+        self.modified_since_last = run_config.get('modified_since_last', True)
+        self.timestamp_key = run_config.get('timestamp_key', 'dt')
+        self.writer = ColumnarWriter(run_config['output_dir'],
+                                     fmt=run_config.get('format', 'npz'),
+                                     chunk_rows=run_config.get('chunk_rows', 10000))
+        self.n_skipped = 0
+        self.n_untimed = 0
+        self.t_start = time.time()
+
+    def is_modified(self, t2record):
+        """
+        :return: True if the record changed since the last export
+        """
+        last_export = self.writer.last_export
+        if not self.modified_since_last or last_export is None:
+            return True
+        timestamp = t2record.get(self.timestamp_key)
+        if timestamp is None and isinstance(t2record['results'][-1], dict):
+            timestamp = t2record['results'][-1].get(self.timestamp_key)
+        if timestamp is None:
+            self.n_untimed += 1
+            return True
+        if hasattr(timestamp, 'timestamp'):
+            timestamp = timestamp.timestamp()
+        return timestamp > last_export
+
+    def state_rows(self, tran_view):
+        """
+        :return: dict of compound id -> row, one per transient state
+                 with any result modified since the last export
+        """
+        records = {}
+        for t2record in tran_view.t2records:
+            unit_id = t2record['t2_unit_id']
+            if unit_id not in (self.t2_unit_photometry, self.t2_unit_catalog) or not t2record['results']:
+                continue
+            records.setdefault(t2record.get('compound_id'), []).append(t2record)
+        rows = {}
+        for compound_id, t2records in records.items():
+            if not any(self.is_modified(t2record) for t2record in t2records):
+                self.n_skipped += 1
+                continue
+            rows[compound_id] = self.state_row(tran_view, compound_id, t2records)
+        return rows
+
+    def state_row(self, tran_view, compound_id, t2records):
+        """
+        :return: row of all the T2 results of one transient state
+        """
+        row = {
+            'tran_id': tran_view.tran_id,
+            'compound_id': None if compound_id is None else str(compound_id),
+        }
+        for t2record in t2records:
+            result = t2record['results'][0]
+            if t2record['t2_unit_id'] == self.t2_unit_photometry:
+                flatten(result, 'phot.', row)
+            else:
+                catalogs = {catalog: dict(match, matched=True) if match else {'matched': False}
+                            for catalog, match in result.items()}
+                flatten(catalogs, 'cat.', row)
+        return row
+
+    def add(self, transients):
+        """
+        """
+        if transients is None:
+            return
+        for tran_view in transients:
+            for row in self.state_rows(tran_view).values():
+                self.writer.append(row)
+
+    def done(self):
+        """
+        """
+        self.writer.close()
+        self.logger.info("Exported {} transient states ({} unchanged states skipped) in {:.1f} s to {}".format(
+            self.writer.n_rows, self.n_skipped, time.time() - self.t_start, self.writer.directory))
+        if self.n_untimed:
+            self.logger.warning("%d T2 records without '%s' timestamp were exported as modified",
+                                self.n_untimed, self.timestamp_key)
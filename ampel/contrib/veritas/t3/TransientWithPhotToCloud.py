@@ -12,6 +12,9 @@ import json
 import time
 import os
 import datetime
+import itertools
+import functools
+import threading
 from aiohttp import ClientSession, ClientTimeout
 from aiohttp.client_exceptions import ServerDisconnectedError, ClientConnectorError
 from asyncio import TimeoutError
@@ -22,12 +25,38 @@ from ampel.base.abstract.AbsT3Unit import AbsT3Unit
 from ampel.pipeline.common.ZTFUtils import ZTFUtils
 from ampel.archive import ArchiveDB
 from ampel.utils.json import AmpelEncoder, object_hook
+from ampel.contrib.veritas.instrumentation import Instrumentation
+from ampel.contrib.veritas.t3.journal import UploadJournal, IN_FLIGHT, DEFERRED
 
 
 
 class TransientWithPhotToCloud(AbsT3Unit):
     """
     Based on TransientWebPublisher
+
+    The uploads run on one event loop in a background thread, with a single
+    HTTP session kept for the whole job. add() only puts the interesting
+    transients of a chunk in a priority queue, so that the next chunk is
+    loaded while the previous one is uploaded. run_config['upload_concurrency']
+    workers (default 8) publish the queued transients by decreasing
+    excitement score (T2BlazarProducts), so that the most exciting ones reach
+    the cloud first. add() blocks while run_config['max_queued'] transients
+    (default 1000) are waiting. done() waits for all the uploads and closes
+    the session.
+
+    With run_config['deadline_minutes'], the transients still queued that
+    long after the first add() and whose excitement is below
+    run_config['defer_below_excitement'] (default 0.5) are deferred to the
+    next run (through the journal, see below, which is then required)
+    instead of being published.
+
+    With a run_config['journal'] dict (UploadJournal arguments, at least
+    'path', plus optional 'inline_attempts' and 'retry_poll'), every file
+    is recorded in a crash-safe journal. Unchanged files already uploaded
+    are skipped, an upload failing after inline_attempts tries (default 3)
+    is retried in the background instead of blocking its batch, and the
+    uploads left over by an interrupted run are resumed at the next one
+    (even if it has no transient to publish).
     """
 
     version = 0.1
@@ -43,6 +72,10 @@ class TransientWithPhotToCloud(AbsT3Unit):
         self.logger = logger
         self.count = 0
         self.dt = 0
+        self.instrumentation = Instrumentation.from_config(
+            self.__class__.__name__,
+            run_config.get('instrumentation') if run_config is not None else None,
+            self.logger)
 
         self.current_month = datetime.date.strftime(datetime.date.today,"%Y%m")
 
@@ -56,6 +89,78 @@ class TransientWithPhotToCloud(AbsT3Unit):
         self.existing_paths = set()
         self.archive = ArchiveDB(base_config['archive.reader'])
 
+        run_config = run_config if run_config is not None else {}
+        self.n_workers = run_config.get('upload_concurrency', 8)
+        self.max_queued = run_config.get('max_queued', 1000)
+        self.deadline = run_config.get('deadline_minutes')
+        self.defer_below = run_config.get('defer_below_excitement', 0.5)
+        self.queue = None
+        self.workers = []
+        self.errors = []
+        self._seq = itertools.count()
+        self.n_published = 0
+        self.n_deferred = 0
+        self.t_first = None
+        self.loop = None
+        self.loop_thread = None
+        self.session = None
+
+        self.journal = None
+        self.retry_task = None
+        journal_config = dict(run_config.get('journal') or {})
+        self.inline_attempts = journal_config.pop('inline_attempts', 3)
+        self.retry_poll = journal_config.pop('retry_poll', 10.)
+        if journal_config:
+            self.journal = UploadJournal(**journal_config)
+            self.logger.info("Upload journal: %s", self.journal.counts())
+        elif self.deadline is not None:
+            # the deferred transients are only kept in the journal
+            raise ValueError("deadline_minutes requires a journal to defer the transients to")
+
+    def start_loop(self):
+        """
+        start the event loop thread and open the HTTP session in it
+        """
+        self.t_start = time.time()
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(
+            target=self.loop.run_forever, name=self.__class__.__name__, daemon=True)
+        self.loop_thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self.open_session(), self.loop).result()
+        asyncio.run_coroutine_threadsafe(self.start_workers(), self.loop).result()
+        if self.journal is not None:
+            asyncio.run_coroutine_threadsafe(self.start_retries(), self.loop).result()
+
+    async def open_session(self):
+        # the session must be created from within its event loop
+        return ClientSession(auth=self.auth)
+
+    async def start_workers(self):
+        self.queue = asyncio.PriorityQueue(self.max_queued)
+        self.workers = [asyncio.ensure_future(self.upload_worker()) for i in range(self.n_workers)]
+
+    async def stop_workers(self):
+        """
+        wait until the queue is empty, then stop the workers
+        """
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def stop_loop(self):
+        """
+        close the HTTP session and stop the event loop thread
+        """
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        self.loop, self.loop_thread, self.session = None, None, None
+
     async def create_directory(self, session, path_parts, timeout=1.0):
         path = []
         while len(path_parts) > 0:
@@ -64,11 +169,13 @@ class TransientWithPhotToCloud(AbsT3Unit):
                 continue
 
             url = os.path.join(self.base_dest, *path)
-            resp = await session.request('HEAD', url)
+            with self.instrumentation.timer('http.HEAD'):
+                resp = await session.request('HEAD', url)
             OK = (200, 201)
             if not resp.status in OK:
                 for i in range(16):
-                    resp = await session.request('MKCOL', url)
+                    with self.instrumentation.timer('http.MKCOL'):
+                        resp = await session.request('MKCOL', url)
                     # in nextClould, rapid-fire MKCOL is unreliable
                     if resp.status in OK:
                         break
@@ -83,29 +190,122 @@ class TransientWithPhotToCloud(AbsT3Unit):
                 resp.raise_for_status()
             self.existing_paths.add(tuple(path))
 
-    async def put(self, session, url, data, timeout=1.0):
+    async def put(self, session, url, data, timeout=1.0, attempts=16):
         OK = (200, 201, 204)
-        for i in range(16):
+        resp, error = None, None
+        for i in range(attempts):
             try:
-                resp = await session.put(url, data=data)
+                with self.instrumentation.timer('http.PUT'):
+                    resp = await session.put(url, data=data)
                 if resp.status in OK:
                     break
                 elif resp.status not in (403, 405, 423):
                     resp.raise_for_status()
             except (ServerDisconnectedError, ClientConnectorError, TimeoutError) as e:
                 self.logger.error(e)
-                pass
-            finally:
+                error = e
+            # back off before the next attempt only
+            if i + 1 < attempts:
                 await asyncio.sleep(timeout)
                 timeout *= 1.5
+        self.instrumentation.incr('http.PUT.attempts', i + 1)
+        if resp is None:
+            raise error
         if not resp.status in OK:
             self.logger.critical("PUT {} failed with status {} after {} attempts".format(url, resp.status, i + 1))
         resp.raise_for_status()
 
+    async def upload(self, session, dir_parts, files):
+        """
+        create the directory and upload the files (dict of data by url).
+        With a journal, failures are recorded for a later retry instead of
+        being raised.
+        """
+        if self.journal is None:
+            await self.create_directory(session, list(dir_parts))
+            await asyncio.gather(*[self.put(session, url, data) for url, data in files.items()])
+            return
+
+        async def put(url, data):
+            try:
+                await self.put(session, url, data, attempts=self.inline_attempts)
+            except Exception as e:
+                await self.journal_call(self.journal.mark_failed, url, e, data)
+                self.instrumentation.incr('upload.deferred')
+                self.logger.warning("Upload of %s failed (%s), will retry later", url, e)
+            else:
+                await self.journal_call(self.journal.mark_done, url, data)
+
+        try:
+            await self.create_directory(session, list(dir_parts))
+        except Exception as e:
+            for url, data in files.items():
+                await self.journal_call(self.journal.mark_failed, url, e, data)
+            self.instrumentation.incr('upload.deferred', len(files))
+            self.logger.warning("Creating %s failed (%s), will retry later", '/'.join(dir_parts), e)
+            return
+        await asyncio.gather(*[put(url, data) for url, data in files.items()])
+
+    async def journal_call(self, method, *args, **kwargs):
+        """
+        run a journal method (blocking SQLite call) in the default executor,
+        not to stall the uploads of the event loop
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(method, *args, **kwargs))
+
+    async def start_retries(self):
+        self.retry_task = asyncio.ensure_future(self.retry_uploads())
+
+    async def finish_retries(self):
+        """
+        stop the background retries and make a last attempt for all the
+        pending and failed uploads. The remaining ones stay in the journal
+        for the next run.
+        """
+        self.retry_task.cancel()
+        try:
+            await self.retry_task
+        except asyncio.CancelledError:
+            pass
+        # uploads interrupted by the cancellation
+        await self.journal_call(self.journal.recover, states=(IN_FLIGHT,))
+        await self.retry_uploads(final=True)
+
+    async def retry_uploads(self, final=False):
+        """
+        Upload the pending files of the journal (left over by a previous
+        run) and retry the failed ones once their back-off delay is over.
+        Runs until cancelled, or makes a single pass over all the pending
+        and failed files if final is True.
+        """
+        while True:
+            items = await self.journal_call(self.journal.claim_due, now=float('inf') if final else None)
+            by_dir = {}
+            for url, dir_parts, data in items:
+                by_dir.setdefault(tuple(dir_parts), {})[url] = data
+            await asyncio.gather(*[self.upload(self.session, dir_parts, files)
+                                   for dir_parts, files in by_dir.items()])
+            self.instrumentation.incr('upload.retried', len(items))
+            if final:
+                return
+            if not items:
+                await asyncio.sleep(self.retry_poll)
+
     def transient_summary(self, tran_view):
         fields = ["tran_id", "flags", "journal", "latest_state"]
         return self.encoder.encode({k: getattr(tran_view, k) for k in fields})
 
+    def transient_excitement(self, tran_view):
+        """
+        :return: excitement score of the transient given by T2BlazarProducts
+                 (0 if not available)
+        """
+        for t2record in tran_view.t2records:
+            if t2record['t2_unit_id'] == self.run_config['t2_unit_photometry']:
+                return t2record['results'][0].get('excitement') or 0.
+        return 0.
+
     def transient_is_interesting(self,tran_view):
         is_interesting = False
         for t2record in tran_view.t2records:
@@ -126,44 +326,124 @@ class TransientWithPhotToCloud(AbsT3Unit):
                 break
         return(is_interesting)
         
-    async def publish_transient(self, session, tran_view):
+    def transient_files(self, tran_view):
+        """
+        :return: (ztf name, directory parts, dict of file contents by url)
+        """
         ztf_name = str(ZTFUtils.to_ztf_id(tran_view.tran_id))
         channel = tran_view.channel
         assert isinstance(channel, str), "Only single-channel transients are supported"
 
-        await self.create_directory(session, ['ZTF', channel, self.current_month, ztf_name])
-        base_dir = os.path.join(self.base_dest, 'ZTF', channel, self.current_month, ztf_name)
+        dir_parts = ['ZTF', channel, self.current_month, ztf_name]
+        base_dir = os.path.join(self.base_dest, *dir_parts)
 
-        tasks = [
-            self.put(session, base_dir + "/transient.json", data=self.transient_summary(tran_view)),
-            self.put(session, base_dir + "/dump.json", data=self.encoder.encode(tran_view)),
-        ]
+        files = {
+            base_dir + "/transient.json": self.transient_summary(tran_view),
+            base_dir + "/dump.json": self.encoder.encode(tran_view),
+        }
+        return ztf_name, dir_parts, files
 
-        await asyncio.gather(*tasks)
+    async def publish_transient(self, session, tran_view):
+        ztf_name, dir_parts, files = self.transient_files(tran_view)
+        if self.journal is not None:
+            # skip the files already uploaded with the same content, or in flight
+            enqueued = await asyncio.gather(*[
+                self.journal_call(self.journal.enqueue, url, dir_parts, data, state=IN_FLIGHT)
+                for url, data in files.items()])
+            files = {url: data for (url, data), new in zip(files.items(), enqueued) if new}
+            if not files:
+                return
+
+        await self.upload(session, dir_parts, files)
 
         self.logger.info(ztf_name)
 
-    async def publish_transient_batch(self, transients):
-        async with ClientSession(auth=self.auth) as session:
-            tasks = [self.publish_transient(session, tran_view) \
-                for tran_view in transients \
-                if self.transient_is_interesting(tran_view)]
+    async def defer_transient(self, tran_view, excitement):
+        """
+        leave the publication of a transient to the next run
+        """
+        ztf_name, dir_parts, files = self.transient_files(tran_view)
+        for url, data in files.items():
+            await self.journal_call(self.journal.enqueue, url, dir_parts, data, state=DEFERRED)
+        self.n_deferred += 1
+        self.instrumentation.incr('deferred')
+        self.logger.info("Deferred %s (excitement %.2f) past the deadline", ztf_name, excitement)
 
-            await asyncio.gather(*tasks)
+    def past_deadline(self):
+        return self.deadline is not None and time.time() > self.t_start + 60. * self.deadline
+
+    async def upload_worker(self):
+        """
+        publish the queued transients, most exciting first
+        """
+        while True:
+            neg_excitement, _, tran_view = await self.queue.get()
+            try:
+                if -neg_excitement < self.defer_below and self.past_deadline():
+                    await self.defer_transient(tran_view, -neg_excitement)
+                    continue
+                await self.publish_transient(self.session, tran_view)
+                self.n_published += 1
+                self.instrumentation.incr('published')
+                if self.t_first is None:
+                    self.t_first = time.time() - self.t_start
+                    self.instrumentation.observe('first_upload', self.t_first)
+            except Exception as e:
+                self.logger.exception("Publishing transient %s failed", tran_view.tran_id)
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    async def publish_transient_batch(self, transients):
+        """
+        queue the interesting transients, waiting if the queue is full
+        """
+        for tran_view in transients:
+            if self.transient_is_interesting(tran_view):
+                # ties are published in arrival order
+                await self.queue.put((-self.transient_excitement(tran_view), next(self._seq), tran_view))
 
     def add(self, transients):
         """
+        queue the interesting transients of a chunk for publication and
+        return, unless max_queued transients are still waiting
         """
         if transients is not None:
             batch_count = len(transients)
             self.count += batch_count
 
-            loop = asyncio.get_event_loop()
+            if self.loop is None:
+                self.start_loop()
             t0 = time.time()
-            loop.run_until_complete(self.publish_transient_batch(transients))
-            self.dt += time.time() - t0
+            asyncio.run_coroutine_threadsafe(self.publish_transient_batch(transients), self.loop).result()
+            self.instrumentation.observe('batch', time.time() - t0)
+            self.instrumentation.maybe_flush()
+            if self.errors:
+                raise self.errors.pop(0)
 
     def done(self):
         """
+        wait for the scheduled uploads, then close the session
         """
-        self.logger.info("Published {} transients in {:.1f} s".format(self.count, self.dt))
+        if self.journal is not None and self.loop is None:
+            # no transient in this run: still resume the uploads left in
+            # the journal by the previous ones
+            self.start_loop()
+        try:
+            if self.loop is not None:
+                asyncio.run_coroutine_threadsafe(self.stop_workers(), self.loop).result()
+            if self.retry_task is not None:
+                asyncio.run_coroutine_threadsafe(self.finish_retries(), self.loop).result()
+                self.retry_task = None
+        finally:
+            if self.loop is not None:
+                self.dt = time.time() - self.t_start
+            self.stop_loop()
+        self.logger.info("Published {} of {} transients in {:.1f} s (first after {} s), deferred {}".format(
+            self.n_published, self.count, self.dt,
+            None if self.t_first is None else round(self.t_first, 1), self.n_deferred))
+        if self.journal is not None:
+            self.logger.info("Upload journal: %s", self.journal.counts())
+        self.instrumentation.flush()
+        if self.errors:
+            raise self.errors.pop(0)
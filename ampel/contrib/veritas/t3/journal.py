@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t3/journal.py
+# License           : BSD-3-Clause
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+PENDING, IN_FLIGHT, DONE, FAILED = 'pending', 'in_flight', 'done', 'failed'
+# postponed to the next run
+DEFERRED = 'deferred'
+
+
+class UploadJournal(object):
+    """
+    Crash-safe record of the files to upload, kept in a SQLite database in
+    write-ahead-log mode.
+
+    Each file (keyed by its url) goes through the states pending ->
+    in_flight -> done, or failed (to be retried after a back-off delay).
+    Every transition is committed, so that after a crash the files left
+    in_flight are simply pending again, and files already uploaded with
+    the same content are not uploaded twice. Deferred files are left
+    aside until the journal is opened again by the next run.
+
+    A file enqueued again while in flight is not uploaded a second time
+    concurrently: a new content is stored, and the upload in flight then
+    ends in the pending state (see mark_done) to upload it next.
+    """
+
+    def __init__(self, path, retry_delay=60., max_retry_delay=3600.):
+        """
+        :param path: SQLite database file (created if needed)
+        :param retry_delay: seconds before the first retry of a failed upload,
+                            doubled at each failure up to max_retry_delay
+        """
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " url TEXT PRIMARY KEY, dir TEXT, data BLOB, digest TEXT, state TEXT,"
+            " attempts INTEGER DEFAULT 0, next_try REAL DEFAULT 0, error TEXT, updated REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS uploads_state ON uploads (state, next_try)")
+        self.recover()
+
+    def _execute(self, sql, args=()):
+        """
+        :return: (rows, number of rows modified), both read while holding
+                 the lock, as the connection is shared by several threads
+        """
+        with self._lock:
+            cursor = self.db.execute(sql, args)
+            return cursor.fetchall(), cursor.rowcount
+
+    def recover(self, states=(IN_FLIGHT, DEFERRED)):
+        """
+        put back the uploads interrupted by a crash (and the ones deferred
+        by the previous run) in the pending state
+        :return: number of recovered uploads
+        """
+        return self._execute("UPDATE uploads SET state=? WHERE state IN (%s)" % ','.join('?' * len(states)),
+                             (PENDING,) + tuple(states))[1]
+
+    @staticmethod
+    def digest(data):
+        if isinstance(data, str):
+            data = data.encode()
+        return hashlib.sha1(data).hexdigest()
+
+    def enqueue(self, url, dir_parts, data, state=PENDING):
+        """
+        Record a file to upload.
+        :param dir_parts: list of the directories to create for the file
+        :param data: content (str or bytes)
+        :param state: PENDING, IN_FLIGHT if the caller uploads the file
+                      itself, or DEFERRED to leave it to the next run
+        :return: False if the same content was already uploaded to url, or
+                 if the file is in flight (the caller must not upload it)
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        digest = self.digest(data)
+        with self._lock:
+            row = self.db.execute("SELECT state, digest FROM uploads WHERE url=?", (url,)).fetchone()
+            if row is not None and row[0] in (DONE, IN_FLIGHT) and row[1] == digest:
+                return False
+            if row is not None and row[0] == IN_FLIGHT:
+                # uploaded after the one in flight, see mark_done
+                self.db.execute("UPDATE uploads SET dir=?, data=?, digest=?, updated=? WHERE url=?",
+                                (json.dumps(dir_parts), data, digest, time.time(), url))
+                return False
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads (url, dir, data, digest, state, attempts, next_try, updated)"
+                " VALUES (?, ?, ?, ?, ?, 0, 0, ?)",
+                (url, json.dumps(dir_parts), data, digest, state, time.time()))
+        return True
+
+    def claim_due(self, limit=-1, now=None):
+        """
+        Mark as in flight the pending uploads and the failed uploads whose
+        retry delay is over.
+        :param limit: maximum number of uploads to claim (-1: no limit)
+        :param now: time to compare the retry times to (None: current time;
+                    use float('inf') to retry all the failed uploads)
+        :return: list of (url, dir_parts, data)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT url, dir, data FROM uploads WHERE state=? OR (state=? AND next_try<=?)"
+                " ORDER BY next_try LIMIT ?", (PENDING, FAILED, now, limit)).fetchall()
+            self.db.executemany("UPDATE uploads SET state=?, updated=? WHERE url=?",
+                                [(IN_FLIGHT, time.time(), row[0]) for row in rows])
+        return [(url, json.loads(dir_parts), bytes(data)) for url, dir_parts, data in rows]
+
+    def _replaced(self, url, data):
+        """
+        put back in the pending state an upload of data whose content was
+        replaced while in flight (to be called with the lock held)
+        :return: True if the content was replaced
+        """
+        if data is None:
+            return False
+        return self.db.execute("UPDATE uploads SET state=?, attempts=0, next_try=0, updated=?"
+                               " WHERE url=? AND state=? AND digest!=?",
+                               (PENDING, time.time(), url, IN_FLIGHT, self.digest(data))).rowcount > 0
+
+    def mark_done(self, url, data=None):
+        """
+        :param data: uploaded content, if given and replaced in the meantime
+                     (see enqueue), the new content is left pending
+        """
+        with self._lock:
+            if self._replaced(url, data):
+                return
+            # the digest is kept to recognize unchanged files, the content is dropped
+            self.db.execute("UPDATE uploads SET state=?, data=NULL, error=NULL, updated=? WHERE url=?",
+                            (DONE, time.time(), url))
+
+    def mark_failed(self, url, error=None, data=None):
+        with self._lock:
+            if self._replaced(url, data):
+                return
+            row = self.db.execute("SELECT attempts FROM uploads WHERE url=?", (url,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+            self.db.execute(
+                "UPDATE uploads SET state=?, attempts=?, next_try=?, error=?, updated=? WHERE url=?",
+                (FAILED, attempts, time.time() + delay, None if error is None else str(error),
+                 time.time(), url))
+
+    def next_retry(self):
+        """
+        :return: time of the next retry of a failed upload, or None
+        """
+        rows, _ = self._execute("SELECT MIN(next_try) FROM uploads WHERE state=?", (FAILED,))
+        return rows[0][0]
+
+    def counts(self):
+        """
+        :return: dict of the number of uploads by state
+        """
+        return dict(self._execute("SELECT state, COUNT(*) FROM uploads GROUP BY state")[0])
+
+    def purge(self, older_than):
+        """
+        forget the uploads done more than older_than seconds ago
+        """
+        self._execute("DELETE FROM uploads WHERE state=? AND updated<?", (DONE, time.time() - older_than))
+
+    def close(self):
+        with self._lock:
+            self.db.close()
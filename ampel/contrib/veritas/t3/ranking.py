@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# File              : ampel/contrib/veritas/t3/ranking.py
+# License           : BSD-3-Clause
+
+import heapq
+import itertools
+
+
+class TopK(object):
+    """
+    Keep the k items with the highest score seen in a stream, in O(k) memory.
+
+    The items are held in a min-heap, so that an item scoring below the
+    current k-th best is rejected in constant time. The item can be given
+    as a function, only called for the items entering the heap.
+    """
+
+    def __init__(self, k):
+        if k < 1:
+            raise ValueError("k must be positive")
+        self.k = k
+        self.heap = []
+        self.n_seen = 0
+        # ties keep the earliest item
+        self._seq = itertools.count(0, -1)
+
+    def threshold(self):
+        """
+        :return: minimum score needed to enter the heap (None if not full)
+        """
+        return self.heap[0][0] if len(self.heap) == self.k else None
+
+    def push(self, score, item):
+        """
+        :param item: the item, or a function without argument returning it
+        :return: True if the item is among the top k so far
+        """
+        self.n_seen += 1
+        if len(self.heap) == self.k and score <= self.heap[0][0]:
+            return False
+        entry = (score, next(self._seq), item() if callable(item) else item)
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        else:
+            heapq.heapreplace(self.heap, entry)
+        return True
+
+    def ranked(self):
+        """
+        :return: list of (score, item), best first
+        """
+        return [(score, item) for score, _, item in sorted(self.heap, reverse=True)]
+
+    def __len__(self):
+        return len(self.heap)
@@ -9,6 +9,9 @@ setup(name='ampel-contrib-veritas',
                 #'ampel.contrib.veritas.t3'],
       package_data = {'': ['*.json']},
       entry_points = {
+          'console_scripts' : [
+              'veritas-replay = ampel.contrib.veritas.t0.replay:main',
+          ],
           'ampel.channels' : [
               'veritas = ampel.contrib.veritas.channels:load_channels',
           ],
@@ -20,7 +23,8 @@ setup(name='ampel-contrib-veritas',
           ],
           'ampel.pipeline.t2.units' : [
               #'CATALOGMATCH = ampel.contrib.veritas.t2.T2CatalogMatch:T2CatalogMatch'
-              'T2BLAZARPRODUTCS = ampel.contrib.veritas.t2.T2BlazarProducts:T2BlazarProducts'
+              'T2BLAZARPRODUTCS = ampel.contrib.veritas.t2.T2BlazarProducts:T2BlazarProducts',
+              'T2BLAZARPRODUCTSUL = ampel.contrib.veritas.t2.T2BlazarProductsUL:T2BlazarProductsUL'
           ],
           #'ampel.pipeline.t3.jobs' : [
           #    'veritas = ampel.contrib.veritas.channels:load_t3_jobs',
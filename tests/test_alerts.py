@@ -0,0 +1,44 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.t0.alerts import AlertReader, FILTER_FIELDS
+
+import unittest
+import os
+import tarfile
+
+basedir=os.path.dirname(os.path.realpath(__file__)).replace("tests","")
+alertfilepath="{0}/tests/ztf_public_20190624".format(basedir)
+
+
+class TestAlertReader(unittest.TestCase):
+    def test_read(self):
+        reader = AlertReader()
+        with tarfile.open(alertfilepath + "_accepted") as tar:
+            members = [m for m in tar.getmembers() if m.name.endswith('.avro')]
+            for member in members:
+                alerts = reader.read(tar.extractfile(member).read())
+                self.assertEqual(len(alerts), 1)
+                alert = alerts[0]
+                self.assertEqual("%d.avro" % alert['candid'], os.path.basename(member.name))
+                self.assertEqual(set(alert.keys()), {'objectId', 'candid', 'candidate'})
+                self.assertEqual(set(alert['candidate'].keys()), set(FILTER_FIELDS) - {'ndet'})
+                self.assertEqual(alert['candidate']['candid'], alert['candid'])
+        # all the alerts share the same schema, parsed only once
+        self.assertEqual(len(reader._schemas), 1)
+
+    def test_read_lean(self):
+        reader = AlertReader()
+        with tarfile.open(alertfilepath + "_accepted") as tar:
+            member = [m for m in tar.getmembers() if m.name.endswith('.avro')][0]
+            data = tar.extractfile(member).read()
+        alert = reader.read_lean(data)[0]
+        self.assertEqual(alert.pps[0]['candid'], alert.candid)
+        full = alert.materialize()
+        self.assertEqual(full['candid'], alert.candid)
+        self.assertEqual(full['objectId'], alert.tran_id)
+        self.assertIn('cutoutScience', full)
+        self.assertEqual(full['candidate']['rb'], alert.pps[0]['rb'])
+
+
+if __name__ == '__main__':
+    unittest.main()
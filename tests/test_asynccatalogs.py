@@ -0,0 +1,121 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.asynccatalogs import AsyncCatalogBackend, SyncCatalogQuery, angular_distance, get_backend
+
+import unittest
+import asyncio
+import time
+import numpy as np
+
+
+class FakeCursor(object):
+    def __init__(self, coll, docs):
+        self.coll = coll
+        self.docs = docs
+
+    async def to_list(self, length):
+        self.coll.in_flight += 1
+        self.coll.max_in_flight = max(self.coll.max_in_flight, self.coll.in_flight)
+        await asyncio.sleep(self.coll.latency)
+        self.coll.in_flight -= 1
+        return self.docs
+
+
+class FakeCollection(object):
+    """
+    stand-in for an asyncio Mongo collection, evaluating the filters of
+    AsyncCatalogQuery on a list of sources
+    """
+    def __init__(self, srcs, latency=0.):
+        # positions stored as in the extcats catalog dumps
+        self.srcs = [dict(src, pos={'type': 'Point', 'coordinates': [
+                         src['ra'] if src['ra'] < 180. else src['ra'] - 360., src['dec']]})
+                     for src in srcs]
+        self.latency = latency
+        self.in_flight = self.max_in_flight = 0
+
+    def matches(self, src, query):
+        for key, cond in query.items():
+            if key == '$or':
+                if not any(self.matches(src, sub) for sub in cond):
+                    return False
+            elif '$geoWithin' in cond:
+                (lon, lat), radius = cond['$geoWithin']['$centerSphere']
+                lon_src, lat_src = src[key]['coordinates']
+                if angular_distance(lon, lat, lon_src, lat_src) > np.degrees(radius):
+                    return False
+            elif not cond.get('$gte', -np.inf) <= src[key] <= cond.get('$lte', np.inf):
+                return False
+        return True
+
+    def project(self, src, projection):
+        if any(projection.get(key) == 1 for key in projection):
+            return {key: src[key] for key in projection if projection[key] == 1 and key in src}
+        return {key: val for key, val in src.items() if projection.get(key, 1) != 0}
+
+    def find(self, query, projection):
+        return FakeCursor(self, [self.project(src, projection) for src in self.srcs if self.matches(src, query)])
+
+    async def find_one(self, query, projection):
+        docs = await self.find(query, projection).to_list(1)
+        return docs[0] if docs else None
+
+
+SRCS = [{'ra': 10., 'dec': 20., 'name': 'a'}, {'ra': 10.002, 'dec': 20., 'name': 'b'},
+        {'ra': 359.999, 'dec': -5., 'name': 'c'}, {'ra': 250., 'dec': 30., 'name': 'd'}]
+
+
+class TestAsyncCatalogs(unittest.TestCase):
+    def setUp(self):
+        self.coll = FakeCollection(SRCS, latency=0.02)
+        self.backend = AsyncCatalogBackend(client={'4FGL': {'srcs': self.coll}}, max_in_flight=8)
+
+    def tearDown(self):
+        self.backend.close()
+
+    def test_binaryserach(self):
+        for method in ('2dsphere', 'raw'):
+            catq = SyncCatalogQuery(self.backend.query('4FGL', method=method))
+            self.assertTrue(catq.binaryserach(10.001, 20., 10.))
+            self.assertFalse(catq.binaryserach(10.01, 20., 10.))
+            # across ra = 0
+            self.assertTrue(catq.binaryserach(0.001, -5., 10.))
+            # ra > 180, stored at a negative longitude
+            self.assertTrue(catq.binaryserach(250.001, 30., 10.))
+            self.assertFalse(catq.binaryserach(70.001, 30., 10.))
+
+    def test_findclosest(self):
+        for method in ('2dsphere', 'raw'):
+            catq = SyncCatalogQuery(self.backend.query('4FGL', method=method))
+            src, dist = catq.findclosest(10.0015, 20., 10., projection={'name': 1})
+            self.assertEqual(src['name'], 'b')
+            self.assertAlmostEqual(dist, 0.0005 * 3600. * np.cos(np.radians(20.)), places=3)
+            self.assertNotIn('pos', src.colnames)
+            self.assertEqual(catq.findclosest(50., 20., 10.), (None, None))
+
+    def test_in_flight(self):
+        catq = SyncCatalogQuery(self.backend.query('4FGL'))
+        start = time.monotonic()
+        futures = [catq.submit_binaryserach(10. + 0.001 * i, 20., 10.) for i in range(40)]
+        results = [future.result() for future in futures]
+        # 40 queries of 20 ms, at most 8 at once
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(self.coll.max_in_flight, 8)
+        self.assertEqual(results[:3], [True, True, True])
+        self.assertFalse(results[-1])
+
+    def test_get_backend(self):
+        client = {'4FGL': {'srcs': self.coll}}
+        backends = [get_backend('mem://test', client=client, max_in_flight=n) for n in (4, 4, 2)]
+        try:
+            self.assertIs(backends[0], backends[1])
+            # other settings are not silently dropped
+            self.assertIsNot(backends[0], backends[2])
+            self.assertEqual(backends[2].max_in_flight, 2)
+        finally:
+            for backend in set(backends):
+                backend.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
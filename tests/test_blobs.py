@@ -0,0 +1,36 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.blobs import encode_array, decode_array, decode_arrays, HEADER
+
+import unittest
+import numpy as np
+
+
+class TestBlobs(unittest.TestCase):
+    def test_roundtrip(self):
+        values = np.array([2458000.5, 2458001.25, 2458003.75])
+        blob = encode_array(values, 'float64')
+        self.assertEqual(len(blob), HEADER.size + 3 * 8)
+        decoded = decode_array(blob)
+        np.testing.assert_array_equal(decoded, values)
+        # a view of the blob, not a copy
+        self.assertFalse(decoded.flags.writeable)
+        self.assertEqual(decoded.dtype, np.dtype('<f8'))
+
+    def test_float32(self):
+        blob = encode_array([17.25, 18.5], 'float32')
+        self.assertEqual(len(blob), HEADER.size + 2 * 4)
+        self.assertEqual(decode_array(blob).dtype, np.dtype('<f4'))
+
+    def test_legacy_lists(self):
+        doc = {'phot_mag_g': {'mag_val': [17., 18.], 'label': 'phot_mag_g', 'is_brighter': 1,
+                              'bayesian_blocks': {'x': encode_array([1., 2.])}}}
+        decoded = decode_arrays(doc)
+        np.testing.assert_array_equal(decoded['phot_mag_g']['mag_val'], [17., 18.])
+        np.testing.assert_array_equal(decoded['phot_mag_g']['bayesian_blocks']['x'], [1., 2.])
+        self.assertEqual(decoded['phot_mag_g']['label'], 'phot_mag_g')
+        self.assertIsNone(decode_array(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.cache import LRUCache, CatalogMatchCache
+
+import unittest
+import time
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = LRUCache(capacity=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # 'b' is the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertAlmostEqual(cache.hit_rate, 2. / 3)
+
+    def test_ttl(self):
+        cache = LRUCache(capacity=2, ttl=0.01)
+        cache.put('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_position_key(self):
+        cache = CatalogMatchCache(quantum_arcsec=1.)
+        latest = {'ra': 150., 'dec': 10.}
+        near = {'ra': 150. + 0.1 / 3600, 'dec': 10.}
+        far = {'ra': 150. + 3. / 3600, 'dec': 10.}
+        self.assertEqual(cache.make_key(None, latest), cache.make_key(None, near))
+        self.assertNotEqual(cache.make_key(None, latest), cache.make_key(None, far))
+
+
+if __name__ == '__main__':
+    unittest.main()
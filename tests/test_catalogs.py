@@ -0,0 +1,42 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.catalogs import CatalogManager
+
+import unittest
+
+
+class TestCatalogManager(unittest.TestCase):
+    def test_swap(self):
+        versions = {'4FGL': 'v1'}
+        built = []
+        def build(catalog):
+            built.append(catalog)
+            return (catalog, versions[catalog])
+        manager = CatalogManager(build, versions.get, ['4FGL'])
+        snapshot = manager.snapshot
+        self.assertEqual(manager.get('4FGL'), ('4FGL', 'v1'))
+        self.assertEqual(manager.refresh(), [])
+        self.assertEqual(built, ['4FGL'])
+
+        # a new release is built and swapped in, old snapshots are untouched
+        versions['4FGL'] = 'v2'
+        self.assertEqual(manager.refresh(), ['4FGL'])
+        self.assertEqual(manager.get('4FGL'), ('4FGL', 'v2'))
+        self.assertEqual(manager.snapshot.versions, {'4FGL': 'v2'})
+        self.assertGreater(manager.snapshot.generation, snapshot.generation)
+        self.assertEqual(snapshot.queries['4FGL'], ('4FGL', 'v1'))
+
+    def test_failed_reload(self):
+        versions = {'4FGL': 'v1'}
+        def build(catalog):
+            if versions[catalog] == 'broken':
+                raise RuntimeError("index not ready")
+            return versions[catalog]
+        manager = CatalogManager(build, versions.get, ['4FGL'])
+        versions['4FGL'] = 'broken'
+        self.assertEqual(manager.refresh(), [])
+        self.assertEqual(manager.get('4FGL'), 'v1')
+
+
+if __name__ == '__main__':
+    unittest.main()
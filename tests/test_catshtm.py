@@ -0,0 +1,65 @@
+#!/bin/env python
+
+import unittest
+import numpy as np
+
+try:
+    from ampel.contrib.veritas.catshtm import CatsHTMClient, CatsHTMServer, CatsHTMError
+except ImportError:
+    raise unittest.SkipTest("pyzmq not installed")
+
+
+def fake_cone_search(catalog, ra, dec, radius):
+    """
+    stand-in for catsHTM.cone_search: two sources around the position
+    """
+    if catalog == 'broken':
+        raise IOError("no such catalog")
+    return [[ra, dec, 1.], [ra + 1e-6, dec, 2.]], ['RA', 'Dec', 'Mag'], ['rad', 'rad', 'mag']
+
+
+class TestCatsHTM(unittest.TestCase):
+    def setUp(self):
+        uri = 'inproc://catshtm-%s' % self.id()
+        self.server = CatsHTMServer(uri, cone_search=fake_cone_search, n_workers=2)
+        self.server.start()
+        self.client = CatsHTMClient(uri, pool_size=2, timeout=5.)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+    def test_cone_search(self):
+        srcs, colnames, colunits = self.client.cone_search('NED', 0.1, 0.2, 10.)
+        self.assertEqual(colnames, ['RA', 'Dec', 'Mag'])
+        np.testing.assert_array_equal(srcs[:, 2], [1., 2.])
+
+    def test_pipelined(self):
+        positions = [('NED', 0.01 * i, 0.2, 10.) for i in range(50)]
+        results = self.client.cone_search_many(positions)
+        # replies are correlated to their request, whatever their order
+        self.assertEqual([srcs[0, 0] for srcs, _, _ in results], [0.01 * i for i in range(50)])
+        self.assertFalse(self.client.pending)
+
+    def test_batched(self):
+        req_id = self.client.submit('NED', [0.1, 0.2, 0.3], [0., 0., 0.], 5.)
+        results = self.client.result(req_id)
+        self.assertEqual([srcs[0, 0] for srcs, _, _ in results], [0.1, 0.2, 0.3])
+
+    def test_cancel(self):
+        cancelled = self.client.submit('NED', 0.1, 0.2, 10.)
+        self.client.cancel(cancelled)
+        # its late reply is dropped
+        self.client.cone_search('NED', 0.3, 0.2, 10.)
+        self.assertFalse(self.client.pending)
+        self.assertNotIn(cancelled, self.client.replies)
+        with self.assertRaises(KeyError):
+            self.client.result(cancelled)
+
+    def test_error(self):
+        with self.assertRaises(CatsHTMError):
+            self.client.cone_search('broken', 0.1, 0.2, 10.)
+
+
+if __name__ == '__main__':
+    unittest.main()
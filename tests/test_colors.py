@@ -0,0 +1,72 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.t2.colors import EpochTable, batched_polyfit, batched_iterative_polyfit, close_pairs
+from ampel.contrib.veritas.t2.lcarrays import DTYPE
+
+import unittest
+import numpy as np
+
+
+def make_points(rows):
+    points = np.zeros(len(rows), dtype=DTYPE)
+    for field, values in zip(('jd', 'fid', 'magpsf', 'sigmapsf'), zip(*rows)):
+        points[field] = values
+    return points
+
+
+class TestEpochTable(unittest.TestCase):
+    def test_colors(self):
+        points = make_points([
+            (10.3, 1, 17.0, 0.1), (10.4, 2, 16.5, 0.1), (10.6, 3, 16.0, 0.1), (10.7, 1, 17.2, 0.1),
+            (12.4, 2, 16.4, 0.1), (13.5, 1, 17.1, 0.1), (13.6, 2, 16.6, 0.1),
+        ])
+        # not sorted by time
+        table = EpochTable(points[::-1])
+        self.assertEqual(len(table), 3)
+        colors = table.colors()
+        self.assertEqual(sorted(colors), [(1, 2), (1, 3), (2, 3)])
+        np.testing.assert_allclose(colors[(1, 2)]['color_val'], [0.6, 0.5])
+        np.testing.assert_allclose(colors[(1, 2)]['jds_val'], [10.45, 13.55])
+        np.testing.assert_allclose(colors[(1, 2)]['jds_err'], [0.05, 0.05])
+        self.assertAlmostEqual(colors[(1, 2)]['color_err'][0], np.hypot(0.1 / np.sqrt(2), 0.1))
+        np.testing.assert_allclose(colors[(2, 3)]['color_val'], [0.5])
+
+
+class TestBatchedPolyfit(unittest.TestCase):
+    def test_polyfit(self):
+        rng = np.random.default_rng(1)
+        xs = [np.sort(rng.random(n) * 10.) for n in (3, 8, 30)]
+        ys = [1. + 0.2 * x - 0.05 * x ** 2 + rng.normal(0., 0.01, len(x)) for x in xs]
+        for deg in (1, 2):
+            coefs, resid = batched_polyfit(xs, ys, deg)
+            for x, y, coef, res in zip(xs, ys, coefs, resid):
+                expected, expected_res = np.polyfit(x, y, deg, full=True)[0:2]
+                np.testing.assert_allclose(coef, expected, rtol=1e-8, atol=1e-10)
+                if len(expected_res):
+                    self.assertAlmostEqual(res, expected_res[0])
+                else:
+                    self.assertTrue(np.isnan(res))
+
+    def test_iterative(self):
+        x = np.linspace(0., 10., 20)
+        fits = batched_iterative_polyfit([x[:2], x, x], [x[:2], 2. * x, x ** 2 / 10.], 2)
+        self.assertEqual(fits[0], (None, None))
+        # the linear fit is kept, the parabola needs the 2nd order
+        self.assertEqual(len(fits[1][0]), 2)
+        self.assertEqual(len(fits[2][0]), 3)
+        np.testing.assert_allclose(fits[2][0], [0.1, 0., 0.], atol=1e-9)
+
+
+class TestClosePairs(unittest.TestCase):
+    def test_matches_product(self):
+        rng = np.random.RandomState(0)
+        for n1, n2 in ((0, 5), (5, 0), (40, 60), (200, 7)):
+            jd1, jd2 = np.round(rng.rand(n1) * 30, 1), np.round(rng.rand(n2) * 30, 1)
+            for width in (0.5, 1., 3.):
+                expected = np.nonzero(np.abs(jd1[:, None] - jd2[None, :]) <= width)
+                for got, ref in zip(close_pairs(jd1, jd2, width), expected):
+                    np.testing.assert_array_equal(got, ref)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.dedupe import BloomFilter, RotatingBloomFilter, CandidDeduplicator, UNSEEN
+
+import unittest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_membership(self):
+        bloom = BloomFilter(capacity=1000, fp_rate=1e-3)
+        for candid in range(1000):
+            bloom.add(candid)
+        # no false negatives
+        self.assertTrue(all(candid in bloom for candid in range(1000)))
+        false_positives = sum(candid in bloom for candid in range(10**6, 10**6 + 20000))
+        self.assertLess(false_positives / 20000., 5e-3)
+        self.assertLess(bloom.estimated_fp_rate(), 2e-3)
+
+    def test_rotation(self):
+        clock = FakeClock()
+        bloom = RotatingBloomFilter(window=4., capacity=100, generations=4, clock=clock)
+        bloom.add(1)
+        for i in range(4):
+            clock.now += 1.
+            bloom.add(100 + i)
+        self.assertIn(103, bloom)
+        # the generation holding key 1 was dropped after the window
+        self.assertNotIn(1, bloom)
+        self.assertEqual(len(bloom.filters), 4)
+
+
+class TestCandidDeduplicator(unittest.TestCase):
+    def test_verdicts(self):
+        dedupe = CandidDeduplicator(capacity=1000)
+        self.assertIs(dedupe.lookup(1), UNSEEN)
+        dedupe.record(1, ['T2BLAZARPRODUCTS'])
+        dedupe.record(2, None)
+        self.assertEqual(dedupe.lookup(1), ['T2BLAZARPRODUCTS'])
+        self.assertIsNone(dedupe.lookup(2))
+        self.assertIs(dedupe.lookup(3), UNSEEN)
+        stats = dedupe.stats()
+        self.assertEqual((stats['hits_accepted'], stats['hits_rejected']), (1, 1))
+
+    def test_drop_accepted(self):
+        dedupe = CandidDeduplicator(capacity=1000, drop_accepted=True)
+        dedupe.record(1, ['T2BLAZARPRODUCTS'])
+        self.assertIsNone(dedupe.lookup(1))
+
+    def test_from_config(self):
+        self.assertIsNone(CandidDeduplicator.from_config({}))
+        self.assertIsInstance(CandidDeduplicator.from_config({'window_days': 1}), CandidDeduplicator)
+
+
+if __name__ == '__main__':
+    unittest.main()
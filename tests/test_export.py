@@ -0,0 +1,77 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.export import ColumnarWriter, flatten, load_npz_export
+from ampel.contrib.veritas.blobs import encode_array
+
+import unittest
+import tempfile
+import shutil
+import numpy as np
+
+
+class TestColumnarExport(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_flatten(self):
+        row = flatten({'ZTF_g': {'mag': 18.5, 'jd': encode_array([1., 2.]), 'coef': [1, 2, 3]},
+                       'names': ['a', 'b']}, 'phot.')
+        self.assertEqual(row['phot.ZTF_g.mag'], 18.5)
+        np.testing.assert_array_equal(row['phot.ZTF_g.jd'], [1., 2.])
+        np.testing.assert_array_equal(row['phot.ZTF_g.coef'], [1., 2., 3.])
+        self.assertEqual(row['phot.names'], '["a", "b"]')
+
+    def test_chunks(self):
+        writer = ColumnarWriter(self.directory, chunk_rows=2)
+        for i in range(5):
+            row = {'tran_id': i, 'name': 'ZTF%d' % i, 'mag': np.arange(i, dtype=float)}
+            if i == 3:
+                row['extra'] = 1.
+            writer.append(row)
+        writer.close()
+        self.assertEqual(len(writer.manifest['parts']), 3)
+        self.assertIsNotNone(writer.last_export)
+
+        data = load_npz_export(self.directory)
+        np.testing.assert_array_equal(data['tran_id'], np.arange(5))
+        self.assertEqual(list(data['name']), ['ZTF0', 'ZTF1', 'ZTF2', 'ZTF3', 'ZTF4'])
+        values, offsets = data['mag.values'], data['mag.offsets']
+        self.assertEqual(len(offsets), 6)
+        np.testing.assert_array_equal(values[offsets[4]:offsets[5]], [0., 1., 2., 3.])
+        # column only present in one row of one part
+        self.assertEqual(np.isnan(data['extra']).sum(), 4)
+        self.assertEqual(data['extra'][3], 1.)
+
+    def test_append_session(self):
+        writer = ColumnarWriter(self.directory)
+        writer.append({'tran_id': 1, 'mag': np.ones(2)})
+        writer.close()
+        # a later export appends its rows to the dataset
+        writer = ColumnarWriter(self.directory)
+        writer.append({'tran_id': 2})
+        writer.close()
+        self.assertEqual(writer.manifest['n_rows'], 2)
+        data = load_npz_export(self.directory, columns=['tran_id', 'mag'])
+        np.testing.assert_array_equal(data['tran_id'], [1, 2])
+        np.testing.assert_array_equal(data['mag.offsets'], [0, 2, 2])
+
+    def test_missing_columns(self):
+        writer = ColumnarWriter(self.directory, chunk_rows=2)
+        # poly_coef is None without fit, only in the first part
+        writer.append({'tran_id': 1, 'poly_coef': None})
+        writer.append({'tran_id': 2, 'poly_coef': None})
+        writer.append({'tran_id': 3, 'poly_coef': np.ones(2), 'name': 'ZTF3'})
+        writer.append({'tran_id': 4, 'poly_coef': None, 'name': None})
+        writer.append({'tran_id': 5, 'name': 'ZTF5'})
+        writer.close()
+        data = load_npz_export(self.directory)
+        self.assertNotIn('poly_coef', data)
+        np.testing.assert_array_equal(data['poly_coef.offsets'], [0, 0, 0, 2, 2, 2])
+        self.assertEqual(list(data['name']), ['', '', 'ZTF3', '', 'ZTF5'])
+
+
+if __name__ == '__main__':
+    unittest.main()
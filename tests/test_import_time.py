@@ -0,0 +1,108 @@
+#!/bin/env python
+
+import unittest
+import importlib.util
+import subprocess
+import tempfile
+import shutil
+import sys
+import os
+import json
+
+# modules loaded by short-lived workers and tools, with the packages they
+# must not pull in at import time
+MODULES = {
+    'ampel.contrib.veritas.channels': ('numpy', 'astropy', 'pymongo', 'extcats'),
+    'ampel.contrib.veritas.t0.VeritasBlazarFilter': ('numpy', 'astropy', 'pymongo', 'extcats'),
+    'ampel.contrib.veritas.t2.T2BlazarProducts': ('astropy', 'pymongo', 'extcats'),
+    'ampel.contrib.veritas.t2.T2CatalogMatch': ('astropy', 'pymongo', 'extcats'),
+}
+
+# seconds, on top of the ampel base classes (imported beforehand)
+IMPORT_BUDGET = 0.5
+
+SCRIPT = """
+import sys, time, json
+import pydantic
+import ampel.base.abstract.AbsAlertFilter, ampel.base.abstract.AbsT2Unit
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+print(json.dumps({{'dt': dt, 'modules': sorted(sys.modules)}}))
+"""
+
+# minimal stand-ins of the ampel classes the modules derive from or call
+# at import time, so that the import budget is checked without ampel
+STUBS = {
+    'ampel/base/abstract/AbsAlertFilter.py': "class AbsAlertFilter(object):\n    pass\n",
+    'ampel/base/abstract/AbsT2Unit.py': "class AbsT2Unit(object):\n    pass\n",
+    'ampel/contrib/hu/utils.py': "def info_as_debug(logger):\n    return logger\n",
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _missing(*modules):
+    for module in modules:
+        try:
+            if importlib.util.find_spec(module) is None:
+                return module
+        except ImportError:
+            return module
+    return None
+
+
+def import_module(module, path=None):
+    """
+    import module in a new interpreter
+    :param path: directories to prepend to the python path
+    :return: (import time in seconds, list of the loaded modules), or None
+             if dependencies of the module are not installed
+    """
+    env = dict(os.environ)
+    if path is not None:
+        env['PYTHONPATH'] = os.pathsep.join(path + [env.get('PYTHONPATH', '')])
+    proc = subprocess.run([sys.executable, '-c', SCRIPT.format(module=module)],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    if proc.returncode != 0:
+        if b'ModuleNotFoundError' in proc.stderr:
+            return None
+        raise AssertionError(proc.stderr.decode())
+    res = json.loads(proc.stdout.decode().splitlines()[-1])
+    return res['dt'], res['modules']
+
+
+class TestImportTime(unittest.TestCase):
+    @unittest.skipIf(_missing('pydantic', 'ampel.base'), "ampel base classes are not installed")
+    def test_lazy_imports(self):
+        for module, heavy in MODULES.items():
+            with self.subTest(module=module):
+                res = import_module(module)
+                if res is None:
+                    self.skipTest("dependencies of %s are not installed" % module)
+                loaded = [m for m in res[1] if m.split('.')[0] in heavy]
+                self.assertEqual(loaded, [], "%s imports %s" % (module, loaded))
+
+    @unittest.skipIf(_missing('pydantic', 'numpy'), "pydantic or numpy is not installed")
+    def test_import_budget(self):
+        stubs = tempfile.mkdtemp()
+        try:
+            for path, source in STUBS.items():
+                os.makedirs(os.path.join(stubs, os.path.dirname(path)), exist_ok=True)
+                with open(os.path.join(stubs, path), 'w') as outfile:
+                    outfile.write(source)
+            for module, heavy in MODULES.items():
+                with self.subTest(module=module):
+                    res = import_module(module, path=[ROOT, stubs])
+                    if res is None:
+                        self.skipTest("dependencies of %s are not installed" % module)
+                    dt, loaded = res
+                    loaded = [m for m in loaded if m.split('.')[0] in heavy]
+                    self.assertEqual(loaded, [], "%s imports %s" % (module, loaded))
+                    self.assertLess(dt, IMPORT_BUDGET, "%s takes %.2f s to import" % (module, dt))
+        finally:
+            shutil.rmtree(stubs)
+
+
+if __name__ == '__main__':
+    unittest.main()
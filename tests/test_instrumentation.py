@@ -0,0 +1,45 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.instrumentation import Instrumentation, NULL_INSTRUMENTATION
+
+import unittest
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_disabled(self):
+        self.assertIs(Instrumentation.from_config('unit', None), NULL_INSTRUMENTATION)
+        self.assertIs(Instrumentation.from_config('unit', {'enabled': False}), NULL_INSTRUMENTATION)
+        with NULL_INSTRUMENTATION.timer('stage'):
+            pass
+        NULL_INSTRUMENTATION.stopwatch().lap('stage')
+        NULL_INSTRUMENTATION.incr('counter')
+        self.assertEqual(NULL_INSTRUMENTATION.histograms, {})
+        self.assertEqual(NULL_INSTRUMENTATION.counters, {})
+
+    def test_exposition(self):
+        instr = Instrumentation.from_config('VeritasBlazarFilter', {'buckets': [0.1, 1.]})
+        instr.observe('cuts', 0.05)
+        instr.observe('cuts', 0.5)
+        instr.observe('cuts', 5.)
+        sw = instr.stopwatch()
+        sw.lap('catalog.4FGL')
+        instr.incr('rejected.low_rb')
+        instr.incr('rejected.low_rb')
+        text = instr.exposition()
+        labels = 'unit="VeritasBlazarFilter",stage="cuts"'
+        self.assertIn('ampel_veritas_stage_seconds_bucket{%s,le="0.1"} 1' % labels, text)
+        self.assertIn('ampel_veritas_stage_seconds_bucket{%s,le="1"} 2' % labels, text)
+        self.assertIn('ampel_veritas_stage_seconds_bucket{%s,le="+Inf"} 3' % labels, text)
+        self.assertIn('ampel_veritas_stage_seconds_count{%s} 3' % labels, text)
+        self.assertIn('stage="catalog.4FGL"', text)
+        self.assertIn('ampel_veritas_events_total{unit="VeritasBlazarFilter",name="rejected.low_rb"} 2', text)
+        self.assertIn('rejected.low_rb=2', instr.summary())
+
+    def test_channel(self):
+        instr = Instrumentation.from_config('VeritasBlazarFilter', {'channel': 'VERITAS_BLAZARS'})
+        instr.incr('accepted')
+        self.assertIn('unit="VeritasBlazarFilter.VERITAS_BLAZARS"', instr.exposition())
+
+
+if __name__ == '__main__':
+    unittest.main()
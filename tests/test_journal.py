@@ -0,0 +1,87 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.t3.journal import UploadJournal, IN_FLIGHT, DEFERRED
+
+import unittest
+import tempfile
+import threading
+import os
+
+
+class TestUploadJournal(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'uploads.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_states(self):
+        journal = UploadJournal(self.path, retry_delay=0.)
+        self.assertTrue(journal.enqueue('a/dump.json', ['a'], '{}'))
+        self.assertTrue(journal.enqueue('b/dump.json', ['b'], b'{}', state=IN_FLIGHT))
+        # only pending uploads are claimed
+        self.assertEqual(journal.claim_due(), [('a/dump.json', ['a'], b'{}')])
+        journal.mark_done('a/dump.json')
+        journal.mark_failed('b/dump.json', 'HTTP 423')
+        self.assertEqual(journal.counts(), {'done': 1, 'failed': 1})
+        # unchanged content is not uploaded again, changed content is
+        self.assertFalse(journal.enqueue('a/dump.json', ['a'], '{}'))
+        self.assertTrue(journal.enqueue('a/dump.json', ['a'], '{"x": 1}'))
+        self.assertEqual(sorted(url for url, _, _ in journal.claim_due()), ['a/dump.json', 'b/dump.json'])
+
+    def test_backoff(self):
+        journal = UploadJournal(self.path, retry_delay=3600.)
+        journal.enqueue('a/dump.json', ['a'], '{}', state=IN_FLIGHT)
+        journal.mark_failed('a/dump.json')
+        self.assertEqual(journal.claim_due(), [])
+        self.assertEqual(len(journal.claim_due(now=float('inf'))), 1)
+
+    def test_resume_after_crash(self):
+        journal = UploadJournal(self.path)
+        journal.enqueue('a/dump.json', ['a'], '{}', state=IN_FLIGHT)
+        # no close(): the process died during the upload
+        resumed = UploadJournal(self.path)
+        self.assertEqual(resumed.counts(), {'pending': 1})
+        self.assertEqual(resumed.claim_due(), [('a/dump.json', ['a'], b'{}')])
+
+    def test_in_flight(self):
+        journal = UploadJournal(self.path)
+        journal.enqueue('a/dump.json', ['a'], '{}')
+        claimed = journal.claim_due()
+        # being uploaded by the retries: not uploaded again
+        self.assertFalse(journal.enqueue('a/dump.json', ['a'], '{}', state=IN_FLIGHT))
+        self.assertFalse(journal.enqueue('a/dump.json', ['a'], '{"x": 1}', state=IN_FLIGHT))
+        self.assertEqual(journal.counts(), {'in_flight': 1})
+        # the new content is uploaded after the one in flight
+        url, _, data = claimed[0]
+        journal.mark_done(url, data)
+        self.assertEqual(journal.claim_due(), [('a/dump.json', ['a'], b'{"x": 1}')])
+        journal.mark_done(url, b'{"x": 1}')
+        self.assertEqual(journal.counts(), {'done': 1})
+
+    def test_threads(self):
+        journal = UploadJournal(self.path)
+
+        def work(i):
+            for j in range(50):
+                journal.enqueue('%d/%d.json' % (i, j), [str(i)], '{}')
+                journal.counts()
+                journal.next_retry()
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(journal.counts(), {'pending': 200})
+
+    def test_deferred(self):
+        journal = UploadJournal(self.path)
+        journal.enqueue('a/dump.json', ['a'], '{}', state=DEFERRED)
+        self.assertEqual(journal.claim_due(), [])
+        # picked up by the next run
+        self.assertEqual(len(UploadJournal(self.path).claim_due()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
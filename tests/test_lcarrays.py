@@ -0,0 +1,94 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.t2.lcarrays import LightCurveArrays, get_lc_arrays, bin_points, bin_upper_limits, \
+    summarize_points, DTYPE
+
+import unittest
+import numpy as np
+
+
+class PhotoPoint(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class LightCurve(object):
+    def __init__(self, pps, compound_id=None, uls=()):
+        self.ppo_list = [PhotoPoint(pp) for pp in pps]
+        self.ulo_list = [PhotoPoint(ul) for ul in uls]
+        self.compound_id = compound_id
+
+
+PPS = [
+    {'jd': 1., 'fid': 1, 'magpsf': 17.5, 'sigmapsf': 0.1, 'ra': 10., 'dec': 20.},
+    {'jd': 2., 'fid': 2, 'magpsf': 17.0, 'sigmapsf': 0.1, 'ra': 10.2, 'dec': 20.2},
+    {'jd': 3., 'fid': 1, 'magpsf': 17.2, 'sigmapsf': 0.1, 'ra': 10.1, 'dec': 20.1},
+]
+
+
+class TestLightCurveArrays(unittest.TestCase):
+    def test_columns(self):
+        arrays = LightCurveArrays.from_light_curve(LightCurve(PPS))
+        self.assertEqual(len(arrays), 3)
+        # grouped by band
+        np.testing.assert_array_equal(arrays.magpsf, [17.5, 17.2, 17.0])
+        self.assertEqual(sorted(arrays.bands), [1, 2])
+        # band groups are views of the points array
+        np.testing.assert_array_equal(arrays.bands[1]['jd'], [1., 3.])
+        self.assertTrue(np.shares_memory(arrays.bands[1], arrays.points))
+
+    def test_get_pos(self):
+        arrays = LightCurveArrays.from_light_curve(LightCurve(PPS))
+        self.assertEqual(arrays.get_pos('brightest'), (10.2, 20.2))
+        self.assertEqual(arrays.get_pos('latest'), (10.1, 20.1))
+        with self.assertRaises(IndexError):
+            LightCurveArrays.from_light_curve(LightCurve([])).get_pos()
+
+    def test_shared_by_compound(self):
+        lc = LightCurve(PPS, compound_id='abc')
+        self.assertIs(get_lc_arrays(lc), get_lc_arrays(LightCurve(PPS, compound_id='abc')))
+        self.assertIsNot(get_lc_arrays(LightCurve(PPS)), get_lc_arrays(LightCurve(PPS)))
+
+    def test_shared_with_upper_limits(self):
+        uls = [{'jd': 4.6, 'fid': 1, 'diffmaglim': 19.5}]
+        # loaded without upper limits first (e.g. by T2CatalogMatch), then with
+        self.assertEqual(len(get_lc_arrays(LightCurve(PPS, compound_id='ul1')).uls), 0)
+        arrays = get_lc_arrays(LightCurve(PPS, compound_id='ul1', uls=uls))
+        self.assertEqual(len(arrays.uls), 1)
+        self.assertIs(get_lc_arrays(LightCurve(PPS, compound_id='ul1')), arrays)
+        # and in the other order
+        arrays = get_lc_arrays(LightCurve(PPS, compound_id='ul2', uls=uls))
+        self.assertIs(get_lc_arrays(LightCurve(PPS, compound_id='ul2')), arrays)
+        self.assertEqual(len(get_lc_arrays(LightCurve(PPS, compound_id='ul2', uls=uls)).uls), 1)
+
+    def test_nightly_binning(self):
+        points = np.zeros(4, dtype=DTYPE)
+        points['jd'] = [10.3, 10.6, 11.4, 12.9]
+        points['magpsf'] = [17., 18., 17., 16.]
+        points['sigmapsf'] = [0.1, 0.2, 0.1, 0.1]
+        binned = bin_points(points, 1.)
+        # the first two points are taken the same night
+        np.testing.assert_allclose(binned['jd'], [10.45, 11.4, 12.9])
+        np.testing.assert_allclose(binned['magpsf'], [17.2, 17., 16.])
+        self.assertAlmostEqual(binned['sigmapsf'][0], (1 / 0.1 ** 2 + 1 / 0.2 ** 2) ** -0.5)
+        summary = summarize_points(points)
+        self.assertEqual(summary['n'], 4)
+        self.assertEqual(summary['mag_sum'], 68.)
+        self.assertEqual((summary['jd_first'], summary['jd_last']), (10.3, 12.9))
+
+    def test_upper_limits(self):
+        uls = [{'jd': 4.6, 'fid': 1, 'diffmaglim': 19.5}, {'jd': 4.4, 'fid': 1, 'diffmaglim': 20.},
+               {'jd': 3.1, 'fid': 1, 'diffmaglim': 20.5}, {'jd': 5.5, 'fid': 2, 'diffmaglim': 19.}]
+        arrays = LightCurveArrays.from_light_curve(LightCurve(PPS, uls=uls))
+        self.assertEqual(sorted(arrays.ul_bands), [1, 2])
+        # sorted by time within a band
+        np.testing.assert_array_equal(arrays.ul_bands[1]['jd'], [3.1, 4.4, 4.6])
+        self.assertEqual(len(LightCurveArrays.from_light_curve(LightCurve(PPS)).uls), 0)
+        # deepest limit of each night, none in the night of the detection at jd 3
+        binned = bin_upper_limits(arrays.ul_bands[1], 1., arrays.bands[1])
+        np.testing.assert_array_equal(binned['jd'], [4.4])
+        np.testing.assert_array_equal(binned['diffmaglim'], [20.])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.profiling import CallProfiler, NULL_PROFILER, load_slowest
+
+import unittest
+import tempfile
+import shutil
+import glob
+import json
+import os
+import pstats
+
+
+def work(n):
+    return sum(i * i for i in range(n))
+
+
+class TestCallProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_disabled(self):
+        self.assertIs(CallProfiler.from_config('unit', None), NULL_PROFILER)
+        self.assertIs(CallProfiler.from_config('unit', {'enabled': False, 'directory': '.'}), NULL_PROFILER)
+        with NULL_PROFILER.profile('key', 1):
+            pass
+        self.assertEqual(NULL_PROFILER.n_calls, 0)
+
+    def test_sampling(self):
+        profiler = CallProfiler.from_config('unit', {
+            'directory': self.directory, 'every': 3, 'slowest': 2, 'dump_interval': 1e6})
+        for n in (10, 20000, 10, 10, 30000, 10):
+            with profiler.profile('candid%d' % n, {'n': n}):
+                work(n)
+        self.assertEqual(profiler.n_calls, 6)
+        self.assertEqual(profiler.n_profiled, 2)
+        self.assertEqual([call['key'] for call in profiler.sampled], ['candid10', 'candid10'])
+        profiler.dump()
+
+        # merged profile of the sampled calls
+        path, = glob.glob(os.path.join(self.directory, 'unit-*.pstats'))
+        stats = pstats.Stats(path)
+        self.assertTrue(any(func[2] == 'work' for func in stats.stats))
+        with open(path.replace('.pstats', '.json')) as infile:
+            self.assertEqual(len(json.load(infile)['sampled']), 2)
+
+        # the slowest calls are kept with their inputs, to be replayed
+        path, = glob.glob(os.path.join(self.directory, 'unit-*-slowest.pkl'))
+        slowest = load_slowest(path)
+        self.assertEqual([entry['key'] for entry in slowest], ['candid30000', 'candid20000'])
+        self.assertEqual(work(**slowest[0]['inputs']), work(30000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+#!/bin/env python
+
+from ampel.contrib.veritas.t3.ranking import TopK
+
+import unittest
+import random
+
+
+class TestTopK(unittest.TestCase):
+    def test_stream(self):
+        scores = list(range(1000))
+        random.Random(1).shuffle(scores)
+        top = TopK(5)
+        for score in scores:
+            top.push(score, score)
+        self.assertEqual([item for _, item in top.ranked()], [999, 998, 997, 996, 995])
+        self.assertEqual(len(top.heap), 5)
+        self.assertEqual(top.n_seen, 1000)
+
+    def test_lazy_items(self):
+        top = TopK(2)
+        built = []
+        for score in (0.5, 0.9, 0.1, 0.7):
+            top.push(score, lambda: built.append(score) or score)
+        # the item of 0.1 was never built
+        self.assertEqual(built, [0.5, 0.9, 0.7])
+        self.assertEqual(top.threshold(), 0.7)
+
+    def test_ties(self):
+        top = TopK(2)
+        for name in 'abc':
+            top.push(1., name)
+        self.assertEqual([item for _, item in top.ranked()], ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()